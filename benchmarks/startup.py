@@ -0,0 +1,64 @@
+"""
+Measure borg-drone CLI startup time.
+
+Reports the cumulative import time of each borg_drone module (from `python -X importtime`)
+and the wall time of `borg-drone version`.
+
+    python3 benchmarks/startup.py [RUNS]
+"""
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+
+
+def import_times() -> dict[str, int]:
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import borg_drone.__main__'],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=ROOT,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and 'borg_drone' in line:
+            _, _, cumulative, name = (x.strip() for x in line.replace('import time:', '|').split('|'))
+            times[name] = int(cumulative)
+    return times
+
+
+def version_time(runs: int) -> list[float]:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-m', 'borg_drone', 'version'], capture_output=True, check=True, cwd=ROOT)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main() -> None:
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print('Cumulative import time (us)')
+    for name, us in sorted(import_times().items(), key=lambda x: -x[1]):
+        print(f'\t{us:>8} │ {name}')
+
+    version_time(1)  # warm up the bytecode cache
+    baseline = version_time(runs)
+    interpreter = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        interpreter.append(time.perf_counter() - start)
+
+    print(f'`borg-drone version` over {runs} runs')
+    print(f'\tmedian      │ {statistics.median(baseline) * 1000:.1f} ms')
+    print(f'\tinterpreter │ {statistics.median(interpreter) * 1000:.1f} ms')
+    print(f'\toverhead    │ {(statistics.median(baseline) - statistics.median(interpreter)) * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Measure configuration validation time as the number of archives grows.
+
+Generates configurations with the given numbers of archives (each referencing two of N/10 repositories)
+and reports the time taken by `validate_config` and the time per archive, which should stay roughly constant.
+
+    python3 benchmarks/validation.py [ARCHIVES ...]
+"""
+import sys
+import time
+from pathlib import Path
+from typing import Any
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from borg_drone.config import validate_config  # noqa: E402
+from borg_drone.schema import config_validator  # noqa: E402
+
+
+def generate_config(archives: int) -> dict[str, Any]:
+    repositories = max(2, archives // 10)
+    local = {
+        f'local-{i}': {
+            'path': f'/mnt/backup/{i}',
+            'encryption': 'keyfile-blake2',
+            'prune': [{'keep_daily': 7}, {'keep_weekly': 4}],
+            'rclone_upload_path': f'remote:backup/{i}',
+        }
+        for i in range(repositories // 2)
+    }
+    remote = {
+        f'remote-{i}': {
+            'hostname': f'host-{i}.example.com',
+            'encryption': 'repokey-blake2',
+            'upload_ratelimit': {'default': '20Mbit', 'schedule': [{'start': '08:00', 'end': '18:00', 'rate': '2M'}]},
+        }
+        for i in range(repositories - len(local))
+    }
+    return {
+        'repositories': {'local': local, 'remote': remote},
+        'archives': {
+            f'archive-{i}': {
+                'paths': [f'/srv/data/{i}'],
+                'exclude': ['*.tmp'],
+                'repositories': {
+                    f'local-{i % len(local)}': None,
+                    f'remote-{i % len(remote)}': {'priority': {'nice': 10}},
+                },
+            }
+            for i in range(archives)
+        },
+    }
+
+
+def main() -> None:
+    sizes = [int(x) for x in sys.argv[1:]] or [100, 10_000, 100_000]
+    config_validator()  # compile the schema outside of the timings
+    print(f'{"archives":>10} │ {"total":>10} │ per archive')
+    for size in sizes:
+        data = generate_config(size)
+        start = time.perf_counter()
+        validate_config(data)
+        elapsed = time.perf_counter() - start
+        print(f'{size:>10} │ {elapsed * 1000:>7.1f} ms │ {elapsed / size * 1e6:.1f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,10 @@ from typing import Any, Callable, Optional
 from dataclasses import dataclass
 from pathlib import Path
 
-from . import __version__, command
-from .util import setup_logging
+from types import ModuleType
+
+from . import __version__
+from .log import setup_logging
 from .config import ConfigValidationError, DEFAULT_CONFIG_FILE
 from .types import OutputFormat, TargetTuple
 
@@ -23,44 +25,108 @@ class ProgramArguments:
     format: OutputFormat = OutputFormat.text
     keyfile: Optional[Path] = None
     password_file: Optional[Path] = None
+    jobs: int = 1
+    upload_jobs: int = 1
+    max_per_host: int = 1
+    max_per_repo: int = 1
+    metrics_file: Optional[Path] = None
+    full_upload: bool = False
+    days: int = 30
+    cached: bool = False
+    refresh: bool = False
+    max_age: int = 300
+    compression: Optional[list[str]] = None
+    sample_size: int = 256
+    write: bool = False
+    sample: Optional[int] = None
+    hash: str = 'md5'
     TARGET: TargetTuple = None
 
 
+def command() -> ModuleType:
+    """
+    Import the command module on first use, so that light subcommands such as `version` do not pay for it
+    """
+    from . import command as module
+    return module
+
+
 # Map subcommands to a command function
 command_functions: dict[str, Callable[[ProgramArguments], Any]] = {
     'version': lambda args: print(__version__),
-    'generate-config': lambda args: command.generate_config_command(
+    'generate-config': lambda args: command().generate_config_command(
         args.config_file,
         overwrite=args.force,
     ),
-    'targets': lambda args: command.targets_command(
+    'targets': lambda args: command().targets_command(
         args.config_file,
         output=OutputFormat(args.format),
     ),
-    'init': lambda args: command.init_command(
+    'init': lambda args: command().init_command(
         args.config_file,
         args.TARGET,
     ),
-    'info': lambda args: command.info_command(
+    'info': lambda args: command().info_command(
+        args.config_file,
+        args.TARGET,
+        cached=args.cached,
+        refresh=args.refresh,
+        max_age=args.max_age,
+        jobs=args.jobs,
+        output=OutputFormat(args.format),
+    ),
+    'list': lambda args: command().list_command(
         args.config_file,
         args.TARGET,
+        cached=args.cached,
+        refresh=args.refresh,
+        max_age=args.max_age,
+        jobs=args.jobs,
+        output=OutputFormat(args.format),
     ),
-    'list': lambda args: command.list_command(
+    'check': lambda args: command().check_command(
         args.config_file,
         args.TARGET,
+        jobs=args.jobs,
+        output=OutputFormat(args.format),
     ),
-    'create': lambda args: command.create_command(
+    'create': lambda args: command().create_command(
         args.config_file,
         args.TARGET,
+        jobs=args.jobs,
+        upload_jobs=args.upload_jobs,
+        limits=command().ConcurrencyLimits(per_host=args.max_per_host, per_repository=args.max_per_repo),
+        metrics_file=args.metrics_file,
+        full_upload=args.full_upload,
     ),
-    'key-export': lambda args: command.key_export_command(
+    'stats': lambda args: command().stats_command(
+        args.TARGET,
+        days=args.days,
+        output=OutputFormat(args.format),
+    ),
+    'tune': lambda args: command().tune_command(
         args.config_file,
         args.TARGET,
+        candidates=args.compression,
+        sample_size=args.sample_size * 2**20,
+        write=args.write,
     ),
-    'key-cleanup': lambda args: command.key_cleanup_command(
+    'verify-upload': lambda args: command().verify_upload_command(
         args.config_file,
+        args.TARGET,
+        sample=args.sample,
+        hash_type=args.hash,
+        jobs=args.jobs,
+        output=OutputFormat(args.format),
     ),
-    'key-import': lambda args: command.key_import_command(
+    'key-export': lambda args: command().key_export_command(
+        args.config_file,
+        args.TARGET,
+    ),
+    'key-cleanup': lambda args: command().key_cleanup_command(
+        args.config_file,
+    ),
+    'key-import': lambda args: command().key_import_command(
         args.config_file,
         args.TARGET,
         args.keyfile,
@@ -72,6 +138,23 @@ HELP_TEXT = {
     'TARGET': 'Select targets using "[ARCHIVE]:[REPO]" syntax',
     'KEYFILE': 'Select borg repo key file',
     'PASSWORD_FILE': 'Select borg password file',
+    'JOBS': 'Number of targets which may be in each borg stage (create, prune, compact) at the same time',
+    'QUERY_JOBS': 'Number of targets to query at the same time',
+    'UPLOAD_JOBS': 'Number of rclone uploads to run at the same time',
+    'MAX_PER_HOST': 'Maximum number of concurrent targets on a single remote host',
+    'MAX_PER_REPO': 'Maximum number of concurrent targets on a single borg repository path',
+    'CACHED': 'Answer from the result cache, refreshing results older than --max-age in the background',
+    'REFRESH': 'Query the repositories and update the result cache',
+    'MAX_AGE': 'Age in seconds after which cached results are refreshed',
+    'DAYS': 'Number of days of history to report on',
+    'METRICS_FILE': 'Write metrics for the node_exporter textfile collector to this file after the run',
+    'FULL_UPLOAD': 'Upload repositories with a full rclone sync, rather than only the files changed since the last one',
+    'COMPRESSION': 'Compression setting to benchmark, may be given more than once (default: lz4, zstd levels and auto)',
+    'SAMPLE_SIZE': 'Amount of data in MiB to sample from the archive paths',
+    'WRITE': 'Save the recommended compression to the configuration file (the previous file is kept as .bak)',
+    'SAMPLE': 'Number of files whose remote hash is checked, continuing from where the last verification stopped '
+    '(default: 16, 0 only checks sizes and modification times)',
+    'HASH': 'Hash to compare, choose one supported by the remote (e.g. md5 for S3 and Drive, sha1 for B2)',
 }
 
 
@@ -84,6 +167,28 @@ def parse_args() -> ProgramArguments:
             raise ValueError(f'String "{text}" does not match format "ARCHIVE:[REPO]"')
         return target[0].strip(), target[1].strip()
 
+    def positive_int(text: str) -> int:
+        value = int(text)
+        if value < 1:
+            raise ValueError(f'Value must be at least 1: {text}')
+        return value
+
+    def non_negative_int(text: str) -> int:
+        value = int(text)
+        if value < 0:
+            raise ValueError(f'Value must not be negative: {text}')
+        return value
+
+    def add_cache_arguments(subparser: ArgumentParser) -> None:
+        cache_group = subparser.add_mutually_exclusive_group()
+        cache_group.add_argument('--cached', action='store_true', help=HELP_TEXT['CACHED'])
+        cache_group.add_argument('--refresh', action='store_true', help=HELP_TEXT['REFRESH'])
+        subparser.add_argument('--max-age', type=positive_int, default=300, help=HELP_TEXT['MAX_AGE'])
+
+    def add_query_arguments(subparser: ArgumentParser) -> None:
+        subparser.add_argument('--jobs', '-j', type=positive_int, default=4, help=HELP_TEXT['QUERY_JOBS'])
+        subparser.add_argument('--format', '-f', choices=OutputFormat.values(), default='text')
+
     parser = ArgumentParser()
     parser.add_argument(
         '--config-file',
@@ -116,14 +221,50 @@ def parse_args() -> ProgramArguments:
     # info
     info_subparser = command_subparser.add_parser('info', help='Run "borg info" on specified targets')
     info_subparser.add_argument('TARGET', type=archive_target, help=HELP_TEXT['TARGET'])
+    add_cache_arguments(info_subparser)
+    add_query_arguments(info_subparser)
 
     # list
     list_subparser = command_subparser.add_parser('list', help='Run "borg list" on specified targets')
     list_subparser.add_argument('TARGET', type=archive_target, help=HELP_TEXT['TARGET'])
+    add_cache_arguments(list_subparser)
+    add_query_arguments(list_subparser)
+
+    # check
+    check_subparser = command_subparser.add_parser('check', help='Run "borg check" on specified targets')
+    check_subparser.add_argument('TARGET', type=archive_target, help=HELP_TEXT['TARGET'])
+    add_query_arguments(check_subparser)
 
     # create
     create_subparser = command_subparser.add_parser('create', help='Create a new backup on specified targets')
     create_subparser.add_argument('TARGET', type=archive_target, help=HELP_TEXT['TARGET'])
+    create_subparser.add_argument('--jobs', '-j', type=positive_int, default=1, help=HELP_TEXT['JOBS'])
+    create_subparser.add_argument('--upload-jobs', type=positive_int, default=1, help=HELP_TEXT['UPLOAD_JOBS'])
+    create_subparser.add_argument('--max-per-host', type=positive_int, default=1, help=HELP_TEXT['MAX_PER_HOST'])
+    create_subparser.add_argument('--max-per-repo', type=positive_int, default=1, help=HELP_TEXT['MAX_PER_REPO'])
+    create_subparser.add_argument('--metrics-file', type=Path, help=HELP_TEXT['METRICS_FILE'], metavar='FILE')
+    create_subparser.add_argument('--full-upload', action='store_true', help=HELP_TEXT['FULL_UPLOAD'])
+
+    # stats
+    stats_subparser = command_subparser.add_parser('stats', help='Show trends of past backups from the run history')
+    stats_subparser.add_argument('TARGET', type=archive_target, nargs='?', default=None, help=HELP_TEXT['TARGET'])
+    stats_subparser.add_argument('--days', type=positive_int, default=30, help=HELP_TEXT['DAYS'])
+    stats_subparser.add_argument('--format', '-f', choices=OutputFormat.values(), default='text')
+
+    # tune
+    tune_subparser = command_subparser.add_parser('tune', help='Benchmark compression settings on sampled files')
+    tune_subparser.add_argument('TARGET', type=archive_target, help=HELP_TEXT['TARGET'])
+    tune_subparser.add_argument('--compression', action='append', help=HELP_TEXT['COMPRESSION'], metavar='SPEC')
+    tune_subparser.add_argument('--sample-size', type=positive_int, default=256, help=HELP_TEXT['SAMPLE_SIZE'])
+    tune_subparser.add_argument('--write', action='store_true', help=HELP_TEXT['WRITE'])
+
+    # verify-upload
+    verify_subparser = command_subparser.add_parser(
+        'verify-upload', help='Check rclone uploads against the local manifest without downloading them')
+    verify_subparser.add_argument('TARGET', type=archive_target, help=HELP_TEXT['TARGET'])
+    verify_subparser.add_argument('--sample', type=non_negative_int, default=None, help=HELP_TEXT['SAMPLE'])
+    verify_subparser.add_argument('--hash', choices=['md5', 'sha1'], default='md5', help=HELP_TEXT['HASH'])
+    add_query_arguments(verify_subparser)
 
     # key-export
     key_export_subparser = command_subparser.add_parser('key-export', help='Export and display secrets')
@@ -0,0 +1,85 @@
+import json
+import os
+import time
+from dataclasses import dataclass
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Optional
+
+from .config import Target
+from .util import atomic_write_text
+
+logger = getLogger(__package__)
+
+# Refresh markers older than this are assumed to be left behind by a refresh which did not finish
+REFRESH_TIMEOUT = 3600
+
+
+@dataclass(frozen=True)
+class CachedResult:
+    time: float
+    data: Any
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.time
+
+
+def result_file(target: Target, kind: str) -> Path:
+    return target.config_path / 'results' / f'{kind}.json'
+
+
+def read_result(target: Target, kind: str) -> Optional[CachedResult]:
+    """
+    Read the cached output of a borg command (e.g. info, list) for the target
+    """
+    try:
+        with result_file(target, kind).open() as f:
+            cached = json.load(f)
+        return CachedResult(cached['time'], cached['data'])
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as ex:
+        logger.debug(f'Ignoring unreadable cached {kind} result for {target.name}: {ex}')
+        return None
+
+
+def write_result(target: Target, kind: str, data: Any) -> None:
+    try:
+        atomic_write_text(result_file(target, kind), json.dumps({'time': time.time(), 'data': data}))
+    except OSError as ex:
+        logger.warning(f'Unable to cache {kind} result for {target.name}: {ex}')
+
+
+def invalidate_results(target: Target) -> None:
+    """
+    Remove all cached results of the target, after its repository has been changed
+    """
+    try:
+        for file in (target.config_path / 'results').glob('*.json'):
+            file.unlink(missing_ok=True)
+    except OSError as ex:
+        logger.warning(f'Unable to invalidate cached results for {target.name}: {ex}')
+
+
+def claim_refresh(target: Target, kind: str) -> bool:
+    """
+    Mark a background refresh of the cached result as started.
+    Returns False if another refresh is already in progress.
+    """
+    marker = result_file(target, kind).with_suffix('.refresh')
+    try:
+        if time.time() - marker.stat().st_mtime > REFRESH_TIMEOUT:
+            marker.unlink(missing_ok=True)
+    except FileNotFoundError:
+        pass
+    try:
+        marker.parent.mkdir(parents=True, exist_ok=True)
+        os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600))
+    except FileExistsError:
+        return False
+    return True
+
+
+def release_refresh(target: Target, kind: str) -> None:
+    result_file(target, kind).with_suffix('.refresh').unlink(missing_ok=True)
@@ -1,14 +1,29 @@
-import json
+import asyncio
 import os
-import subprocess
-from getpass import getpass
+from collections import Counter
+import time
 from pathlib import Path, PurePosixPath
+import logging
 from logging import getLogger
 from subprocess import CalledProcessError
-from typing import Optional
-
-from .config import RemoteRepository, LocalRepository
-from .util import run_cmd, get_targets, execute, update_ssh_known_hosts, CustomJSONEncoder, require_borg
+from typing import Any, Callable, Optional
+
+from .cache import claim_refresh, invalidate_results, read_result, release_refresh, write_result
+from .config import RemoteRepository, LocalRepository, Target
+from .log import log_prefix
+from .fingerprint import (
+    Fingerprint,
+    forget_fingerprint,
+    read_fingerprint,
+    source_fingerprint,
+    target_fingerprint,
+    write_fingerprint,
+)
+from .progress import ArchiveProgress, ArchiveStats, BorgEventParser, LogMessage, ProgressView, format_size
+from .scheduler import ConcurrencyLimits, Stage, StageResult, TargetFunction, run_pipeline
+from .ssh import known_hosts_name, multiplexed, ssh_argv, update_ssh_known_hosts
+from .util import run_cmd, run_cmd_async, get_targets, execute, execute_async, CustomJSONEncoder, require_borg
+from .tools import borg_capabilities, find_tool
 from .types import OutputFormat, TargetTuple
 
 logger = getLogger(__package__)
@@ -21,6 +36,7 @@ def generate_config_command(config_file: Path, overwrite: bool = False) -> None:
     """
     if config_file.exists() and not overwrite:
         raise RuntimeError(f'Configuration file already exists: {config_file}')
+    config_file.parent.mkdir(parents=True, exist_ok=True)
     config_file.write_text((Path(__file__).parent / 'example.yml').read_text())
     logger.info(f'Configuration file created: {config_file}')
     logger.info(f'Edit this file to configure the application')
@@ -32,29 +48,47 @@ def init_command(config_file: Path, sync_target: TargetTuple) -> None:
     Wrapper for calling 'borg init' on all targets for the provided archives
     Initialises all configured borg repositories
     """
+    targets = []
     for target in get_targets(config_file, sync_target):
         if target.initialised:
             logger.info(f'{target.name} already initialised')
-            continue
-
-        target.create_password_file()
-
-        # Check / add server host key
-        if isinstance(target.repo, RemoteRepository):
+        else:
+            target.create_password_file()
+            targets.append(target)
+
+    # Check / add server host keys for every remote before any connection is made
+    remotes = {t.name: (t.repo.hostname, t.repo.port) for t in targets if isinstance(t.repo, RemoteRepository)}
+    unknown_hosts = update_ssh_known_hosts(remotes.values())
+    for hostname, port in unknown_hosts:
+        logger.error(f'Unable to fetch host key for {known_hosts_name(hostname, port)}')
+    targets = [t for t in targets if remotes.get(t.name) not in unknown_hosts]
+
+    results = []
+    with multiplexed(targets):
+        for target in targets:
+            started = time.time()
+            if target.primary is not None and target.archive.fanout == 'sync':
+                logger.info(f'{target.name} is a copy of {target.primary.name}, it will be created by the first sync')
+                target.config_path.mkdir(parents=True, exist_ok=True)
+                (target.config_path / '.initialised').touch(exist_ok=True)
+                continue
             try:
-                update_ssh_known_hosts(target.repo.hostname)
+                argv = [*borg_capabilities().init_command, '--encryption', target.repo.encryption]
+                if target.primary is not None:
+                    # Share the chunker secret with the primary, so transferred archives deduplicate
+                    argv += ['--other-repo', target.primary.borg_repository_path]
+                run_cmd(argv, env=target.environment, priority=target.priority)
             except CalledProcessError as ex:
                 logger.error(ex)
-                continue
+                results.append(StageResult(target, 'init', started, time.time(), ex))
+            else:
+                logger.info(f'{target.name} initialised')
+                (target.config_path / '.initialised').touch(exist_ok=True)
+                forget_fingerprint(target)
+                results.append(StageResult(target, 'init', started, time.time()))
 
-        try:
-            argv = ['borg', 'init', '--encryption', target.repo.encryption]
-            run_cmd(argv, env=target.environment)
-        except CalledProcessError as ex:
-            logger.error(ex)
-        else:
-            logger.info(f'{target.name} initialised')
-            (target.config_path / '.initialised').touch(exist_ok=True)
+    from .history import record_results
+    record_results('init', results)
 
 
 @require_borg
@@ -65,23 +99,36 @@ def key_export_command(config_file: Path, sync_target: TargetTuple) -> None:
     """
     passwords = {}
     exported = []
-    for target in get_targets(config_file, sync_target):
-        try:
-            lines = list(execute(['borg', 'key', 'export', '--paper'], env=target.environment))
-        except CalledProcessError as ex:
-            logger.error(ex)
-            continue
-        else:
-            target.paper_keyfile.write_text('\n'.join(lines))
+    results = []
+    targets = get_targets(config_file, sync_target)
+    with multiplexed(targets):
+        for target in targets:
+            started = time.time()
+            try:
+                argv = ['borg', 'key', 'export', '--paper']
+                lines = list(execute(argv, env=target.environment, priority=target.priority))
+            except CalledProcessError as ex:
+                logger.error(ex)
+                results.append(StageResult(target, 'key-export', started, time.time(), ex))
+                continue
+            else:
+                target.config_path.mkdir(parents=True, exist_ok=True)
+                target.paper_keyfile.write_text('\n'.join(lines))
 
-        try:
-            run_cmd(['borg', 'key', 'export', '::', str(target.keyfile)], env=target.environment)
-        except CalledProcessError as ex:
-            logger.error(ex)
-            continue
+            try:
+                argv = ['borg', 'key', 'export', *borg_capabilities().repository(), str(target.keyfile)]
+                run_cmd(argv, env=target.environment, priority=target.priority)
+            except CalledProcessError as ex:
+                logger.error(ex)
+                results.append(StageResult(target, 'key-export', started, time.time(), ex))
+                continue
+
+            results.append(StageResult(target, 'key-export', started, time.time()))
+            passwords[f'{target.name}:{target.repo.name}'] = target.password_file.read_text()
+            exported += [target.keyfile, target.paper_keyfile]
 
-        passwords[f'{target.name}:{target.repo.name}'] = target.password_file.read_text()
-        exported += [target.keyfile, target.paper_keyfile]
+    from .history import record_results
+    record_results('key-export', results)
 
     logger.info(f'{len(exported)} Encryption keys exported')
     if passwords:
@@ -110,17 +157,29 @@ def key_import_command(
     if sync_target is None:
         raise RuntimeError('No target provided')
     if password_file is None:
+        from getpass import getpass
         password = getpass('Enter password for existing archive: ')
     else:
         password = password_file.read_text()
 
-    for target in get_targets(config_file, sync_target):
-        target.create_password_file(contents=password)
-        try:
-            run_cmd(['borg', 'key', 'import', '::', str(keyfile)], env=target.environment)
-        except CalledProcessError as ex:
-            logger.error(ex)
-        logger.info(f'Imported keys for {target.name} successfully')
+    results = []
+    targets = get_targets(config_file, sync_target)
+    with multiplexed(targets):
+        for target in targets:
+            target.create_password_file(contents=password)
+            started = time.time()
+            try:
+                argv = ['borg', 'key', 'import', *borg_capabilities().repository(), str(keyfile)]
+                run_cmd(argv, env=target.environment, priority=target.priority)
+            except CalledProcessError as ex:
+                logger.error(ex)
+                results.append(StageResult(target, 'key-import', started, time.time(), ex))
+            else:
+                logger.info(f'Imported keys for {target.name} successfully')
+                results.append(StageResult(target, 'key-import', started, time.time()))
+
+    from .history import record_results
+    record_results('key-import', results)
 
 
 def key_cleanup_command(config_file: Path) -> None:
@@ -138,67 +197,526 @@ def key_cleanup_command(config_file: Path) -> None:
     logger.info(f'{found} files removed')
 
 
+def _bandwidth_key(target: Target) -> Optional[str]:
+    """
+    Targets with the same key share a single upload budget
+    """
+    if isinstance(target.repo, RemoteRepository):
+        return f'host:{target.repo.hostname}'
+    if target.repo.rclone_upload_path:
+        return f'rclone:{target.repo.rclone_upload_path.split(":", 1)[0]}'
+    return None
+
+
+def _upload_ratelimit(target: Target, shared_by: int) -> Optional[int]:
+    """
+    Current upload rate limit in KiB/s for a single job, splitting the repository budget across concurrent jobs
+    """
+    rate = target.repo.upload_ratelimit.current()
+    if rate is None:
+        return None
+    share = max(1, rate // max(1, shared_by))
+    logger.info(f'Upload rate limited to {share} KiB/s ({rate} KiB/s shared by up to {shared_by} job(s))')
+    return share
+
+
+async def _create_stage(
+    target: Target,
+    shared_by: int = 1,
+    view: Optional[ProgressView] = None,
+) -> Optional[ArchiveStats]:
+    logger.info(f'----- {target.name} -----')
+    if target.priority:
+        logger.info(f'Process priority: {target.priority}')
+    if target.profile:
+        logger.info(f'Performance profile: {target.profile}')
+    archive = target.archive
+    borg = borg_capabilities()
+    # Without JSON output, borg's human readable stats are logged instead
+    output_args = ['--log-json', '--progress', '--json'] if borg.log_json else ['--stats']
+    argv = ['borg', 'create', *output_args, '--compression', target.compression, *target.profile.argv]
+    if target.repo.is_remote:
+        ratelimit = _upload_ratelimit(target, shared_by)
+        if ratelimit is not None:
+            argv += [borg.ratelimit_option, str(ratelimit)]
+    if archive.one_file_system:
+        argv.append('--one-file-system')
+    for pattern in archive.exclude:
+        argv += ['--exclude', pattern]
+    argv.append(borg.archive('{now}'))
+    argv += map(os.path.expanduser, archive.paths)
+
+    parser = BorgEventParser()
+    try:
+        async for line in execute_async(argv, env=target.environment, priority=target.priority, spill=True):
+            event = parser.feed(line)
+            if isinstance(event, ArchiveProgress):
+                if view is not None:
+                    view.update(target.name, event)
+            elif event is not None:
+                logger.log(event.level, event.message)
+    finally:
+        if view is not None:
+            view.finish(target.name)
+        invalidate_results(target)
+
+    if parser.result is None:
+        if borg.log_json:
+            logger.warning('No archive statistics were reported')
+        return None
+    stats = ArchiveStats.from_json(parser.result)
+    logger.info(f'Archive {stats}')
+    return stats
+
+
+async def _prune_stage(target: Target) -> None:
+    prune_argv = ['borg', 'prune', '-v', '--list', *target.repo.prune.argv]
+    try:
+        await run_cmd_async(prune_argv, env=target.environment, priority=target.priority, spill=True)
+    finally:
+        invalidate_results(target)
+
+
+async def _compact_stage(target: Target) -> None:
+    borg = borg_capabilities()
+    compact_argv = ['borg', 'compact', *([] if borg.borg2 else ['--cleanup-commits']), *borg.repository()]
+    try:
+        await run_cmd_async(compact_argv, env=target.environment, priority=target.priority)
+    finally:
+        invalidate_results(target)
+
+
+def _upload_targets(targets: list[Target], upload_jobs: int = 1, full: bool = False) -> list[StageResult]:
+    """
+    Upload local repositories to their rclone remotes in one phase, once every borg stage has finished.
+    Targets sharing a repository and upload path are uploaded together, and up to upload_jobs groups at once.
+    """
+    from .upload import upload_group, upload_group_key
+
+    if not targets:
+        return []
+    if find_tool('rclone') is None:
+        logger.warning('Unable to locate rclone executable')
+        return []
+    groups: dict[tuple[str, str], list[Target]] = {}
+    for target in targets:
+        groups.setdefault(upload_group_key(target), []).append(target)
+    bandwidth_users = Counter(_bandwidth_key(group[0]) for group in groups.values())
+
+    async def upload(group: list[Target], semaphore: asyncio.Semaphore) -> list[StageResult]:
+        async with semaphore:
+            log_prefix.set(f'[{group[0].repo.name}] ')
+            shared_by = min(upload_jobs, bandwidth_users[_bandwidth_key(group[0])])
+            started = time.time()
+            error: Optional[Exception] = None
+            try:
+                await upload_group(group, _upload_ratelimit(group[0], shared_by), full)
+            except Exception as ex:
+                logger.error(f'upload failed: {ex}')
+                error = ex
+            return [StageResult(target, 'upload', started, time.time(), error) for target in group]
+
+    async def upload_all() -> list[list[StageResult]]:
+        semaphore = asyncio.Semaphore(upload_jobs)
+        return await asyncio.gather(*(upload(group, semaphore) for group in groups.values()))
+
+    return [result for results in asyncio.run(upload_all()) for result in results]
+
+
+async def _replicate_stage(target: Target, shared_by: int = 1) -> None:
+    """
+    Copy the primary repository of a fan-out archive into the target's repository,
+    so the sources are only read and chunked once for all of the archive's repositories
+    """
+    primary = target.primary
+    assert primary is not None
+    logger.info(f'Replicating from {primary.name} ({target.archive.fanout})')
+    try:
+        if target.archive.fanout == 'sync':
+            await _sync_repository(primary, target, shared_by)
+        else:
+            await _transfer_archives(primary, target, shared_by)
+    finally:
+        invalidate_results(target)
+
+
+async def _sync_repository(primary: Target, target: Target, shared_by: int) -> None:
+    """
+    Mirror the files of the (local) primary repository with rsync. The copy has the same repository id and key,
+    so it must only ever be written to by this sync.
+    """
+    if find_tool('rsync') is None:
+        raise RuntimeError('Unable to locate rsync executable')
+    argv = ['rsync', '--archive', '--delete', '--stats']
+    ratelimit = _upload_ratelimit(target, shared_by)
+    if ratelimit is not None:
+        argv += ['--bwlimit', str(ratelimit)]
+    if isinstance(target.repo, RemoteRepository):
+        argv += ['--rsh', ' '.join([*ssh_argv(target.repo), '-p', str(target.repo.port)])]
+        username = f'{target.repo.username}@' if target.repo.username else ''
+        destination = f'{username}{target.repo.hostname}:{PurePosixPath(target.repo.path) / target.archive.name}'
+    else:
+        Path(target.borg_repository_path).parent.mkdir(parents=True, exist_ok=True)
+        destination = target.borg_repository_path
+    argv += [f'{primary.borg_repository_path}/', destination]
+    await run_cmd_async(argv, priority=target.priority, spill=True)
+
+
+async def _transfer_archives(primary: Target, target: Target, shared_by: int) -> None:
+    """
+    Copy the archives which are missing from the target's repository with `borg transfer`
+    """
+    borg = borg_capabilities()
+    if not borg.borg2:
+        raise RuntimeError(f'fanout: transfer requires borg 2, found {borg.tool}')
+    argv = ['borg', 'transfer', '--other-repo', primary.borg_repository_path]
+    if target.repo.is_remote:
+        ratelimit = _upload_ratelimit(target, shared_by)
+        if ratelimit is not None:
+            argv += [borg.ratelimit_option, str(ratelimit)]
+    await run_cmd_async(argv, env=target.environment, priority=target.priority, spill=True)
+
+
 @require_borg
-def create_command(config_file: Path, sync_target: TargetTuple) -> None:
+def create_command(
+    config_file: Path,
+    sync_target: TargetTuple,
+    jobs: int = 1,
+    upload_jobs: int = 1,
+    limits: ConcurrencyLimits = ConcurrencyLimits(),
+    metrics_file: Optional[Path] = None,
+    full_upload: bool = False,
+) -> dict[str, ArchiveStats]:
     """
     Wrapper for calling 'borg create' on all targets for the provided archives
     Also calls 'borg prune' and 'borg compact' if specified by the configuration
+
+    Each target passes through the create, prune and compact stages in order, while different targets
+    may be in different stages at the same time. `jobs` limits each borg stage.
+    Local repositories with an rclone_upload_path are then uploaded incrementally, batched by repository,
+    with up to `upload_jobs` uploads at once. full_upload forces a full `rclone sync` instead.
+    Secondary repositories of fan-out archives are filled from the archive's first repository once its create,
+    prune and compact stages have finished, rather than reading the sources again.
+    Targets of archives with skip_if_unchanged are skipped entirely when their sources have the same fingerprint
+    as at the start of the last successful run.
+    Returns the statistics of each created archive, keyed by target name.
+    If metrics_file is given, the results are also written to it in the Prometheus text format.
     """
-    for target in get_targets(config_file, sync_target):
-        logger.info(f'----- {target.name} -----')
-        archive = target.archive
-        argv = ['borg', 'create', '--stats', '--compression', archive.compression]
-        if archive.one_file_system:
-            argv.append('--one-file-system')
-        for pattern in archive.exclude:
-            argv += ['--exclude', pattern]
-        argv.append('::{now}')
-        argv += map(os.path.expanduser, archive.paths)
-        run_cmd(argv, env=target.environment)
-
-        if target.repo.prune:
-            prune_argv = ['borg', 'prune', '-v', '--list', *target.repo.prune.argv]
-            run_cmd(prune_argv, env=target.environment)
-
-        if target.repo.compact:
-            run_cmd(['borg', 'compact', '--cleanup-commits', '::'], env=target.environment)
-
-        if isinstance(target.repo, LocalRepository) and target.repo.rclone_upload_path:
-            try:
-                subprocess.run(['rclone', '-V'], capture_output=True)
-            except FileNotFoundError:
-                logger.warning('Unable to locate rclone executable')
+    targets = get_targets(config_file, sync_target)
+
+    # Jobs uploading to the same host (or rclone remote) at the same time split its bandwidth budget between them
+    bandwidth_users = Counter(_bandwidth_key(t) for t in targets)
+    create_shared_by = {t.name: min(jobs, limits.per_host, bandwidth_users[_bandwidth_key(t)]) for t in targets}
+
+    view = ProgressView()
+    borg = borg_capabilities()
+
+    # Archives with skip_if_unchanged are fingerprinted once, before any of their targets are created
+    fingerprints: dict[str, asyncio.Task[Optional[Fingerprint]]] = {}
+    unchanged: set[str] = set()
+
+    async def fingerprint_stage(target: Target) -> Optional[Fingerprint]:
+        if target.archive.name not in fingerprints:
+            task = asyncio.create_task(asyncio.to_thread(source_fingerprint, target.archive))
+            fingerprints[target.archive.name] = task
+        fingerprint = await fingerprints[target.archive.name]
+        if fingerprint is None:
+            return None
+        fingerprint = target_fingerprint(target, fingerprint)
+        timing = f'{fingerprint.entries} entries in {fingerprint.duration:.2f}s'
+        if fingerprint.digest == read_fingerprint(target):
+            logger.info(f'Sources unchanged since the last successful run, skipping ({timing})')
+            unchanged.add(target.name)
+        else:
+            logger.info(f'Sources changed since the last successful run ({timing})')
+        return fingerprint
+
+    def changed(target: Target) -> bool:
+        return target.name not in unchanged
+
+    def not_synced(target: Target) -> bool:
+        # Synced copies are pruned and compacted along with their primary
+        return changed(target) and not (target.primary is not None and target.archive.fanout == 'sync')
+
+    def primary(target: Target) -> bool:
+        return changed(target) and target.primary is None
+
+    async def create_stage(target: Target) -> Optional[ArchiveStats]:
+        return await _create_stage(target, create_shared_by[target.name], view)
+
+    async def replicate_stage(target: Target) -> None:
+        await _replicate_stage(target, create_shared_by[target.name])
+
+    stages = [
+        Stage(
+            'fingerprint',
+            fingerprint_stage,
+            workers=jobs,
+            limited=False,
+            applies=lambda t: t.archive.skip_if_unchanged,
+        ),
+        Stage('create', create_stage, workers=jobs, applies=primary),
+        Stage('prune', _prune_stage, workers=jobs, applies=lambda t: not_synced(t) and bool(t.repo.prune)),
+        Stage(
+            'compact',
+            _compact_stage,
+            workers=jobs,
+            applies=lambda t: not_synced(t) and t.repo.compact and borg.compact,
+        ),
+        Stage('replicate', replicate_stage, workers=jobs, applies=lambda t: changed(t) and t.primary is not None),
+    ]
+    depends_on = {t.name: t.primary.name for t in targets if t.primary is not None}
+    with multiplexed(targets):
+        results = run_pipeline(targets, stages, limits=limits, depends_on=depends_on)
+    failed = {r.target.name for r in results if r.error is not None}
+    # Unchanged targets are included, to retry uploads which failed in an earlier run
+    uploads = [
+        t for t in targets
+        if isinstance(t.repo, LocalRepository) and t.repo.rclone_upload_path and t.name not in failed
+    ]
+    results += _upload_targets(uploads, upload_jobs, full_upload)
+    failed = {r.target.name for r in results if r.error is not None}
+    for r in results:
+        if r.stage == 'fingerprint' and r.result is not None and r.target.name not in failed | unchanged:
+            write_fingerprint(r.target, r.result.digest)
+    if metrics_file is not None:
+        from .metrics import write_metrics
+        write_metrics(metrics_file, targets, results)
+    from .history import record_results
+    record_results('create', results)
+    failures = [f'{r.target.name} ({r.stage})' for r in results if r.error is not None]
+    if failures:
+        raise RuntimeError(f'{len(failures)} target(s) failed: {", ".join(failures)}')
+    return {r.target.name: r.result for r in results if r.stage == 'create' and r.result is not None}
+
+
+async def _borg_json(target: Target, argv: list[str]) -> Any:
+    """
+    Run a borg command with --json and return its parsed result. borg's log messages are logged, not printed.
+    """
+    parser = BorgEventParser()
+    async for line in execute_async([*argv, '--log-json', '--json'], env=target.environment, priority=target.priority):
+        event = parser.feed(line)
+        if isinstance(event, LogMessage):
+            logger.log(event.level, event.message)
+    return parser.result
+
+
+def _background_refresh(config_file: Path, target: Target, kind: str) -> None:
+    """
+    Start a detached `borg-drone KIND --refresh` for the target, unless one is already running
+    """
+    if not claim_refresh(target, kind):
+        return
+    import subprocess
+    import sys
+    argv = [sys.executable, '-m', 'borg_drone', '--config-file', str(config_file), kind, '--refresh', target.name]
+    logger.debug(f'Refreshing cached {kind} result for {target.name} in the background')
+    subprocess.Popen(
+        argv,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def _error_result(error: BaseException) -> dict[str, Any]:
+    result: dict[str, Any] = {'error': str(error)}
+    if isinstance(error, CalledProcessError) and error.output:
+        result['output'] = error.output.splitlines()
+    return result
+
+
+def _query_targets(kind: str, targets: list[Target], run: TargetFunction, jobs: int) -> dict[str, Any]:
+    """
+    Run a read-only query against all targets concurrently, with at most `jobs` running at once.
+    Results are keyed by target name, failed targets have an 'error' entry instead.
+    """
+    if not targets:
+        return {}
+    # Read-only queries of different targets never touch the same repository, so no host or repository limits apply
+    stage = Stage(kind, run, workers=jobs, limited=False)
+    with multiplexed(targets):
+        results = run_pipeline(targets, [stage])
+    from .history import record_results
+    record_results(kind, results)
+    return {r.target.name: r.result if r.error is None else _error_result(r.error) for r in results}
+
+
+def _cached_results(
+    config_file: Path,
+    targets: list[Target],
+    kind: str,
+    argv: list[str],
+    cached: bool = False,
+    max_age: int = 300,
+    jobs: int = 4,
+    refresh: bool = False,
+) -> dict[str, Any]:
+    """
+    JSON results of a read-only borg command for each target, keyed by target name.
+    All targets are queried and their cached results updated, unless cached=True.
+    Then results younger than max_age are answered from the cache, and older results are answered from the cache
+    while a refresh runs in the background. Only targets without a cached result are queried.
+    With refresh=True this is the background refresh, which releases the marker claimed for it when done.
+    """
+    results = {}
+    query = []
+    for target in targets:
+        cached_result = read_result(target, kind) if cached else None
+        if cached_result is None:
+            query.append(target)
+            continue
+        results[target.name] = cached_result.data
+        if cached_result.age > max_age:
+            _background_refresh(config_file, target, kind)
+
+    async def run(target: Target) -> Any:
+        try:
+            data = await _borg_json(target, argv)
+        finally:
+            if refresh:
+                release_refresh(target, kind)
+        write_result(target, kind, data)
+        return data
+
+    results.update(_query_targets(kind, query, run, jobs))
+    return {t.name: results[t.name] for t in targets if t.name in results}
+
+
+async def _check_target(target: Target) -> dict[str, Any]:
+    messages = []
+    parser = BorgEventParser()
+    argv = ['borg', 'check', '--log-json']
+    try:
+        async for line in execute_async(argv, env=target.environment, priority=target.priority):
+            event = parser.feed(line)
+            if isinstance(event, LogMessage):
+                logger.log(event.level, event.message)
+                if event.level >= logging.WARNING:
+                    messages.append(event.message)
+    except CalledProcessError as ex:
+        ex.output = '\n'.join(messages)
+        raise
+    return {'status': 'ok', 'messages': messages}
+
+
+def _info_text(result: dict[str, Any]) -> list[tuple[str, str]]:
+    repository = result.get('repository', {})
+    lines = [
+        ('location', repository.get('location', '')),
+        ('modified', repository.get('last_modified', '')),
+        ('encryption', result.get('encryption', {}).get('mode', '')),
+    ]
+    stats = result.get('cache', {}).get('stats')
+    if stats:
+        lines.append((
+            'size',
+            f'{format_size(stats.get("total_size", 0))} original, '
+            f'{format_size(stats.get("total_csize", 0))} compressed, '
+            f'{format_size(stats.get("unique_csize", 0))} deduplicated',
+        ))
+    return lines
+
+
+def _list_text(result: dict[str, Any]) -> list[tuple[str, str]]:
+    archives = result.get('archives', [])
+    return [('archives', str(len(archives)))] + [(a.get('start', a.get('time', '')), a['name']) for a in archives]
+
+
+def _check_text(result: dict[str, Any]) -> list[tuple[str, str]]:
+    return [('status', result['status'])] + [('warning', message) for message in result['messages']]
+
+
+def _print_results(
+    results: dict[str, Any],
+    output: OutputFormat,
+    text: Callable[[dict[str, Any]], list[tuple[str, str]]],
+) -> None:
+    """
+    Print the merged results of a read-only command as a single document keyed by target name
+    """
+    if output == OutputFormat.json:
+        import json
+        print(json.dumps(results, indent=2, cls=CustomJSONEncoder))
+
+    elif output == OutputFormat.yaml:
+        import yaml
+        print(yaml.safe_dump(results, sort_keys=False))
+
+    elif output == OutputFormat.text:
+        for name, result in results.items():
+            print(name)
+            if 'error' in result:
+                lines = [('error', result['error']), *(('output', line) for line in result.get('output', []))]
             else:
-                remote_name, remote_base_path = target.repo.rclone_upload_path.split(':', 1)
-                remote_path = PurePosixPath(remote_base_path) / target.archive.name
-                upload_path = f'{remote_name}:{remote_path}'
-                run_cmd(['rclone', 'sync', '-v', '--stats-one-line', target.borg_repository_path, upload_path])
+                lines = text(result)
+            width = max(8, *(len(label) for label, _ in lines))
+            for label, value in lines:
+                print(f'\t{label:{width}}│ {value}')
+            print()
+
+    elif output == OutputFormat.python:
+        print(results)
 
 
 @require_borg
-def info_command(config_file: Path, target: TargetTuple) -> None:
+def info_command(
+    config_file: Path,
+    target: TargetTuple,
+    cached: bool = False,
+    refresh: bool = False,
+    max_age: int = 300,
+    jobs: int = 4,
+    output: OutputFormat = OutputFormat.text,
+) -> None:
     """
-    Wrapper for calling 'borg info' on all targets for the provided archives
+    Wrapper for calling 'borg info' (borg 2: 'borg repo-info') on all targets for the provided archives,
+    see _cached_results
     """
-    for t in get_targets(config_file, target):
-        logger.info(f'----- {t.name} -----')
-        try:
-            run_cmd(['borg', 'info'], env=t.environment)
-        except CalledProcessError as ex:
-            logger.error(ex)
+    targets = get_targets(config_file, target)
+    argv = borg_capabilities().repo_info_command
+    results = _cached_results(config_file, targets, 'info', argv, cached and not refresh, max_age, jobs, refresh)
+    _print_results(results, output, _info_text)
 
 
 @require_borg
-def list_command(config_file: Path, target: TargetTuple) -> None:
+def list_command(
+    config_file: Path,
+    target: TargetTuple,
+    cached: bool = False,
+    refresh: bool = False,
+    max_age: int = 300,
+    jobs: int = 4,
+    output: OutputFormat = OutputFormat.text,
+) -> None:
     """
-    Wrapper for calling 'borg list' on all targets for the provided archives
+    Wrapper for calling 'borg list' (borg 2: 'borg repo-list') on all targets for the provided archives,
+    see _cached_results
     """
-    for t in get_targets(config_file, target):
-        logger.info(f'----- {t.name} -----')
-        try:
-            run_cmd(['borg', 'list'], env=t.environment)
-        except CalledProcessError as ex:
-            logger.error(ex)
+    targets = get_targets(config_file, target)
+    argv = borg_capabilities().repo_list_command
+    results = _cached_results(config_file, targets, 'list', argv, cached and not refresh, max_age, jobs, refresh)
+    _print_results(results, output, _list_text)
+
+
+@require_borg
+def check_command(
+    config_file: Path,
+    target: TargetTuple,
+    jobs: int = 4,
+    output: OutputFormat = OutputFormat.text,
+) -> None:
+    """
+    Wrapper for calling 'borg check' on all targets for the provided archives
+    """
+    targets = get_targets(config_file, target)
+    results = _query_targets('check', targets, _check_target, jobs)
+    _print_results({t.name: results[t.name] for t in targets}, output, _check_text)
+    failures = [name for name, result in results.items() if 'error' in result]
+    if failures:
+        raise RuntimeError(f'{len(failures)} target(s) failed: {", ".join(failures)}')
 
 
 def targets_command(config_file: Path, output: OutputFormat = OutputFormat.text) -> None:
@@ -209,6 +727,7 @@ def targets_command(config_file: Path, output: OutputFormat = OutputFormat.text)
     targets = get_targets(config_file, ('', ''))
 
     if output == OutputFormat.json:
+        import json
         print(json.dumps([x.to_dict() for x in targets], indent=2, cls=CustomJSONEncoder))
 
     elif output == OutputFormat.yaml:
@@ -221,9 +740,181 @@ def targets_command(config_file: Path, output: OutputFormat = OutputFormat.text)
             if target.archive.exclude:
                 print(f'\texclude │ {", ".join(target.archive.exclude)}')
             print(f'\trepo    │ {target.repo.name} [{target.repo.url}]')
+            if target.primary is not None:
+                print(f'\tfanout  │ {target.archive.fanout} from {target.primary.repo.name}')
+            if target.repo.upload_ratelimit:
+                print(f'\tlimit   │ {target.repo.upload_ratelimit}')
+            if target.priority:
+                print(f'\tprio    │ {target.priority}')
+            if target.profile:
+                print(f'\tprofile │ {target.repo.profile or target.archive.profile} ({target.profile})')
             print()
         return
 
     elif output == OutputFormat.python:
         for target in targets:
             print(target)
+
+
+def _format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return '-'
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}h {minutes:02}m' if hours else f'{minutes}m {seconds:02}s'
+
+
+def _format_ratio(ratio: Optional[float], sign: str = '') -> str:
+    return '-' if ratio is None else f'{ratio:{sign}.2%}'
+
+
+def stats_command(sync_target: TargetTuple, days: int = 30, output: OutputFormat = OutputFormat.text) -> None:
+    """
+    Print trends of the `borg create` runs recorded in the run history over the last `days` days.
+    Targets are ordered slowest first.
+    """
+    from dataclasses import asdict
+    from datetime import datetime
+    from .history import target_stats
+
+    stats = target_stats(days, sync_target)
+
+    if output == OutputFormat.json:
+        import json
+        print(json.dumps([asdict(x) for x in stats], indent=2))
+
+    elif output == OutputFormat.yaml:
+        import yaml
+        print(yaml.safe_dump([asdict(x) for x in stats], sort_keys=False))
+
+    elif output == OutputFormat.text:
+        rows = [('target', 'runs', 'failed', 'median', 'max', 'dedup', 'drift', 'last success')]
+        for x in stats:
+            last_success = datetime.fromtimestamp(x.last_success).strftime('%Y-%m-%d %H:%M') if x.last_success else '-'
+            rows.append((
+                x.target,
+                str(x.runs),
+                str(x.failures),
+                _format_duration(x.median_duration),
+                _format_duration(x.max_duration),
+                _format_ratio(x.dedup_ratio),
+                _format_ratio(x.dedup_drift, '+'),
+                last_success,
+            ))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        for row in rows:
+            print(' │ '.join(f'{value:{width}}' for value, width in zip(row, widths)).rstrip())
+        if not stats:
+            print(f'No runs recorded in the last {days} days')
+
+    elif output == OutputFormat.python:
+        for x in stats:
+            print(x)
+
+
+@require_borg
+def tune_command(
+    config_file: Path,
+    sync_target: TargetTuple,
+    candidates: Optional[list[str]] = None,
+    sample_size: Optional[int] = None,
+    write: bool = False,
+) -> dict[str, str]:
+    """
+    Benchmark compression settings on a sample of each selected archive's files, and recommend the setting with
+    the lowest estimated backup time for each target: CPU time plus the time to write and upload the compressed data.
+    With write=True, the recommendations are saved to the configuration file.
+    Returns the recommended compression, keyed by target name.
+    """
+    from .tune import CANDIDATES, SAMPLE_SIZE, estimated_seconds, recommend, tune_archive, write_compression
+
+    targets = get_targets(config_file, sync_target)
+    archives: dict[str, list[Target]] = {}
+    for target in targets:
+        archives.setdefault(target.archive.name, []).append(target)
+
+    from .history import record_results
+    recommendations = {}
+    history: list[StageResult] = []
+    for name, archive_targets in archives.items():
+        archive = archive_targets[0].archive
+        started = time.time()
+        try:
+            sample, results = tune_archive(archive, candidates or CANDIDATES, sample_size or SAMPLE_SIZE)
+        except (CalledProcessError, RuntimeError) as ex:
+            history += [StageResult(t, 'tune', started, time.time(), ex) for t in archive_targets]
+            record_results('tune', history)
+            raise
+        history += [StageResult(t, 'tune', started, time.time()) for t in archive_targets]
+        print(f'{name} (sample of {format_size(sample.size)} from {sample.files} files)')
+        rows = [('compression', 'ratio', 'throughput', 'cpu', *(t.repo.name for t in archive_targets))]
+        for result in results:
+            rows.append((
+                result.compression,
+                _format_ratio(result.ratio),
+                f'{format_size(int(result.throughput))}/s',
+                f'{result.cpu_seconds:.2f}s',
+                *(f'{estimated_seconds(result, t):.2f}s' for t in archive_targets),
+            ))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        for row in rows:
+            print('\t' + ' │ '.join(f'{value:{width}}' for value, width in zip(row, widths)).rstrip())
+        for target in archive_targets:
+            best = recommend(results, target).compression
+            recommendations[target.name] = best
+            current = '' if best == target.compression else f' (currently {target.compression})'
+            print(f'\trecommended for {target.repo.name}: {best}{current}')
+        print()
+    record_results('tune', history)
+
+    if write:
+        compression = {
+            name: {t.repo.name: recommendations[t.name]
+                   for t in archive_targets}
+            for name, archive_targets in archives.items()
+        }
+        backup = write_compression(config_file, compression)
+        logger.info(f'Compression saved to {config_file}, the previous configuration was kept as {backup}')
+    return recommendations
+
+
+def _verify_upload_text(result: dict[str, Any]) -> list[tuple[str, str]]:
+    lines = [('status', result['status']), ('files', f'{result["files"]} listed, {result["hashed"]} hashed')]
+    for problem in ('missing', 'truncated', 'corrupt', 'modified', 'unexpected'):
+        lines += [(problem, path) for path in result[problem]]
+    return lines
+
+
+def verify_upload_command(
+    config_file: Path,
+    target: TargetTuple,
+    sample: Optional[int] = None,
+    hash_type: str = 'md5',
+    jobs: int = 4,
+    output: OutputFormat = OutputFormat.text,
+) -> None:
+    """
+    Compare the rclone uploads of local repositories with the manifest kept by each upload, without downloading them.
+    Every file is checked for its presence, size and modification time in the remote listing, and the remote hashes
+    of a rotating sample of files are compared with the hashes computed when they were uploaded.
+    """
+    from .upload import VERIFY_SAMPLE, verify_upload
+
+    if sample is not None and sample < 0:
+        raise ValueError(f'The sample must not be negative: {sample}')
+    targets = [
+        t for t in get_targets(config_file, target)
+        if isinstance(t.repo, LocalRepository) and t.repo.rclone_upload_path
+    ]
+    if not targets:
+        raise RuntimeError('No targets with an rclone upload path selected')
+
+    async def run(target: Target) -> dict[str, Any]:
+        result = await verify_upload(target, VERIFY_SAMPLE if sample is None else sample, hash_type)
+        return result.to_dict()
+
+    results = _query_targets('verify-upload', targets, run, jobs)
+    _print_results({t.name: results[t.name] for t in targets}, output, _verify_upload_text)
+    failures = [name for name, result in results.items() if 'error' in result or result['status'] != 'ok']
+    if failures:
+        raise RuntimeError(f'{len(failures)} target(s) failed: {", ".join(failures)}')
@@ -1,14 +1,16 @@
 import os
+import re
 from dataclasses import dataclass, fields, field, asdict
+from functools import lru_cache
 from itertools import chain
 from logging import getLogger
 from pathlib import Path, PurePosixPath
-from secrets import token_hex
-from typing import ClassVar, Optional, Union, Any, TypeVar, TYPE_CHECKING
-from urllib.parse import urlparse
+from typing import Callable, ClassVar, Optional, Union, Any, TypeVar, TYPE_CHECKING, cast
 from collections.abc import Iterable
+from datetime import datetime, time
 
-import yaml
+from . import __version__
+from .types import TargetTuple
 
 if TYPE_CHECKING:
     from _typeshed import DataclassInstance
@@ -27,7 +29,9 @@ def xdg_config_path(name: str, create: bool = False) -> Path:
     return path
 
 
-CONFIG_PATH = xdg_config_path("borg-drone", create=True)
+CONFIG_PATH = xdg_config_path("borg-drone")
+
+CONFIG_CACHE_PATH = CONFIG_PATH / 'cache'
 
 DEFAULT_CONFIG_FILE = CONFIG_PATH / 'config.yml'
 
@@ -67,6 +71,167 @@ class PruneOptions:
                 ]))
 
 
+@dataclass(frozen=True)
+class PriorityOptions:
+    """
+    Scheduling priority applied to the borg (and rclone) processes of a target.
+    Archive settings may be overridden field by field in the repository settings.
+    """
+    nice: Optional[int] = None
+    ionice_class: Optional[str] = None
+    ionice_level: Optional[int] = None
+    cpu_affinity: Optional[list[int]] = None
+
+    IONICE_CLASSES: ClassVar[dict[str, int]] = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+    @classmethod
+    def from_yaml(cls: type[T], data: Optional[dict[str, Any]]) -> T:
+        return cls(**(data or {}))
+
+    def merge(self, other: 'PriorityOptions') -> 'PriorityOptions':
+        """
+        Return a copy of these options with every value set in `other` taking precedence
+        """
+        return PriorityOptions(**dict(asdict(self), **{k: v for k, v in asdict(other).items() if v is not None}))
+
+    def __bool__(self) -> bool:
+        return any(value is not None for value in asdict(self).values())
+
+    def __str__(self) -> str:
+        return ', '.join(f'{k}={v}' for k, v in asdict(self).items() if v is not None) or 'default'
+
+
+@dataclass(frozen=True)
+class PerformanceProfile:
+    """
+    borg create settings tuned for a kind of source data.
+    Profiles are selected by name on an archive, and may be overridden in the repository settings.
+    """
+    chunker_params: Optional[str] = None
+    files_cache: Optional[str] = None
+    files_cache_ttl: Optional[int] = None
+    checkpoint_interval: Optional[int] = None
+
+    @property
+    def argv(self) -> list[str]:
+        argv = []
+        if self.chunker_params is not None:
+            argv += ['--chunker-params', self.chunker_params]
+        if self.files_cache is not None:
+            argv += ['--files-cache', self.files_cache]
+        if self.checkpoint_interval is not None:
+            argv += ['--checkpoint-interval', str(self.checkpoint_interval)]
+        return argv
+
+    @property
+    def environment(self) -> dict[str, str]:
+        return {} if self.files_cache_ttl is None else {'BORG_FILES_CACHE_TTL': str(self.files_cache_ttl)}
+
+    def __bool__(self) -> bool:
+        return any(value is not None for value in asdict(self).values())
+
+    def __str__(self) -> str:
+        return ', '.join(f'{k}={v}' for k, v in asdict(self).items() if v is not None) or 'default'
+
+
+PERFORMANCE_PROFILES = {
+    # Large files modified in place: fixed size chunks line up with the guest's blocks, and frequent checkpoints
+    # avoid re-sending hours of data after an interrupted run
+    'vm-images': PerformanceProfile(chunker_params='fixed,4194304', files_cache='ctime,size', checkpoint_interval=600),
+    # Millions of mostly unchanged files: keep files cache entries of paths which are not always present
+    # (e.g. excluded caches, mounted media) for longer, so they are not read and chunked again
+    'many-small-files': PerformanceProfile(files_cache='ctime,size,inode', files_cache_ttl=60),
+    # Dumps are rewritten on every run, so the files cache never matches and is not worth its memory.
+    # Smaller chunks deduplicate the unchanged rows between dumps better.
+    'database-dumps': PerformanceProfile(chunker_params='buzhash,14,20,17,4095', files_cache='disabled'),
+}
+
+
+def parse_rate(value: Union[None, bool, int, float, str]) -> Optional[int]:
+    """
+    Convert a bandwidth value to KiB/s, the unit used by borg.
+    Plain numbers are KiB/s. Strings may use bit (bit, kbit, Mbit, Mb, Mbps) or byte (B, K, M, MB, MiB) units,
+    per second. A lowercase b is bits and an uppercase B is bytes, as in 10Mbps and 10MB/s.
+    Returns None for unlimited (off, unlimited, 0).
+    """
+    if value is None or value is False or value == 0 or str(value).lower() in ('off', 'unlimited'):
+        return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return max(1, int(value))
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kKmMgG]?)(bit|b|i?B)?(?:/s|ps)?\s*', str(value))
+    if match is None:
+        raise ValueError(f'Invalid rate: {value}')
+    number, prefix, unit = match.groups()
+    prefix = prefix.lower()
+    if unit in ('bit', 'b'):
+        bytes_per_second = float(number) * {'': 1, 'k': 1e3, 'm': 1e6, 'g': 1e9}[prefix] / 8
+    elif not prefix and not unit:
+        bytes_per_second = float(number) * 1024
+    else:
+        bytes_per_second = float(number) * {'': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3}[prefix]
+    return max(1, int(bytes_per_second / 1024)) if bytes_per_second else None
+
+
+def parse_time_of_day(value: Union[int, str]) -> time:
+    # YAML 1.1 reads unquoted times such as 18:30 as base-60 integers (i.e. minutes past midnight)
+    if isinstance(value, int):
+        return time(value // 60 % 24, value % 60)
+    return time.fromisoformat(value)
+
+
+@dataclass(frozen=True)
+class RateWindow:
+    start: time
+    end: time
+    rate: Optional[int]
+
+    def contains(self, now: time) -> bool:
+        if self.start <= self.end:
+            return self.start <= now < self.end
+        return now >= self.start or now < self.end
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """
+    Upload bandwidth limit in KiB/s, optionally varying by time of day.
+    The first schedule window containing the current time applies, otherwise the default rate.
+    """
+    default: Optional[int] = None
+    schedule: tuple[RateWindow, ...] = ()
+
+    @classmethod
+    def from_yaml(cls, data: Union[None, bool, int, float, str, dict[str, Any]]) -> 'RateLimit':
+        if not isinstance(data, dict):
+            return cls(default=parse_rate(data))
+        schedule = tuple(
+            RateWindow(parse_time_of_day(x['start']), parse_time_of_day(x['end']), parse_rate(x.get('rate')))
+            for x in data.get('schedule', []))
+        return cls(default=parse_rate(data.get('default')), schedule=schedule)
+
+    def current(self, now: Optional[datetime] = None) -> Optional[int]:
+        time_of_day = (now or datetime.now()).time()
+        for window in self.schedule:
+            if window.contains(time_of_day):
+                return window.rate
+        return self.default
+
+    def __bool__(self) -> bool:
+        return self.default is not None or any(x.rate is not None for x in self.schedule)
+
+    def __str__(self) -> str:
+        def fmt(rate: Optional[int]) -> str:
+            return f'{rate} KiB/s' if rate is not None else 'unlimited'
+
+        windows = [f'{x.start:%H:%M}-{x.end:%H:%M} {fmt(x.rate)}' for x in self.schedule]
+        return ', '.join([*windows, f'otherwise {fmt(self.default)}' if windows else fmt(self.default)])
+
+
+@lru_cache(maxsize=None)
+def field_names(cls: type['DataclassInstance']) -> frozenset[str]:
+    return frozenset(x.name for x in fields(cls))
+
+
 @dataclass(frozen=True)
 class ConfigItem:
     name: str
@@ -74,7 +239,8 @@ class ConfigItem:
 
     @classmethod
     def from_dict(cls: type[DataclassT], obj: dict[str, Any]) -> DataclassT:
-        return cls(**{k: v for k, v in obj.items() if k in [x.name for x in fields(cls)]})
+        names = field_names(cls)
+        return cls(**{k: v for k, v in obj.items() if k in names})
 
     def to_dict(self: DataclassT) -> dict[str, Any]:
         return {f.name: getattr(self, f.name) for f in fields(self)}
@@ -88,6 +254,10 @@ class LocalRepository(ConfigItem):
     prune: PruneOptions = field(default_factory=PruneOptions)
     compact: bool = False
     rclone_upload_path: str = ''
+    upload_ratelimit: RateLimit = field(default_factory=RateLimit)
+    priority: PriorityOptions = field(default_factory=PriorityOptions)
+    profile: Optional[str] = None
+    compression: Optional[str] = None
 
     required_attributes = {'encryption', 'path'}
     is_remote = False
@@ -106,8 +276,13 @@ class RemoteRepository(ConfigItem):
     username: Optional[str] = None
     port: int = 22
     ssh_key: Optional[str] = None
+    ssh_multiplex: bool = True
     prune: PruneOptions = field(default_factory=PruneOptions)
     compact: bool = False
+    upload_ratelimit: RateLimit = field(default_factory=RateLimit)
+    priority: PriorityOptions = field(default_factory=PriorityOptions)
+    profile: Optional[str] = None
+    compression: Optional[str] = None
 
     required_attributes = {'encryption', 'hostname'}
     is_remote = True
@@ -131,28 +306,79 @@ class Archive(ConfigItem):
     exclude: list[str] = field(default_factory=list)
     one_file_system: bool = False
     compression: str = 'lz4'
+    priority: PriorityOptions = field(default_factory=PriorityOptions)
+    skip_if_unchanged: bool = False
+    fanout: Optional[str] = None
+    profile: Optional[str] = None
 
     required_attributes = {'repositories', 'paths'}
+    FANOUT_MODES = ('sync', 'transfer')
 
 
 @dataclass
 class Target:
+    """
+    A single archive:repository pair.
+    Everything derived from the configuration is computed once on creation, and no filesystem access is made
+    until a file is actually read or written.
+    """
+    __slots__ = (
+        'archive',
+        'repo',
+        'name',
+        'config_path',
+        'password_file',
+        'borg_repository_path',
+        'environment',
+        'priority',
+        'profile',
+        'compression',
+        'primary',
+    )
+
     archive: Archive
     repo: Union[LocalRepository, RemoteRepository]
 
-    @property
-    def name(self) -> str:
-        return f'{self.archive.name}:{self.repo.name}'
+    def __post_init__(self) -> None:
+        self.name = f'{self.archive.name}:{self.repo.name}'
+        self.config_path = CONFIG_PATH / self.name.replace(':', '_')
+        self.password_file = self.config_path / 'passwd'
+        self.priority = self.archive.priority.merge(self.repo.priority)
+        self.compression = self.repo.compression or self.archive.compression
+        self.profile = PERFORMANCE_PROFILES.get(self.repo.profile or self.archive.profile or '', PerformanceProfile())
+        self.primary: Optional[Target] = None
 
-    @property
-    def config_path(self) -> Path:
-        path = CONFIG_PATH / self.name.replace(':', '_')
-        path.mkdir(exist_ok=True)
-        return path
+        if self.repo.is_remote:
+            from urllib.parse import urlparse
+            url = urlparse(self.repo.url)
+            self.borg_repository_path = url._replace(path=os.path.join(url.path, self.archive.name)).geturl()
+        else:
+            self.borg_repository_path = str(PurePosixPath(self.repo.url) / self.archive.name)
 
-    @property
-    def password_file(self) -> Path:
-        return self.config_path / 'passwd'
+        self.environment = dict(
+            BORG_PASSCOMMAND=f'cat {self.password_file}',
+            BORG_RELOCATED_REPO_ACCESS_IS_OK='yes',
+            BORG_REPO=self.borg_repository_path,
+            **self.profile.environment,
+        )
+        if isinstance(self.repo, RemoteRepository):
+            from .ssh import ssh_argv
+            self.environment.update(BORG_RSH=' '.join(ssh_argv(self.repo)))
+
+    def replicate_from(self, primary: 'Target') -> None:
+        """
+        Fill this repository from the primary target of a fan-out archive, instead of running `borg create` on it.
+        A synced repository is a copy of the primary and shares its passphrase; a transfer destination is a separate
+        repository which needs the primary's passphrase to read from it.
+        """
+        self.primary = primary
+        if self.archive.fanout == 'sync':
+            self.password_file = primary.password_file
+            self.environment.update(BORG_PASSCOMMAND=primary.environment['BORG_PASSCOMMAND'])
+        else:
+            self.environment.update(BORG_OTHER_PASSCOMMAND=primary.environment['BORG_PASSCOMMAND'])
+            if 'BORG_RSH' in primary.environment:
+                self.environment.setdefault('BORG_RSH', primary.environment['BORG_RSH'])
 
     @property
     def keyfile(self) -> Path:
@@ -166,41 +392,101 @@ class Target:
     def initialised(self) -> bool:
         return (self.config_path / '.initialised').exists()
 
-    @property
-    def borg_repository_path(self) -> str:
-        if self.repo.is_remote:
-            url = urlparse(self.repo.url)
-            return url._replace(path=os.path.join(url.path, self.archive.name)).geturl()
-        else:
-            return str(PurePosixPath(self.repo.url) / self.archive.name)
-
-    @property
-    def environment(self) -> dict[str, str]:
-        env = dict(
-            BORG_PASSCOMMAND=f'cat {self.password_file}',
-            BORG_RELOCATED_REPO_ACCESS_IS_OK='yes',
-            BORG_REPO=self.borg_repository_path,
-        )
-        if self.repo.is_remote:
-            borg_rsh = 'ssh -o VisualHostKey=no'
-
-            ssh_key = getattr(self.repo, 'ssh_key', None)
-            if ssh_key:
-                borg_rsh += f' -i {ssh_key}'
-            env.update(BORG_RSH=borg_rsh)
-        return env
-
     def create_password_file(self, contents: Optional[str] = None) -> None:
-        passwd = self.config_path / 'passwd'
-        if not passwd.exists():
-            passwd.write_text(contents or token_hex(32))
-            logger.info(f'Created passphrase file: {passwd}')
+        if not self.password_file.exists():
+            from secrets import token_hex
+            self.config_path.mkdir(parents=True, exist_ok=True)
+            self.password_file.write_text(contents or token_hex(32))
+            logger.info(f'Created passphrase file: {self.password_file}')
 
     def to_dict(self) -> dict[str, Any]:
         return {'archive': self.archive.to_dict(), 'repo': self.repo.to_dict()}
 
 
+class TargetIndex:
+    """
+    All configured targets, with hash lookups by archive name, repository name and archive:repository pair
+    """
+    __slots__ = ('targets', 'by_archive', 'by_repo', 'by_pair')
+
+    def __init__(self, targets: list[Target]) -> None:
+        self.targets = targets
+        self.by_archive: dict[str, list[Target]] = {}
+        self.by_repo: dict[str, list[Target]] = {}
+        self.by_pair: dict[tuple[str, str], Target] = {}
+        for target in targets:
+            self.by_archive.setdefault(target.archive.name, []).append(target)
+            self.by_repo.setdefault(target.repo.name, []).append(target)
+            self.by_pair[(target.archive.name, target.repo.name)] = target
+
+    def select(self, sync_target: TargetTuple = None) -> list[Target]:
+        """
+        Targets matching an (archive, repo) selector, where an empty name matches everything
+        """
+        if sync_target is None:
+            return self.targets
+        archive, repo = sync_target
+        if archive and repo:
+            target = self.by_pair.get((archive, repo))
+            return [target] if target is not None else []
+        if archive:
+            return self.by_archive.get(archive, [])
+        if repo:
+            return self.by_repo.get(repo, [])
+        return self.targets
+
+
+def validate_priority(name: str, data: dict[str, Any]) -> set[str]:
+    errors = set()
+    try:
+        priority = PriorityOptions.from_yaml(data)
+    except TypeError:
+        return {f'Invalid priority options for "{name}": {data}'}
+    if priority.nice is not None and not -20 <= priority.nice <= 19:
+        errors.add(f'Invalid nice level for "{name}": {priority.nice}. Must be between -20 and 19')
+    if priority.ionice_class is not None and priority.ionice_class not in PriorityOptions.IONICE_CLASSES:
+        errors.add(
+            f'Invalid ionice_class for "{name}": {priority.ionice_class}. '
+            f'Must be one of {list(PriorityOptions.IONICE_CLASSES)}')
+    if priority.ionice_level is not None and not 0 <= priority.ionice_level <= 7:
+        errors.add(f'Invalid ionice_level for "{name}": {priority.ionice_level}. Must be between 0 and 7')
+    if priority.cpu_affinity is not None and not all(isinstance(x, int) and x >= 0 for x in priority.cpu_affinity):
+        errors.add(f'Invalid cpu_affinity for "{name}": {priority.cpu_affinity}. Must be a list of CPU numbers')
+    return errors
+
+
+def validate_profile(name: str, profile: Optional[str]) -> set[str]:
+    if profile is None or profile in PERFORMANCE_PROFILES:
+        return set()
+    return {f'Invalid profile for "{name}": {profile}. Must be one of {list(PERFORMANCE_PROFILES)}'}
+
+
+def validate_options(name: str, item: dict[str, Any]) -> set[str]:
+    """
+    Validate the option values which may be set on a repository, or overridden per archive
+    """
+    errors = set()
+    try:
+        RateLimit.from_yaml(item.get('upload_ratelimit'))
+    except (ValueError, TypeError, KeyError) as ex:
+        errors.add(f'Invalid upload_ratelimit for "{name}": {ex}')
+    if item.get('priority') is not None:
+        errors |= validate_priority(name, item['priority'])
+    errors |= validate_profile(name, item.get('profile'))
+    prune_opts = item.get('prune', [])
+    try:
+        PruneOptions.from_yaml(prune_opts)
+    except TypeError:
+        errors.add(f'Invalid prune options: {prune_opts}')
+    return errors
+
+
 def validate_config(data: dict[str, Any]) -> None:
+    """
+    Validate the configuration in a single pass over all repositories and archives.
+    Once the semantic checks pass, the structure is also validated against config-schema.json.
+    """
+    from .schema import schema_errors
 
     errors = set()
 
@@ -209,60 +495,69 @@ def validate_config(data: dict[str, Any]) -> None:
     if missing_keys:
         errors.add(f'Missing required keys: {missing_keys}')
 
-    repository_types = data.get('repositories', {}).keys()
-    invalid_repo_types = set(repository_types) - {'local', 'remote'}
+    repositories = data.get('repositories') or {}
+    invalid_repo_types = set(repositories) - {'local', 'remote'}
     if invalid_repo_types:
         errors.add(f'Invalid repository types: {invalid_repo_types}')
 
-    local_repositories = data.get('repositories', {}).get('local', {})
-    remote_repositories = data.get('repositories', {}).get('remote', {})
-    repo_names = [*local_repositories.keys(), *remote_repositories.keys()]
-    archives = data.get('archives', {})
+    repo_names: set[str] = set()
+    repository_types = (
+        (repositories.get('local') or {}, LocalRepository),
+        (repositories.get('remote') or {}, RemoteRepository),
+    )
+    for repository_items, repository_type in repository_types:
+        for name, repository in repository_items.items():
+            repository = repository or {}
+
+            # Check for duplicate local/remote repository names
+            if name in repo_names:
+                errors.add(f'Duplicate repository name: {name}')
+            repo_names.add(name)
+
+            for attribute in repository_type.required_attributes:
+                if repository.get(attribute) is None:
+                    errors.add(f'Repository "{name}" is missing attribute "{attribute}"')
+
+            rclone_upload_path = repository.get('rclone_upload_path')
+            if rclone_upload_path and rclone_upload_path.count(':') != 1:
+                errors.add(f'Invalid rclone_upload_path "{rclone_upload_path}". Path must contain a single colon')
+
+            errors |= validate_options(name, repository)
 
     if not repo_names:
         errors.add('No repositories were defined')
 
-    # Check required attributes for local repository
-    for name, repository in local_repositories.items():
-        for attribute in LocalRepository.required_attributes:
-            if repository.get(attribute) is None:
-                errors.add(f'Repository "{name}" is missing attribute "{attribute}"')
-
-    # Check required attributes for remote repository
-    for name, repository in remote_repositories.items():
-        for attribute in RemoteRepository.required_attributes:
-            if repository.get(attribute) is None:
-                errors.add(f'Repository "{name}" is missing attribute "{attribute}"')
-
-    # Check for duplicate local/remote repository names
-    repository_duplicates = set(item for item in repo_names if repo_names.count(item) > 1)
-    if repository_duplicates:
-        errors |= set(f'Duplicate repository name: {name}' for name in repository_duplicates)
-
-    # Validate repository upload_path strings
-    for name, repository in local_repositories.items():
-        rclone_upload_path = repository.get('rclone_upload_path')
-        if rclone_upload_path:
-            if rclone_upload_path.count(':') != 1:
-                errors.add(f'Invalid rclone_upload_path "{rclone_upload_path}". Path must contain a single colon')
+    for name, archive in (data.get('archives') or {}).items():
+        archive = archive or {}
 
-    for name, archive in archives.items():
-        # Check required attributes for archive
         for attribute in Archive.required_attributes:
             if archive.get(attribute) is None:
                 errors.add(f'Archive "{name}" is missing attribute "{attribute}"')
 
+        if archive.get('priority') is not None:
+            errors |= validate_priority(name, archive['priority'])
+        errors |= validate_profile(name, archive.get('profile'))
+
         # Make sure all repository references are valid
-        for archive_repository in archive.get('repositories', []):
+        archive_repositories = archive.get('repositories') or []
+        for archive_repository in archive_repositories:
             if archive_repository not in repo_names:
                 errors.add(f'Invalid repository reference: {archive_repository}')
 
-    # Validate Prune Options
-    for prune_opts in (x.get('prune', []) for x in local_repositories.values()):
-        try:
-            PruneOptions.from_yaml(prune_opts)
-        except TypeError:
-            errors.add(f'Invalid prune options: {prune_opts}')
+        if isinstance(archive_repositories, dict):
+            for repo, overrides in archive_repositories.items():
+                errors |= validate_options(f'{name}:{repo}', overrides or {})
+
+        fanout = archive.get('fanout')
+        if fanout is not None and fanout not in Archive.FANOUT_MODES:
+            errors.add(f'Invalid fanout for "{name}": {fanout}. Must be one of {list(Archive.FANOUT_MODES)}')
+        elif fanout == 'sync' and archive_repositories:
+            primary = next(iter(archive_repositories))
+            if primary in (repositories.get('remote') or {}):
+                errors.add(f'Archive "{name}" uses fanout: sync, its first repository "{primary}" must be local')
+
+    if not errors:
+        errors = schema_errors(data)
 
     if errors:
         err = ConfigValidationError(errors)
@@ -270,19 +565,147 @@ def validate_config(data: dict[str, Any]) -> None:
         raise err
 
 
-def parse_config(file: Path) -> list[Target]:
-    yaml_data = yaml.safe_load(file.read_text())
+def select_config(data: dict[str, Any], sync_target: TargetTuple) -> Optional[dict[str, Any]]:
+    """
+    Reduce the configuration data to the archives matching an (archive, repo) selector and the repositories
+    they reference, so only the selected entries are validated and materialised.
+    Returns None when nothing matches.
+    Data which can not be reduced is returned unchanged, to be reported by validation.
+    """
+    archive_name, repo_name = sync_target or ('', '')
+    archives = data.get('archives')
+    repositories = data.get('repositories')
+    if not (archive_name or repo_name) or not isinstance(archives, dict) or not isinstance(repositories, dict):
+        return data
+
+    selected = archives
+    if archive_name:
+        selected = {archive_name: archives[archive_name]} if archive_name in archives else {}
+    if repo_name:
+        selected = {
+            name: archive
+            for name, archive in selected.items()
+            if isinstance(archive, dict) and repo_name in (archive.get('repositories') or [])
+        }
+    if not selected:
+        return None
+
+    referenced = set()
+    for archive in selected.values():
+        archive_repositories = (archive or {}).get('repositories')
+        if isinstance(archive_repositories, (list, dict)):
+            referenced.update(x for x in archive_repositories if isinstance(x, str))
+
+    if not referenced:
+        # Broken archive entries, leave the repositories for validation to report on
+        return {**data, 'archives': selected}
+
+    selected_repositories = {
+        repository_type: {name: items[name] for name in referenced if name in items}
+        if isinstance(items, dict) else items
+        for repository_type, items in repositories.items()
+    }
+    return {**data, 'repositories': selected_repositories, 'archives': selected}
+
+
+def _mapping_value(node: Any, key: str) -> Optional[Any]:
+    """
+    Value node of a key in a YAML mapping node, or None
+    """
+    import yaml
+    if not isinstance(node, yaml.MappingNode):
+        return None
+    return next((value for key_node, value in node.value if key_node.value == key), None)
+
+
+def _replace_mapping(node: Any, keep: Callable[[str], bool], replace: Callable[[str, Any], Any]) -> Any:
+    """
+    Copy of a YAML mapping node with only the keys for which keep() is true, and each value node passed through
+    replace(). Merge keys are always kept unchanged.
+    """
+    import yaml
+    if not isinstance(node, yaml.MappingNode):
+        return node
+    value = [
+        (k, v if k.tag == 'tag:yaml.org,2002:merge' else replace(k.value, v))
+        for k, v in node.value
+        if k.tag == 'tag:yaml.org,2002:merge' or keep(k.value)
+    ]
+    return yaml.MappingNode(node.tag, value, node.start_mark, node.end_mark, node.flow_style)
+
+
+def load_config_text(text: str, sync_target: TargetTuple = None) -> Any:
+    """
+    Load the configuration data, constructing only the archives matching sync_target and the repositories they
+    reference. The document is composed into YAML nodes first, by libyaml when available, and the nodes which were
+    not selected are dropped before any Python objects are built for them.
+    """
+    import yaml
+
+    # The libyaml based loader is much faster, when available
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)(text)
+    try:
+        node = loader.get_single_node()
+        if node is None:
+            return None
+        archive_name, repo_name = sync_target or ('', '')
+        archives = _mapping_value(node, 'archives')
+        if not (archive_name or repo_name) or archives is None or _mapping_value(node, 'repositories') is None:
+            return loader.construct_document(node)
+
+        if archive_name:
+            archives = _replace_mapping(archives, lambda name: name == archive_name, lambda name, value: value)
+        constructed = {'archives': loader.construct_object(archives, deep=True), 'repositories': {}}
+        selected = select_config(constructed, sync_target) or {}
+        referenced: set[str] = set()
+        for archive in selected.get('archives', {}).values():
+            archive_repositories = archive.get('repositories') if isinstance(archive, dict) else None
+            if isinstance(archive_repositories, (list, dict)):
+                referenced.update(x for x in archive_repositories if isinstance(x, str))
+
+        def reduce(key: str, value: Any) -> Any:
+            if key == 'archives':
+                return archives
+            if key == 'repositories' and referenced:
+                return _replace_mapping(
+                    value,
+                    lambda repository_type: True,
+                    lambda repository_type, items: _replace_mapping(items, referenced.__contains__, lambda k, v: v),
+                )
+            return value
+
+        return loader.construct_document(_replace_mapping(node, lambda key: True, reduce))
+    finally:
+        loader.dispose()
+
+
+def parse_config(file: Path, sync_target: TargetTuple = None) -> list[Target]:
+    return parse_config_text(file.read_text(), sync_target)
+
+
+def parse_config_text(text: str, sync_target: TargetTuple = None) -> list[Target]:
+    """
+    Parse and validate the configuration, building targets only for the archives matching sync_target.
+    Targets of the selected archives are not filtered by repository, use TargetIndex.select for that.
+    """
+    yaml_data = select_config(load_config_text(text, sync_target), sync_target)
+    if yaml_data is None:
+        return []
     validate_config(yaml_data)
 
     repositories: dict[str, Union[LocalRepository, RemoteRepository]] = {}
 
     for name, repo in yaml_data['repositories'].get('local', {}).items():
         repo['prune'] = PruneOptions.from_yaml(repo.get('prune', []))
+        repo['priority'] = PriorityOptions.from_yaml(repo.get('priority'))
+        repo['upload_ratelimit'] = RateLimit.from_yaml(repo.get('upload_ratelimit'))
         local_repository: LocalRepository = LocalRepository.from_dict({'name': name, **repo})
         repositories[name] = local_repository
 
     for name, repo in yaml_data['repositories'].get('remote', {}).items():
         repo['prune'] = PruneOptions.from_yaml(repo.get('prune', []))
+        repo['priority'] = PriorityOptions.from_yaml(repo.get('priority'))
+        repo['upload_ratelimit'] = RateLimit.from_yaml(repo.get('upload_ratelimit'))
         remote_repository: RemoteRepository = RemoteRepository.from_dict({'name': name, **repo})
         repositories[name] = remote_repository
 
@@ -300,22 +723,103 @@ def parse_config(file: Path) -> list[Target]:
         for archive_repository, overrides in repository_list.items():
             if 'prune' in overrides:
                 overrides['prune'] = PruneOptions.from_yaml(overrides['prune'])
+            if 'priority' in overrides:
+                overrides['priority'] = PriorityOptions.from_yaml(overrides['priority'])
+            if 'upload_ratelimit' in overrides:
+                overrides['upload_ratelimit'] = RateLimit.from_yaml(overrides['upload_ratelimit'])
             repo = repositories[archive_repository]
             repo = type(repo).from_dict(dict(repo.to_dict(), **overrides))
             target_repos.append(repo)
 
+        archive_data['priority'] = PriorityOptions.from_yaml(archive_data.get('priority'))
         archive = Archive.from_dict({'name': name, **archive_data})
-        targets += [Target(archive=archive, repo=repo) for repo in target_repos]
+        archive_targets = [Target(archive=archive, repo=repo) for repo in target_repos]
+        if archive.fanout:
+            # The first repository receives the archive, the others are replicated from it
+            for target in archive_targets[1:]:
+                target.replicate_from(archive_targets[0])
+        targets += archive_targets
 
     return targets
 
 
-def read_config(file: Path) -> list[Target]:
+def config_cache_file(file: Path, sync_target: TargetTuple = None) -> Path:
+    """
+    Cache of the full target index of a configuration file, or of the partial index for a selector
+    """
+    from hashlib import sha256
+    name = str(file.resolve())
+    if sync_target is not None and any(sync_target):
+        name += '\0' + ':'.join(sync_target)
+    return CONFIG_CACHE_PATH / f'config-{sha256(name.encode()).hexdigest()[:16]}.pickle'
+
+
+def config_cache_key(content: bytes) -> str:
+    """
+    Cached targets are only valid for the same configuration file contents, borg-drone version and the directories
+    their paths and environment were derived from
+    """
+    from hashlib import sha256
+    from .ssh import CONTROL_DIR
+    salt = [__version__, str(CONFIG_PATH), str(CONTROL_DIR)]
+    return sha256(b'\0'.join([*(x.encode() for x in salt), content])).hexdigest()
+
+
+def read_config_cache(file: Path, key: str, sync_target: TargetTuple = None) -> Optional[TargetIndex]:
+    import pickle
+    try:
+        with config_cache_file(file, sync_target).open('rb') as f:
+            cached_key, index = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        logger.debug(f'Ignoring unreadable configuration cache: {ex}')
+        return None
+    if cached_key != key:
+        return None
+    return cast(TargetIndex, index)
+
+
+def write_config_cache(file: Path, key: str, index: TargetIndex, sync_target: TargetTuple = None) -> None:
+    import pickle
+    from .util import atomic_write_bytes
     try:
-        return parse_config(file)
+        atomic_write_bytes(config_cache_file(file, sync_target), pickle.dumps((key, index), pickle.HIGHEST_PROTOCOL))
+    except OSError as ex:
+        logger.debug(f'Unable to write configuration cache: {ex}')
+
+
+def read_index(file: Path, sync_target: TargetTuple = None) -> TargetIndex:
+    """
+    Read targets from the configuration file.
+    The target index is cached, so YAML parsing and validation only happen when the file has changed.
+    Without a cached full index, a selective sync_target only constructs and validates the matching archives,
+    and the resulting partial index is cached separately for that selector.
+    """
+    try:
+        content = file.read_bytes()
     except FileNotFoundError:
         if file == DEFAULT_CONFIG_FILE:
+            file.parent.mkdir(parents=True, exist_ok=True)
             file.write_text((Path(__file__).parent / 'example.yml').read_text())
-            return read_config(file)
+            return read_index(file, sync_target)
         else:
             raise ConfigValidationError([f'No such file: {file}'])
+
+    key = config_cache_key(content)
+    index = read_config_cache(file, key)
+    if index is not None:
+        return index
+    if sync_target is not None and any(sync_target):
+        index = read_config_cache(file, key, sync_target)
+        if index is None:
+            index = TargetIndex(parse_config_text(content.decode(), sync_target))
+            write_config_cache(file, key, index, sync_target)
+        return index
+    index = TargetIndex(parse_config_text(content.decode()))
+    write_config_cache(file, key, index)
+    return index
+
+
+def read_config(file: Path) -> list[Target]:
+    return read_index(file).targets
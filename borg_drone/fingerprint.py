@@ -0,0 +1,152 @@
+import hashlib
+import os
+import re
+import stat
+import time
+from dataclasses import dataclass, replace
+from fnmatch import fnmatchcase
+from logging import getLogger
+from pathlib import Path
+from typing import Callable, Optional
+
+from .config import Archive, Target
+from .util import atomic_write_text
+
+logger = getLogger(__package__)
+
+# Walks which would visit more entries than this give up, and the archive is always created
+ENTRY_LIMIT = 1_000_000
+
+Matcher = Callable[[str], bool]
+
+
+@dataclass(frozen=True)
+class Fingerprint:
+    digest: str
+    entries: int
+    duration: float
+
+
+def pattern_matcher(pattern: str) -> Optional[Matcher]:
+    """
+    Matcher for a borg exclude pattern, applied to paths without a leading slash as borg does.
+    Returns None for pattern styles which are not understood, so those paths are still part of the fingerprint.
+    Matching fewer paths than borg only causes unnecessary creates, never a skipped change.
+    """
+    style, _, value = pattern.partition(':')
+    if len(style) != 2 or not value:
+        style, value = 'fm', pattern
+    if style == 'fm':
+        value = value.lstrip('/')
+        return lambda path: fnmatchcase(path, value) or fnmatchcase(path, value.rstrip('/') + '/*')
+    if style == 'pp':
+        value = os.path.normpath(value).lstrip('/')
+        return lambda path: path == value or path.startswith(value + '/')
+    if style == 'pf':
+        value = os.path.normpath(value).lstrip('/')
+        return lambda path: path == value
+    if style == 're':
+        regex = re.compile(value)
+        return lambda path: regex.search(path) is not None
+    return None
+
+
+def exclude_matcher(patterns: list[str]) -> Matcher:
+    matchers = []
+    for pattern in patterns:
+        matcher = pattern_matcher(pattern)
+        if matcher is None:
+            logger.debug(f'Exclude pattern "{pattern}" is not applied to the change fingerprint')
+        else:
+            matchers.append(matcher)
+    return lambda path: any(matcher(path) for matcher in matchers)
+
+
+def source_fingerprint(archive: Archive, limit: int = ENTRY_LIMIT) -> Optional[Fingerprint]:
+    """
+    Digest of the type, inode, size, mode, mtime and ctime of every file and directory below the archive's paths,
+    together with the options which affect what borg would read. Settings of the repositories are added by
+    target_fingerprint, so the walk is shared by all targets of the archive.
+    Returns None if there are more than `limit` entries.
+    """
+    started = time.monotonic()
+    excluded = exclude_matcher(archive.exclude)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(repr((archive.paths, archive.exclude, archive.one_file_system)).encode())
+    entries = 0
+
+    def add(path: str, st: os.stat_result) -> None:
+        line = f'{path}\0{st.st_mode}\0{st.st_ino}\0{st.st_size}\0{st.st_mtime_ns}\0{st.st_ctime_ns}\n'
+        digest.update(line.encode(errors='surrogateescape'))
+
+    for root in map(os.path.expanduser, archive.paths):
+        try:
+            root_stat = os.lstat(root)
+        except OSError as ex:
+            digest.update(f'{root}\0{ex.errno}\n'.encode(errors='surrogateescape'))
+            continue
+        add(root, root_stat)
+        if not stat.S_ISDIR(root_stat.st_mode):
+            continue
+
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            try:
+                with os.scandir(directory) as it:
+                    children = sorted(it, key=lambda entry: entry.name)
+            except OSError as ex:
+                digest.update(f'{directory}\0{ex.errno}\n'.encode(errors='surrogateescape'))
+                continue
+            for entry in children:
+                if excluded(entry.path.lstrip('/')):
+                    continue
+                entries += 1
+                if entries > limit:
+                    logger.info(f'More than {limit} entries in {", ".join(archive.paths)}, not fingerprinting')
+                    return None
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError as ex:
+                    digest.update(f'{entry.path}\0{ex.errno}\n'.encode(errors='surrogateescape'))
+                    continue
+                add(entry.path, st)
+                if stat.S_ISDIR(st.st_mode) and not (archive.one_file_system and st.st_dev != root_stat.st_dev):
+                    stack.append(entry.path)
+
+    return Fingerprint(digest.hexdigest(), entries, time.monotonic() - started)
+
+
+def target_fingerprint(target: Target, fingerprint: Fingerprint) -> Fingerprint:
+    """
+    Fingerprint of the sources combined with the settings `borg create` uses for the target, so a change of its
+    compression or performance profile (e.g. by tune --write) is not skipped
+    """
+    digest = hashlib.blake2b(fingerprint.digest.encode(), digest_size=20)
+    digest.update(repr((target.compression, target.profile)).encode())
+    return replace(fingerprint, digest=digest.hexdigest())
+
+
+def fingerprint_file(target: Target) -> Path:
+    return target.config_path / 'fingerprint'
+
+
+def read_fingerprint(target: Target) -> Optional[str]:
+    """
+    Fingerprint of the sources at the start of the last successful run of the target
+    """
+    try:
+        return fingerprint_file(target).read_text().strip() or None
+    except OSError:
+        return None
+
+
+def write_fingerprint(target: Target, digest: str) -> None:
+    try:
+        atomic_write_text(fingerprint_file(target), digest + '\n')
+    except OSError as ex:
+        logger.warning(f'Unable to save the source fingerprint of {target.name}: {ex}')
+
+
+def forget_fingerprint(target: Target) -> None:
+    fingerprint_file(target).unlink(missing_ok=True)
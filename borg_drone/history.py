@@ -0,0 +1,172 @@
+import sqlite3
+import statistics
+import time
+from collections.abc import Iterable
+from contextlib import closing
+from dataclasses import dataclass
+from logging import getLogger
+from pathlib import Path
+from typing import Optional
+
+from .config import CONFIG_PATH
+from .progress import ArchiveStats
+from .scheduler import StageResult
+from .types import TargetTuple
+
+logger = getLogger(__package__)
+
+HISTORY_FILE = CONFIG_PATH / 'history.sqlite3'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    command TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stages (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    target TEXT NOT NULL,
+    archive TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL NOT NULL,
+    original_size INTEGER,
+    compressed_size INTEGER,
+    deduplicated_size INTEGER,
+    nfiles INTEGER,
+    exit_code INTEGER NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS stages_stage_started ON stages(stage, started);
+CREATE INDEX IF NOT EXISTS stages_target_stage_started ON stages(target, stage, started);
+'''
+
+
+def connect(file: Optional[Path] = None) -> sqlite3.Connection:
+    file = file or HISTORY_FILE
+    file.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(file, timeout=30)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def record_results(command: str, results: list[StageResult], file: Optional[Path] = None) -> None:
+    """
+    Record the results of a command in a single transaction once it has finished, so the history
+    never adds latency to the commands themselves. Failures are logged rather than raised.
+    """
+    if not results:
+        return
+    rows = []
+    for r in results:
+        stats = r.result if isinstance(r.result, ArchiveStats) else None
+        rows.append((
+            r.target.name,
+            r.target.archive.name,
+            r.target.repo.name,
+            r.stage,
+            r.started,
+            r.finished,
+            stats and stats.original_size,
+            stats and stats.compressed_size,
+            stats and stats.deduplicated_size,
+            stats and stats.nfiles,
+            r.exit_code,
+            None if r.error is None else str(r.error),
+        ))
+    try:
+        with closing(connect(file)) as connection, connection:
+            started = min(r.started for r in results)
+            finished = max(r.finished for r in results)
+            cursor = connection.execute(
+                'INSERT INTO runs (command, started, finished) VALUES (?, ?, ?)', (command, started, finished))
+            connection.executemany(
+                'INSERT INTO stages (run_id, target, archive, repo, stage, started, finished, original_size, '
+                'compressed_size, deduplicated_size, nfiles, exit_code, error) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [(cursor.lastrowid, *row) for row in rows],
+            )
+    except sqlite3.Error as ex:
+        logger.warning(f'Unable to record history: {ex}')
+
+
+@dataclass(frozen=True)
+class TargetStats:
+    """
+    Trends of the `borg create` stage of a single target over a period of time.
+    The deduplication ratio is the deduplicated size as a fraction of the original size, and its drift is the
+    change in the mean ratio between the first and second half of the period.
+    """
+    target: str
+    runs: int
+    failures: int
+    median_duration: Optional[float]
+    max_duration: Optional[float]
+    dedup_ratio: Optional[float]
+    dedup_drift: Optional[float]
+    last_success: Optional[float]
+
+
+def mean(values: Iterable[float]) -> Optional[float]:
+    values = list(values)
+    return statistics.fmean(values) if values else None
+
+
+def target_stats(
+    days: int = 30,
+    sync_target: TargetTuple = None,
+    file: Optional[Path] = None,
+    now: Optional[float] = None,
+) -> list[TargetStats]:
+    """
+    Statistics of each target matching sync_target over the last `days` days, slowest first
+    """
+    now = time.time() if now is None else now
+    since = now - days * 86400
+    midpoint = now - days * 86400 / 2
+    query = (
+        'SELECT target, started, finished - started, original_size, deduplicated_size, exit_code '
+        'FROM stages WHERE stage = ? AND started >= ?')
+    params: list[object] = ['create', since]
+    archive, repo = sync_target or ('', '')
+    if archive and repo:
+        query += ' AND target = ?'
+        params.append(f'{archive}:{repo}')
+    elif archive:
+        query += ' AND archive = ?'
+        params.append(archive)
+    elif repo:
+        query += ' AND repo = ?'
+        params.append(repo)
+
+    rows: dict[str, list[tuple[float, float, Optional[int], Optional[int], int]]] = {}
+    connection = connect(file)
+    try:
+        for target, *row in connection.execute(query + ' ORDER BY started', params):
+            rows.setdefault(target, []).append(tuple(row))  # type: ignore[arg-type]
+    finally:
+        connection.close()
+
+    results = []
+    for target, target_rows in rows.items():
+        succeeded = [row for row in target_rows if row[4] == 0]
+        durations = [row[1] for row in succeeded]
+        ratios = [(row[0], row[3] / row[2]) for row in succeeded if row[2] and row[3] is not None]
+        earlier = mean(ratio for started, ratio in ratios if started < midpoint)
+        recent = mean(ratio for started, ratio in ratios if started >= midpoint)
+        results.append(
+            TargetStats(
+                target=target,
+                runs=len(target_rows),
+                failures=len(target_rows) - len(succeeded),
+                median_duration=statistics.median(durations) if durations else None,
+                max_duration=max(durations) if durations else None,
+                dedup_ratio=mean(ratio for _, ratio in ratios),
+                dedup_drift=recent - earlier if recent is not None and earlier is not None else None,
+                last_success=max(row[0] + row[1] for row in succeeded) if succeeded else None,
+            ))
+    return sorted(results, key=lambda x: -(x.median_duration or 0))
@@ -0,0 +1,106 @@
+import logging
+import shutil
+import sys
+from contextvars import ContextVar
+from typing import Optional, TextIO
+
+logger = logging.getLogger(__package__)
+
+# Prefix prepended to log messages, used to tell apart the output of targets running concurrently
+log_prefix: ContextVar[str] = ContextVar('log_prefix', default='')
+
+
+class Colour:
+    RESET = '\x1b[0m'
+    GREY = '\x1b[38;20m'
+    DARK_GREY = '\x1b[90;20m'
+    YELLOW = '\x1b[33;20m'
+    RED = '\x1b[31;20m'
+    BOLD_RED = '\x1b[31;1m'
+    GREEN = '\x1b[32;20m'
+
+
+class ColourLogFormatter(logging.Formatter):
+    datefmt = '%Y-%m-%d %H:%M:%S'
+    fmt = '%(asctime)s │ %(levelname)s │ %(message)s'
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.formatters = {
+            logging.DEBUG: self.mkformat(Colour.DARK_GREY),
+            logging.INFO: self.mkformat(Colour.GREY),
+            logging.WARNING: self.mkformat(Colour.YELLOW),
+            logging.ERROR: self.mkformat(Colour.RED),
+            logging.CRITICAL: self.mkformat(Colour.BOLD_RED),
+        }
+
+    @classmethod
+    def mkformat(cls, colour: str) -> logging.Formatter:
+        asctime = f'{colour}%(asctime)s{Colour.RESET}'
+        levelname = f'{colour}%(levelname)-7s{Colour.RESET}'
+        message = f'{colour}%(prefix)s%(message)s{Colour.RESET}'
+        return logging.Formatter(cls.fmt % locals(), datefmt=cls.datefmt)
+
+    def format(self, record: logging.LogRecord) -> str:
+        record.prefix = log_prefix.get()
+        return self.formatters[record.levelno].format(record)
+
+
+class StatusLine:
+    """
+    A single line of live status, kept below the log output of interactive sessions
+    """
+    CLEAR = '\r\x1b[K'
+
+    def __init__(self, stream: Optional[TextIO] = None) -> None:
+        self._stream = stream
+        self.text = ''
+
+    @property
+    def stream(self) -> TextIO:
+        return self._stream or sys.stderr
+
+    @property
+    def enabled(self) -> bool:
+        return self.stream.isatty()
+
+    def update(self, text: str) -> None:
+        if self.enabled:
+            self.text = text[:shutil.get_terminal_size().columns - 1]
+            self.redraw()
+
+    def redraw(self) -> None:
+        if self.text:
+            self.stream.write(self.CLEAR + self.text)
+            self.stream.flush()
+
+    def clear(self) -> None:
+        if self.text:
+            self.stream.write(self.CLEAR)
+            self.stream.flush()
+            self.text = ''
+
+
+status_line = StatusLine()
+
+
+class StatusLineHandler(logging.StreamHandler):  # type: ignore[type-arg]
+    """
+    Moves the status line out of the way of each log message
+    """
+
+    def emit(self, record: logging.LogRecord) -> None:
+        text = status_line.text
+        status_line.clear()
+        super().emit(record)
+        status_line.text = text
+        status_line.redraw()
+
+
+def setup_logging(debug: bool = False) -> None:
+    level = logging.DEBUG if debug else logging.INFO
+    logger.setLevel(level)
+    ch = StatusLineHandler()
+    ch.setLevel(level)
+    ch.setFormatter(ColourLogFormatter())
+    logger.addHandler(ch)
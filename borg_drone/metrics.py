@@ -0,0 +1,131 @@
+import re
+from logging import getLogger
+from pathlib import Path
+from typing import Optional
+
+from .config import Target
+from .progress import ArchiveStats
+from .scheduler import StageResult
+from .util import atomic_write_text
+
+logger = getLogger(__package__)
+
+# All metrics are gauges, written in this order
+METRICS = {
+    'borg_drone_start_timestamp_seconds': 'Time the last run of the target started',
+    'borg_drone_end_timestamp_seconds': 'Time the last run of the target finished',
+    'borg_drone_stage_duration_seconds': 'Duration of each stage in the last run of the target',
+    'borg_drone_original_bytes': 'Original size of the last archive',
+    'borg_drone_compressed_bytes': 'Compressed size of the last archive',
+    'borg_drone_deduplicated_bytes': 'Deduplicated size of the last archive',
+    'borg_drone_files': 'Number of files processed in the last archive',
+    'borg_drone_exit_status': 'Exit status of the last run of the target, 0 on success',
+    'borg_drone_last_success_timestamp_seconds': 'Time the target last completed all stages successfully',
+}
+
+SAMPLE_PATTERN = re.compile(r'^(\w+)\{(.*)\} (\S+)$')
+LABEL_PATTERN = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+Labels = tuple[tuple[str, str], ...]
+Sample = tuple[str, Labels, float]
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def unescape(value: str) -> str:
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), value)
+
+
+def format_sample(sample: Sample) -> str:
+    name, labels, value = sample
+    label_text = ','.join(f'{k}="{escape(v)}"' for k, v in labels)
+    value_text = str(int(value)) if float(value).is_integer() else repr(float(value))
+    return f'{name}{{{label_text}}} {value_text}'
+
+
+def read_samples(file: Path) -> list[Sample]:
+    """
+    Read the samples of a metrics file written by a previous run
+    """
+    try:
+        text = file.read_text()
+    except OSError:
+        return []
+    samples = []
+    for line in text.splitlines():
+        match = SAMPLE_PATTERN.match(line)
+        if match and match.group(1) in METRICS:
+            labels = tuple((k, unescape(v)) for k, v in LABEL_PATTERN.findall(match.group(2)))
+            samples.append((match.group(1), labels, float(match.group(3))))
+    return samples
+
+
+def target_samples(target: Target, results: list[StageResult], previous: list[Sample]) -> list[Sample]:
+    labels: Labels = (('target', target.name), ('archive', target.archive.name), ('repo', target.repo.name))
+    status = next((r.exit_code for r in results if r.exit_code), 0)
+    end = max(r.finished for r in results)
+    samples: list[Sample] = [
+        ('borg_drone_start_timestamp_seconds', labels, min(r.started for r in results)),
+        ('borg_drone_end_timestamp_seconds', labels, end),
+    ]
+    samples += [('borg_drone_stage_duration_seconds', labels + (('stage', r.stage), ), r.duration) for r in results]
+    stats = next((r.result for r in results if isinstance(r.result, ArchiveStats)), None)
+    if stats is not None:
+        samples += [
+            ('borg_drone_original_bytes', labels, stats.original_size),
+            ('borg_drone_compressed_bytes', labels, stats.compressed_size),
+            ('borg_drone_deduplicated_bytes', labels, stats.deduplicated_size),
+            ('borg_drone_files', labels, stats.nfiles),
+        ]
+    samples.append(('borg_drone_exit_status', labels, status))
+    if status == 0:
+        samples.append(('borg_drone_last_success_timestamp_seconds', labels, end))
+    else:
+        # Keep the last success time from an earlier run
+        samples += [s for s in previous if s[0] == 'borg_drone_last_success_timestamp_seconds']
+    return samples
+
+
+def render_metrics(samples: list[Sample]) -> str:
+    by_name: dict[str, list[Sample]] = {name: [] for name in METRICS}
+    for sample in samples:
+        by_name[sample[0]].append(sample)
+    lines = []
+    for name, metric_samples in by_name.items():
+        if metric_samples:
+            lines += [f'# HELP {name} {METRICS[name]}', f'# TYPE {name} gauge']
+            lines += map(format_sample, metric_samples)
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(file: Path, targets: list[Target], results: list[StageResult]) -> None:
+    """
+    Write the results of a run in the Prometheus text format, for the node_exporter textfile collector.
+    Metrics of targets which were not part of this run are kept from the previous file.
+    The file is replaced atomically, and failures to write it are logged rather than raised.
+    """
+    results_by_target: dict[str, list[StageResult]] = {}
+    for result in results:
+        results_by_target.setdefault(result.target.name, []).append(result)
+
+    previous_by_target: dict[Optional[str], list[Sample]] = {}
+    for sample in read_samples(file):
+        previous_by_target.setdefault(dict(sample[1]).get('target'), []).append(sample)
+
+    samples = []
+    for name, previous in previous_by_target.items():
+        if name not in results_by_target:
+            samples += previous
+    for target in targets:
+        if target.name in results_by_target:
+            previous = previous_by_target.get(target.name, [])
+            samples += target_samples(target, results_by_target[target.name], previous)
+
+    try:
+        atomic_write_text(file, render_metrics(samples))
+    except OSError as ex:
+        logger.error(f'Unable to write metrics file {file}: {ex}')
+    else:
+        logger.debug(f'Metrics written to {file}')
@@ -0,0 +1,74 @@
+import os
+import tempfile
+from collections import deque
+from pathlib import Path
+from typing import IO, Optional
+
+# Size of each read from child process output
+CHUNK_SIZE = 2**16
+
+# Maximum length of a single line of child process output, longer lines are split
+LINE_LIMIT = 2**20
+
+# Number of trailing output lines kept for error reporting
+TAIL_LINES = 50
+
+
+def decode_line(line: bytes) -> str:
+    return line.decode(errors='replace').rstrip()
+
+
+class LineSplitter:
+    """
+    Split a stream of binary chunks into decoded lines, holding at most one incomplete line in memory
+    """
+    __slots__ = ('partial', 'limit')
+
+    def __init__(self, limit: int = LINE_LIMIT) -> None:
+        self.partial = b''
+        self.limit = limit
+
+    def feed(self, chunk: bytes) -> list[str]:
+        lines = (self.partial + chunk if self.partial else chunk).split(b'\n')
+        self.partial = lines.pop()
+        while len(self.partial) > self.limit:
+            lines.append(self.partial[:self.limit])
+            self.partial = self.partial[self.limit:]
+        return [decode_line(line) for line in lines]
+
+    def flush(self) -> list[str]:
+        partial, self.partial = self.partial, b''
+        return [decode_line(partial)] if partial else []
+
+
+class OutputLog:
+    """
+    Keeps the last lines of a command's output for error reporting.
+    With spill=True, the complete raw output is also written to a temporary file.
+    """
+
+    def __init__(self, lines: int = TAIL_LINES, spill: bool = False) -> None:
+        self.tail: deque[str] = deque(maxlen=lines)
+        self.file: Optional[IO[bytes]] = None
+        if spill:
+            self.file = tempfile.NamedTemporaryFile(prefix='borg-drone-', suffix='.log', delete=False)
+
+    def write(self, chunk: bytes, lines: list[str]) -> None:
+        if self.file is not None:
+            self.file.write(chunk)
+        self.tail.extend(lines)
+
+    def close(self, keep: bool = False) -> Optional[Path]:
+        """
+        Close the spill file, returning its path if it was kept
+        """
+        if self.file is None:
+            return None
+        self.file.close()
+        if not keep:
+            os.unlink(self.file.name)
+            return None
+        return Path(self.file.name)
+
+    def __str__(self) -> str:
+        return '\n'.join(self.tail)
@@ -0,0 +1,211 @@
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Optional, Union
+
+from .log import status_line
+
+SIZE_UNITS = ('B', 'kB', 'MB', 'GB', 'TB', 'PB')
+
+
+def format_size(size: float) -> str:
+    """
+    Human readable size, using decimal units like borg
+    """
+    for unit in SIZE_UNITS[:-1]:
+        if abs(size) < 1000:
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.2f} {unit}'
+        size /= 1000
+    return f'{size:.2f} {SIZE_UNITS[-1]}'
+
+
+def ratio(part: int, total: int) -> float:
+    return part / total if total else 0.0
+
+
+@dataclass(frozen=True)
+class ArchiveProgress:
+    """
+    Progress of a running `borg create`, with rates measured since the command started
+    """
+    original_size: int
+    compressed_size: int
+    deduplicated_size: int
+    nfiles: int
+    path: str
+    elapsed: float
+
+    @property
+    def files_per_second(self) -> float:
+        return self.nfiles / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.original_size / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def compression_ratio(self) -> float:
+        return ratio(self.compressed_size, self.original_size)
+
+    @property
+    def deduplication_ratio(self) -> float:
+        return ratio(self.deduplicated_size, self.original_size)
+
+
+@dataclass(frozen=True)
+class LogMessage:
+    level: int
+    message: str
+
+
+@dataclass(frozen=True)
+class ArchiveStats:
+    """
+    Final statistics of an archive, as reported by `borg create --json`
+    """
+    name: str
+    original_size: int
+    compressed_size: int
+    deduplicated_size: int
+    nfiles: int
+    duration: float
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> 'ArchiveStats':
+        archive = data['archive']
+        stats = archive['stats']
+        return cls(
+            name=archive['name'],
+            original_size=stats['original_size'],
+            compressed_size=stats['compressed_size'],
+            deduplicated_size=stats['deduplicated_size'],
+            nfiles=stats['nfiles'],
+            duration=archive['duration'],
+        )
+
+    @property
+    def files_per_second(self) -> float:
+        return self.nfiles / self.duration if self.duration > 0 else 0.0
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.original_size / self.duration if self.duration > 0 else 0.0
+
+    @property
+    def compression_ratio(self) -> float:
+        return ratio(self.compressed_size, self.original_size)
+
+    @property
+    def deduplication_ratio(self) -> float:
+        return ratio(self.deduplicated_size, self.original_size)
+
+    def __str__(self) -> str:
+        return (
+            f'{self.name}: {self.nfiles} files, {format_size(self.original_size)} original, '
+            f'{format_size(self.compressed_size)} compressed, {format_size(self.deduplicated_size)} deduplicated '
+            f'in {self.duration:.1f}s ({format_size(self.bytes_per_second)}/s, {self.files_per_second:.0f} files/s)')
+
+
+BorgEvent = Union[ArchiveProgress, LogMessage]
+
+
+class BorgEventParser:
+    """
+    Parse the output of borg run with `--log-json --json` (and `--progress`) into events.
+    borg writes one JSON object per line to stderr, and a single (indented) JSON document with the result
+    to stdout once it has finished, which is kept as `result`.
+    Lines which are not JSON are returned as info log messages.
+    """
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.result: Optional[dict[str, Any]] = None
+        self.document: list[str] = []
+
+    def feed(self, line: str) -> Optional[BorgEvent]:
+        if self.document or line == '{':
+            return self.feed_document(line)
+        if not line.startswith('{'):
+            return LogMessage(logging.INFO, line) if line else None
+        try:
+            data = json.loads(line)
+        except ValueError:
+            return LogMessage(logging.INFO, line)
+        return self.event(data)
+
+    def feed_document(self, line: str) -> Optional[BorgEvent]:
+        self.document.append(line)
+        if line != '}':
+            return None
+        try:
+            data = json.loads('\n'.join(self.document))
+        except ValueError:
+            return None
+        self.document = []
+        return self.event(data)
+
+    def event(self, data: dict[str, Any]) -> Optional[BorgEvent]:
+        event_type = data.get('type')
+        if event_type == 'archive_progress':
+            if data.get('finished'):
+                return None
+            return ArchiveProgress(
+                original_size=data.get('original_size', 0),
+                compressed_size=data.get('compressed_size', 0),
+                deduplicated_size=data.get('deduplicated_size', 0),
+                nfiles=data.get('nfiles', 0),
+                path=data.get('path', ''),
+                elapsed=data.get('time', time.time()) - self.started,
+            )
+        if event_type == 'log_message':
+            level = logging.getLevelName(data.get('levelname', 'INFO'))
+            return LogMessage(level if isinstance(level, int) else logging.INFO, data.get('message', ''))
+        if event_type is None:
+            self.result = data
+        # progress_message, progress_percent and file_status events are not used
+        return None
+
+
+class ProgressView:
+    """
+    Aggregates the latest progress of every running target into a single status line.
+    Only shown for interactive sessions, and redrawn at most once per interval.
+    """
+
+    def __init__(self, interval: float = 0.5) -> None:
+        self.interval = interval
+        self.progress: dict[str, ArchiveProgress] = {}
+        self.last_update = 0.0
+
+    def update(self, name: str, progress: ArchiveProgress) -> None:
+        self.progress[name] = progress
+        now = time.monotonic()
+        if now - self.last_update >= self.interval:
+            self.last_update = now
+            status_line.update(self.render())
+
+    def finish(self, name: str) -> None:
+        self.progress.pop(name, None)
+        if self.progress:
+            status_line.update(self.render())
+        else:
+            status_line.clear()
+
+    def render(self) -> str:
+        if not self.progress:
+            return ''
+        items = list(self.progress.values())
+        nfiles = sum(x.nfiles for x in items)
+        original = sum(x.original_size for x in items)
+        deduplicated = sum(x.deduplicated_size for x in items)
+        bytes_per_second = sum(x.bytes_per_second for x in items)
+        files_per_second = sum(x.files_per_second for x in items)
+        if len(items) == 1:
+            name, = self.progress
+            prefix, path = f'[{name}]', items[0].path
+        else:
+            prefix, path = f'{len(items)} targets', ''
+        return (
+            f'{prefix} {nfiles} files │ {format_size(original)} │ {format_size(deduplicated)} deduplicated │ '
+            f'{format_size(bytes_per_second)}/s │ {files_per_second:.0f} files/s │ {path}').rstrip(' │')
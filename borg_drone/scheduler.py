@@ -0,0 +1,172 @@
+import asyncio
+import time
+from collections import Counter
+from collections.abc import Awaitable
+from dataclasses import dataclass, field
+from logging import getLogger
+from subprocess import CalledProcessError
+from typing import Any, Callable, Optional
+
+from .config import RemoteRepository, Target
+from .log import log_prefix
+
+logger = getLogger(__package__)
+
+TargetFunction = Callable[[Target], Awaitable[Any]]
+
+
+@dataclass(frozen=True)
+class ConcurrencyLimits:
+    """
+    Maximum number of targets which may run at the same time against a single resource.
+    Repository limits are keyed on the path of each archive's borg repository, host limits on the remote hostname.
+    """
+    per_host: int = 1
+    per_repository: int = 1
+
+    def keys(self, target: Target) -> list[tuple[str, int]]:
+        keys = [(f'repo:{target.borg_repository_path}', self.per_repository)]
+        if isinstance(target.repo, RemoteRepository):
+            keys.append((f'host:{target.repo.hostname}', self.per_host))
+        return keys
+
+
+@dataclass(frozen=True)
+class Stage:
+    """
+    A single step of the per-target pipeline.
+    At most `workers` targets may be in this stage at once. Stages which touch the borg repository
+    are also subject to the per-host and per-repository ConcurrencyLimits.
+    """
+    name: str
+    run: TargetFunction
+    workers: int = 1
+    limited: bool = True
+    applies: Callable[[Target], bool] = field(default=lambda target: True)
+
+
+@dataclass
+class StageResult:
+    target: Target
+    stage: str
+    started: float
+    finished: float
+    error: Optional[BaseException] = None
+    result: Any = None
+
+    @property
+    def duration(self) -> float:
+        return self.finished - self.started
+
+    @property
+    def exit_code(self) -> int:
+        """
+        Return code of the failed command, 1 for other errors or 0 on success
+        """
+        if isinstance(self.error, CalledProcessError):
+            return self.error.returncode
+        return 0 if self.error is None else 1
+
+
+async def _run_stage(stage: Stage, target: Target) -> StageResult:
+    # Each task runs in a copy of the current context, so the prefix only applies to this stage's output
+    log_prefix.set(f'[{target.name}] ')
+    started = time.time()
+    try:
+        result = await stage.run(target)
+    except Exception as ex:
+        logger.error(f'{stage.name} failed: {ex}')
+        return StageResult(target, stage.name, started, time.time(), ex)
+    return StageResult(target, stage.name, started, time.time(), result=result)
+
+
+def run_pipeline(
+    targets: list[Target],
+    stages: list[Stage],
+    limits: ConcurrencyLimits = ConcurrencyLimits(),
+    depends_on: Optional[dict[str, str]] = None,
+) -> list[StageResult]:
+    """
+    Blocking interface to run_pipeline_async
+    """
+    return asyncio.run(run_pipeline_async(targets, stages, limits, depends_on))
+
+
+async def run_pipeline_async(
+    targets: list[Target],
+    stages: list[Stage],
+    limits: ConcurrencyLimits = ConcurrencyLimits(),
+    depends_on: Optional[dict[str, str]] = None,
+) -> list[StageResult]:
+    """
+    Pass every target through each of the stages in order.
+    Different targets may occupy different stages at the same time, so a slow stage (e.g. an upload) for one target
+    does not hold up the earlier stages of the next.
+    When a stage fails, the remaining stages of that target are skipped.
+
+    depends_on maps a target name to the name of another target in the pipeline. A target only enters a stage once
+    the target it depends on has completed all earlier stages, and fails without running if that target failed.
+    """
+    order = {target.name: index for index, target in enumerate(targets)}
+    depends_on = {k: v for k, v in (depends_on or {}).items() if k in order and v in order}
+    failed: set[str] = set()
+    position = {target.name: 0 for target in targets}
+    pending = list(targets)
+    running: dict[asyncio.Task[StageResult], tuple[Target, Stage]] = {}
+    stage_use: Counter[str] = Counter()
+    key_use: Counter[str] = Counter()
+    results: list[StageResult] = []
+
+    def next_stage(target: Target) -> Optional[Stage]:
+        while position[target.name] < len(stages):
+            stage = stages[position[target.name]]
+            if stage.applies(target):
+                return stage
+            position[target.name] += 1
+        return None
+
+    def keys(target: Target, stage: Stage) -> list[tuple[str, int]]:
+        return limits.keys(target) if stage.limited else []
+
+    while pending or running:
+        for target in list(pending):
+            stage = next_stage(target)
+            if stage is None:
+                pending.remove(target)
+                continue
+            dependency = depends_on.get(target.name)
+            if dependency is not None and position[dependency] < position[target.name]:
+                if dependency in failed:
+                    logger.error(f'{target.name} {stage.name} skipped, {dependency} failed')
+                    now = time.time()
+                    results.append(StageResult(target, stage.name, now, now, RuntimeError(f'{dependency} failed')))
+                    failed.add(target.name)
+                    pending.remove(target)
+                continue
+            if stage_use[stage.name] >= max(1, stage.workers):
+                continue
+            stage_keys = keys(target, stage)
+            if all(key_use[key] < max(1, limit) for key, limit in stage_keys):
+                pending.remove(target)
+                stage_use[stage.name] += 1
+                key_use.update(key for key, _ in stage_keys)
+                running[asyncio.create_task(_run_stage(stage, target))] = (target, stage)
+
+        if not running:
+            continue
+
+        done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            target, stage = running.pop(task)
+            stage_use[stage.name] -= 1
+            key_use.subtract(key for key, _ in keys(target, stage))
+            result = task.result()
+            results.append(result)
+            if result.error is None:
+                position[target.name] += 1
+                pending.append(target)
+            else:
+                failed.add(target.name)
+        pending.sort(key=lambda t: order[t.name])
+
+    return results
@@ -0,0 +1,171 @@
+import json
+import re
+from collections.abc import Callable, Iterator
+from functools import lru_cache
+from pathlib import Path
+from typing import Any
+
+SCHEMA_FILE = Path(__file__).parent / 'config-schema.json'
+
+# A compiled validator yields an error message for every violation found at or below the given path
+Validator = Callable[[Any, str], Iterator[str]]
+
+JSON_TYPES: dict[str, Callable[[Any], bool]] = {
+    'object': lambda x: isinstance(x, dict),
+    'array': lambda x: isinstance(x, list),
+    'string': lambda x: isinstance(x, str),
+    'integer': lambda x: isinstance(x, int) and not isinstance(x, bool),
+    'number': lambda x: isinstance(x, (int, float)) and not isinstance(x, bool),
+    'boolean': lambda x: isinstance(x, bool),
+    'null': lambda x: x is None,
+}
+
+
+def join_path(path: str, key: Any) -> str:
+    return f'{path}.{key}' if path else str(key)
+
+
+class SchemaCompiler:
+    """
+    Compiles the subset of JSON schema (draft 6) used by config-schema.json into nested validator functions,
+    so that each schema node is only interpreted once no matter how many values it is applied to.
+    """
+
+    def __init__(self, schema: dict[str, Any]) -> None:
+        self.definitions = schema.get('definitions', {})
+        self.compiled: dict[str, Validator] = {}
+
+    def ref(self, ref: str) -> Validator:
+        name = ref.rsplit('/', 1)[-1]
+        if name not in self.compiled:
+            # Register a forwarding validator first to support recursive references
+            self.compiled[name] = lambda value, path: self.compiled[name](value, path)
+            self.compiled[name] = self.compile(self.definitions[name])
+        return self.compiled[name]
+
+    def compile(self, node: dict[str, Any]) -> Validator:
+        if '$ref' in node:
+            return self.ref(node['$ref'])
+
+        checks: list[Validator] = []
+
+        if 'type' in node:
+            types = node['type'] if isinstance(node['type'], list) else [node['type']]
+            type_checks = [JSON_TYPES[t] for t in types]
+            expected = ' or '.join(types)
+
+            def check_type(value: Any, path: str) -> Iterator[str]:
+                if not any(check(value) for check in type_checks):
+                    yield f'Invalid value for "{path}": expected {expected}, got {value!r}'
+
+            checks.append(check_type)
+
+        if 'enum' in node:
+            allowed = node['enum']
+
+            def check_enum(value: Any, path: str) -> Iterator[str]:
+                if value not in allowed:
+                    yield f'Invalid value for "{path}": {value!r}. Must be one of {allowed}'
+
+            checks.append(check_enum)
+
+        if 'pattern' in node:
+            pattern = re.compile(node['pattern'])
+
+            def check_pattern(value: Any, path: str) -> Iterator[str]:
+                if isinstance(value, str) and not pattern.search(value):
+                    yield f'Invalid value for "{path}": {value!r} does not match {pattern.pattern}'
+
+            checks.append(check_pattern)
+
+        if 'minimum' in node or 'maximum' in node:
+            minimum, maximum = node.get('minimum'), node.get('maximum')
+
+            def check_range(value: Any, path: str) -> Iterator[str]:
+                if not JSON_TYPES['number'](value):
+                    return
+                if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+                    yield f'Invalid value for "{path}": {value} is outside of the range {minimum} to {maximum}'
+
+            checks.append(check_range)
+
+        if 'required' in node:
+            required = node['required']
+
+            def check_required(value: Any, path: str) -> Iterator[str]:
+                if isinstance(value, dict):
+                    for key in required:
+                        if key not in value:
+                            yield f'Missing required key "{join_path(path, key)}"'
+
+            checks.append(check_required)
+
+        if 'properties' in node or 'patternProperties' in node or node.get('additionalProperties') is False:
+            checks.append(self.compile_properties(node))
+
+        if 'items' in node:
+            item_validator = self.compile(node['items'])
+
+            def check_items(value: Any, path: str) -> Iterator[str]:
+                if isinstance(value, list):
+                    for i, item in enumerate(value):
+                        yield from item_validator(item, join_path(path, i))
+
+            checks.append(check_items)
+
+        if 'anyOf' in node:
+            options = [self.compile(option) for option in node['anyOf']]
+
+            def check_any_of(value: Any, path: str) -> Iterator[str]:
+                option_errors = []
+                for option in options:
+                    errors = list(option(value, path))
+                    if not errors:
+                        return
+                    option_errors.append(errors)
+                # Report the errors of the option which came closest to matching
+                yield from min(option_errors, key=len)
+
+            checks.append(check_any_of)
+
+        def validate(value: Any, path: str) -> Iterator[str]:
+            for check in checks:
+                yield from check(value, path)
+
+        return validate
+
+    def compile_properties(self, node: dict[str, Any]) -> Validator:
+        properties = {key: self.compile(value) for key, value in node.get('properties', {}).items()}
+        patterns = [(re.compile(key), self.compile(value)) for key, value in node.get('patternProperties', {}).items()]
+        additional = node.get('additionalProperties', True) is not False
+
+        def check_properties(value: Any, path: str) -> Iterator[str]:
+            if not isinstance(value, dict):
+                return
+            for key, item in value.items():
+                item_path = join_path(path, key)
+                if key in properties:
+                    yield from properties[key](item, item_path)
+                    continue
+                matched = False
+                for pattern, validator in patterns:
+                    if pattern.search(str(key)):
+                        matched = True
+                        yield from validator(item, item_path)
+                if not matched and not additional:
+                    yield f'Unknown key "{item_path}"'
+
+        return check_properties
+
+
+@lru_cache(maxsize=None)
+def config_validator() -> Validator:
+    """
+    Validator for the configuration file, compiled from config-schema.json on first use
+    """
+    schema = json.loads(SCHEMA_FILE.read_text())
+    return SchemaCompiler(schema).compile(schema)
+
+
+def schema_errors(data: Any) -> set[str]:
+    return set(config_validator()(data, ''))
@@ -0,0 +1,257 @@
+import asyncio
+import hmac
+import os
+import re
+import tempfile
+import time
+from base64 import b64decode, b64encode
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from fnmatch import fnmatchcase
+from hashlib import sha1
+from logging import getLogger
+from pathlib import Path
+from subprocess import DEVNULL, PIPE
+from typing import Optional, TYPE_CHECKING
+
+from .types import EnvironmentMap
+
+if TYPE_CHECKING:
+    from .config import RemoteRepository, Target
+
+logger = getLogger(__package__)
+
+# Seconds an idle master connection is kept open if borg-drone exits without closing it
+CONTROL_PERSIST = 60
+
+# Unix socket paths are limited to ~100 characters, so sockets are kept in a short per-user temporary directory
+CONTROL_DIR = Path(tempfile.gettempdir()) / f'borg-drone-{os.getuid()}'
+
+_CONTROL_PATH_PATTERN = re.compile(r'ControlPath=(\S+)')
+
+
+def control_path(repo: 'RemoteRepository') -> Path:
+    """
+    Location of the master connection socket shared by all repositories with the same user, host, port and key
+    """
+    key = f'{repo.username}@{repo.hostname}:{repo.port}:{repo.ssh_key}'
+    return CONTROL_DIR / sha1(key.encode()).hexdigest()[:16]
+
+
+def ssh_argv(repo: 'RemoteRepository', control_master: str = 'auto') -> list[str]:
+    """
+    ssh command used to connect to a remote repository, as used by BORG_RSH
+    """
+    argv = ['ssh', '-o', 'VisualHostKey=no']
+    if repo.ssh_key:
+        argv += ['-i', repo.ssh_key]
+    if repo.ssh_multiplex:
+        argv += [
+            '-o', f'ControlMaster={control_master}',
+            '-o', f'ControlPath={control_path(repo)}',
+            '-o', f'ControlPersist={CONTROL_PERSIST}',
+        ]  # yapf: disable
+    return argv
+
+
+@dataclass
+class ControlMaster:
+    repo: 'RemoteRepository'
+    path: Path
+    handshake: float = 0.0
+    connections: int = 0
+
+    @property
+    def destination(self) -> str:
+        return f'{self.repo.username}@{self.repo.hostname}' if self.repo.username else self.repo.hostname
+
+    async def open(self) -> bool:
+        started = time.monotonic()
+        argv = [*ssh_argv(self.repo, control_master='yes'), '-p', str(self.repo.port), '-N', '-f', self.destination]
+        logger.debug('> ' + ' '.join(argv))
+        proc = await asyncio.create_subprocess_exec(*argv, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+        if await proc.wait():
+            logger.warning(f'Unable to open SSH master connection to {self.destination}:{self.repo.port}')
+            return False
+        self.handshake = time.monotonic() - started
+        logger.debug(f'SSH master connection to {self.destination}:{self.repo.port} opened in {self.handshake:.2f}s')
+        return True
+
+    async def close(self) -> None:
+        argv = ['ssh', '-o', f'ControlPath={self.path}', '-O', 'exit', self.destination]
+        logger.debug('> ' + ' '.join(argv))
+        proc = await asyncio.create_subprocess_exec(*argv, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+        await proc.wait()
+        if self.handshake:
+            logger.debug(
+                f'SSH master connection to {self.destination}:{self.repo.port} closed. '
+                f'{self.connections} connection(s) reused it, saving ~{self.connections * self.handshake:.2f}s')
+
+
+# Master connections opened by the current run, keyed by socket path
+_masters: dict[str, ControlMaster] = {}
+
+
+def record_connection(env: EnvironmentMap) -> None:
+    """
+    Count a command which will connect through an open master connection
+    """
+    match = _CONTROL_PATH_PATTERN.search((env or {}).get('BORG_RSH', ''))
+    if match and match.group(1) in _masters:
+        _masters[match.group(1)].connections += 1
+
+
+@contextmanager
+def multiplexed(targets: Iterable['Target']) -> Iterator[None]:
+    """
+    Open one master connection for every distinct remote (user, host, port, key) before running commands against
+    the targets, and close them all afterwards. Connections which cannot be opened fall back to ControlMaster=auto.
+    """
+    from .config import RemoteRepository
+
+    masters: dict[str, ControlMaster] = {}
+    for target in targets:
+        repo = target.repo
+        if isinstance(repo, RemoteRepository) and repo.ssh_multiplex:
+            path = control_path(repo)
+            masters.setdefault(str(path), ControlMaster(repo, path))
+
+    if masters:
+        from .tools import find_tool
+        if find_tool('ssh') is None:
+            logger.debug('Unable to locate ssh executable, connections will not be shared')
+            masters.clear()
+
+    if not masters:
+        yield
+        return
+
+    async def open_all() -> list[bool]:
+        return await asyncio.gather(*(master.open() for master in masters.values()))
+
+    async def close_all() -> None:
+        await asyncio.gather(*(master.close() for master in masters.values()))
+
+    CONTROL_DIR.mkdir(mode=0o700, exist_ok=True)
+    opened = asyncio.run(open_all())
+    _masters.update((path, master) for (path, master), ok in zip(masters.items(), opened) if ok)
+    try:
+        yield
+    finally:
+        for path in masters:
+            _masters.pop(path, None)
+        # Masters which failed to open may since have been created by borg's own ssh (ControlMaster=auto)
+        asyncio.run(close_all())
+
+
+def known_hosts_name(hostname: str, port: int = 22) -> str:
+    """
+    Host name as written to known_hosts, which includes the port when it is not the default
+    """
+    return hostname if port == 22 else f'[{hostname}]:{port}'
+
+
+def hash_hostname(name: str, salt: Optional[bytes] = None) -> str:
+    """
+    Hash a host name in the same format as `ssh-keygen -H`
+    """
+    salt = salt if salt is not None else os.urandom(20)
+    digest = hmac.new(salt, name.encode(), sha1).digest()
+    return f'|1|{b64encode(salt).decode()}|{b64encode(digest).decode()}'
+
+
+class KnownHosts:
+    """
+    Index of the host names in a known_hosts file, including hashed and wildcard entries
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.names: set[str] = set()
+        self.patterns: list[str] = []
+        self.hashed: list[tuple[bytes, bytes]] = []
+        if path.exists():
+            with path.open() as f:
+                for line in f:
+                    self.add_line(line)
+
+    def add_line(self, line: str) -> None:
+        fields = line.split()
+        if not fields or fields[0].startswith(('#', '@')):
+            return
+        for name in fields[0].split(','):
+            if name.startswith('|1|'):
+                try:
+                    salt, digest = name[3:].split('|', 1)
+                    self.hashed.append((b64decode(salt), b64decode(digest)))
+                except ValueError:
+                    continue
+            elif name.startswith('!') or '*' in name or '?' in name:
+                self.patterns.append(name)
+            else:
+                self.names.add(name)
+
+    def __contains__(self, name: str) -> bool:
+        if name in self.names:
+            return True
+        for salt, digest in self.hashed:
+            if hmac.compare_digest(hmac.new(salt, name.encode(), sha1).digest(), digest):
+                self.names.add(name)
+                return True
+        matched = False
+        for pattern in self.patterns:
+            if pattern.startswith('!') and fnmatchcase(name, pattern[1:]):
+                return False
+            matched = matched or fnmatchcase(name, pattern)
+        return matched
+
+
+async def keyscan(hostnames: list[str], port: int) -> list[str]:
+    """
+    Fetch the host keys of many hosts with a single ssh-keyscan, which queries all of them concurrently
+    """
+    argv = ['ssh-keyscan', '-p', str(port), *hostnames]
+    logger.info('> ' + ' '.join(argv))
+    proc = await asyncio.create_subprocess_exec(*argv, stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL)
+    stdout, _ = await proc.communicate()
+    return [line for line in stdout.decode(errors='replace').splitlines() if line and not line.startswith('#')]
+
+
+def update_ssh_known_hosts(hosts: Iterable[tuple[str, int]]) -> set[tuple[str, int]]:
+    """
+    Add the keys of any (hostname, port) not already present in ~/.ssh/known_hosts.
+    Returns the hosts for which no key could be found.
+    """
+    ssh_dir = Path.home() / '.ssh'
+    ssh_dir.mkdir(mode=0o700, exist_ok=True)
+    known_hosts = KnownHosts(ssh_dir / 'known_hosts')
+
+    missing: dict[int, list[str]] = defaultdict(list)
+    for hostname, port in dict.fromkeys(hosts):
+        if known_hosts_name(hostname, port) not in known_hosts:
+            missing[port].append(hostname)
+    if not missing:
+        return set()
+
+    async def scan_all() -> list[list[str]]:
+        return await asyncio.gather(*(keyscan(hostnames, port) for port, hostnames in missing.items()))
+
+    entries = []
+    found = set()
+    for lines in asyncio.run(scan_all()):
+        for line in lines:
+            name, key = line.split(' ', 1)
+            entries.append(f'{hash_hostname(name)} {key}')
+            found.add(name)
+
+    if entries:
+        if not known_hosts.path.exists():
+            known_hosts.path.touch(mode=0o600)
+        with known_hosts.path.open('a') as f:
+            f.write('\n' + '\n'.join(entries) + '\n')
+        logger.info(f'Added {len(entries)} host key(s) to {known_hosts.path}')
+
+    unknown = {(hostname, port) for port, names in missing.items() for hostname in names}
+    return {(hostname, port) for hostname, port in unknown if known_hosts_name(hostname, port) not in found}
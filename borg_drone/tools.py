@@ -0,0 +1,183 @@
+import json
+import os
+import re
+import shutil
+import subprocess
+from dataclasses import dataclass
+from logging import getLogger
+from pathlib import Path
+from typing import Optional
+
+from . import config
+from .util import atomic_write_text
+
+logger = getLogger(__package__)
+
+# Arguments which make each tool print its version
+VERSION_ARGS = {
+    'borg': ['-V'],
+    'rclone': ['version'],
+    'ssh': ['-V'],
+    'rsync': ['--version'],
+}
+
+VERSION_PATTERN = re.compile(r'(\d+)\.(\d+)(?:\.(\d+))?')
+
+
+def parse_version(text: str) -> tuple[int, ...]:
+    match = VERSION_PATTERN.search(text)
+    if match is None:
+        return ()
+    return tuple(int(x) for x in match.groups() if x is not None)
+
+
+@dataclass(frozen=True)
+class Tool:
+    name: str
+    path: str
+    version: tuple[int, ...]
+
+    def at_least(self, *version: int) -> bool:
+        return self.version >= version
+
+    def __str__(self) -> str:
+        return f'{self.name} {".".join(map(str, self.version)) or "(unknown version)"} [{self.path}]'
+
+
+@dataclass(frozen=True)
+class BorgCapabilities:
+    """
+    Features and command line syntax of the installed borg version
+    """
+    tool: Tool
+
+    @property
+    def borg2(self) -> bool:
+        return self.tool.at_least(2)
+
+    @property
+    def log_json(self) -> bool:
+        """
+        `--log-json` and `--json` output
+        """
+        return self.tool.at_least(1, 1)
+
+    @property
+    def compact(self) -> bool:
+        """
+        Freeing space is a separate `borg compact` command since borg 1.2
+        """
+        return self.tool.at_least(1, 2)
+
+    @property
+    def ratelimit_option(self) -> str:
+        """
+        Option to limit upload bandwidth to a remote repository
+        """
+        return '--upload-ratelimit' if self.tool.at_least(1, 2) else '--remote-ratelimit'
+
+    @property
+    def init_command(self) -> list[str]:
+        return ['borg', 'repo-create'] if self.borg2 else ['borg', 'init']
+
+    @property
+    def repo_info_command(self) -> list[str]:
+        """
+        Summary of the repository, borg 2 moved it from `borg info` to a separate command
+        """
+        return ['borg', 'repo-info'] if self.borg2 else ['borg', 'info']
+
+    @property
+    def repo_list_command(self) -> list[str]:
+        """
+        Archives in the repository, borg 2 `borg list` lists the contents of an archive instead
+        """
+        return ['borg', 'repo-list'] if self.borg2 else ['borg', 'list']
+
+    def archive(self, name: str) -> str:
+        """
+        Archive argument, borg 2 takes the name alone since the repository is always given by BORG_REPO
+        """
+        return name if self.borg2 else f'::{name}'
+
+    def repository(self) -> list[str]:
+        """
+        Repository argument for commands which default to BORG_REPO with borg 2, but need '::' with borg 1
+        """
+        return [] if self.borg2 else ['::']
+
+
+def tools_cache_file() -> Path:
+    return config.CONFIG_CACHE_PATH / 'tools.json'
+
+
+class ToolRegistry:
+    """
+    Resolves the path and version of each external tool once.
+    Versions are cached on disk keyed on the binary's path and modification time, so a version command is only
+    spawned again after the tool is upgraded or moved.
+    """
+
+    def __init__(self) -> None:
+        self.tools: dict[str, Optional[Tool]] = {}
+        self.cache: Optional[dict[str, dict[str, object]]] = None
+
+    def read_cache(self) -> dict[str, dict[str, object]]:
+        if self.cache is None:
+            try:
+                self.cache = json.loads(tools_cache_file().read_text())
+            except (OSError, ValueError):
+                self.cache = {}
+        return self.cache
+
+    def write_cache(self) -> None:
+        try:
+            atomic_write_text(tools_cache_file(), json.dumps(self.read_cache()))
+        except OSError as ex:
+            logger.debug(f'Unable to write tool cache: {ex}')
+
+    def find(self, name: str) -> Optional[Tool]:
+        if name not in self.tools:
+            self.tools[name] = self.resolve(name)
+        return self.tools[name]
+
+    def resolve(self, name: str) -> Optional[Tool]:
+        path = shutil.which(name)
+        if path is None:
+            return None
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+        cached = self.read_cache().get(name)
+        if cached is not None and cached.get('path') == path and cached.get('mtime') == mtime:
+            return Tool(name, path, tuple(cached.get('version', ())))  # type: ignore[arg-type]
+
+        version: tuple[int, ...] = ()
+        if name in VERSION_ARGS:
+            try:
+                result = subprocess.run([path, *VERSION_ARGS[name]], capture_output=True, text=True, timeout=30)
+                version = parse_version(result.stdout + result.stderr)
+            except (OSError, subprocess.SubprocessError) as ex:
+                logger.warning(f'Unable to determine the version of {name}: {ex}')
+        tool = Tool(name, path, version)
+        logger.debug(f'Found {tool}')
+        self.read_cache()[name] = {'path': path, 'mtime': mtime, 'version': list(version)}
+        self.write_cache()
+        return tool
+
+
+registry = ToolRegistry()
+
+
+def find_tool(name: str) -> Optional[Tool]:
+    return registry.find(name)
+
+
+def borg_capabilities() -> BorgCapabilities:
+    """
+    Capabilities of the installed borg. Assumes the latest borg 1.x when it can not be found.
+    """
+    tool = find_tool('borg')
+    return BorgCapabilities(tool if tool is not None and tool.version else Tool('borg', 'borg', (1, 4)))
@@ -0,0 +1,230 @@
+import os
+import random
+import resource
+import shutil
+import stat
+import time
+from dataclasses import dataclass
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Optional
+
+from .config import Archive, LocalRepository, Target
+from .fingerprint import ENTRY_LIMIT, exclude_matcher
+from .progress import BorgEventParser, LogMessage
+from .tools import borg_capabilities
+from .util import execute, run_cmd
+
+logger = getLogger(__package__)
+
+CANDIDATES = ['lz4', 'zstd,1', 'zstd,3', 'zstd,6', 'zstd,10', 'auto,zstd']
+
+# Defaults for the amount of data benchmarked, and the largest piece taken from a single file
+SAMPLE_SIZE = 256 * 2**20
+PIECE_SIZE = 4 * 2**20
+MAX_FILES = 4096
+
+# Assumed throughput of writes to a local repository, and of uploads without a configured rate limit
+DISK_RATE = 200 * 10**6
+UPLOAD_RATE = 10 * 10**6
+
+
+@dataclass(frozen=True)
+class Sample:
+    """
+    Pieces of randomly chosen files below an archive's paths, copied to a directory for benchmarking
+    """
+    path: Path
+    files: int
+    size: int
+
+
+@dataclass(frozen=True)
+class CompressionResult:
+    compression: str
+    original_size: int
+    compressed_size: int
+    cpu_seconds: float
+
+    @property
+    def ratio(self) -> float:
+        return self.compressed_size / self.original_size if self.original_size else 1.0
+
+    @property
+    def throughput(self) -> float:
+        """
+        Bytes compressed per CPU second
+        """
+        return self.original_size / self.cpu_seconds if self.cpu_seconds else 0.0
+
+
+def candidate_files(archive: Archive, limit: int = ENTRY_LIMIT, count: int = MAX_FILES) -> list[tuple[str, int]]:
+    """
+    Uniform random selection (reservoir sampling) of up to `count` non-empty regular files below the archive's paths
+    """
+    excluded = exclude_matcher(archive.exclude)
+    selected: list[tuple[str, int]] = []
+    seen = 0
+    entries = 0
+    stack = [os.path.expanduser(path) for path in archive.paths]
+    while stack and entries < limit:
+        path = stack.pop()
+        try:
+            st = os.lstat(path)
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            try:
+                with os.scandir(path) as it:
+                    children = [entry.path for entry in it if not excluded(entry.path.lstrip('/'))]
+            except OSError:
+                continue
+            entries += len(children)
+            stack += children
+        elif stat.S_ISREG(st.st_mode) and st.st_size > 0:
+            seen += 1
+            if len(selected) < count:
+                selected.append((path, st.st_size))
+            else:
+                index = random.randrange(seen)
+                if index < count:
+                    selected[index] = (path, st.st_size)
+    return selected
+
+
+def sample_files(archive: Archive, directory: Path, size: int = SAMPLE_SIZE) -> Sample:
+    """
+    Copy a piece from a random offset of randomly chosen files, until `size` bytes have been sampled
+    """
+    candidates = candidate_files(archive)
+    random.shuffle(candidates)
+    directory.mkdir(parents=True, exist_ok=True)
+    files = 0
+    total = 0
+    for path, file_size in candidates:
+        if total >= size:
+            break
+        length = min(file_size, PIECE_SIZE, size - total)
+        offset = random.randrange(file_size - length + 1)
+        try:
+            with open(path, 'rb') as src:
+                src.seek(offset)
+                data = src.read(length)
+        except OSError as ex:
+            logger.debug(f'Unable to sample {path}: {ex}')
+            continue
+        (directory / f'{files:06d}{Path(path).suffix}').write_bytes(data)
+        files += 1
+        total += len(data)
+    return Sample(directory, files, total)
+
+
+def benchmark(sample: Sample, compression: str, workdir: Path) -> CompressionResult:
+    """
+    Back up the sample into a new unencrypted repository with the given compression.
+    Every candidate uses a fresh repository, so none of them benefit from deduplication against another.
+    """
+    borg = borg_capabilities()
+    repository = workdir / 'repo'
+    env = dict(
+        os.environ,
+        BORG_REPO=str(repository),
+        BORG_BASE_DIR=str(workdir / 'base'),
+        BORG_PASSPHRASE='',
+        BORG_UNKNOWN_UNENCRYPTED_REPO_ACCESS_IS_OK='yes',
+    )
+    try:
+        run_cmd([*borg.init_command, '--encryption', 'none'], env=env)
+        argv = ['borg', 'create', '--log-json', '--json', '--compression', compression, borg.archive('tune')]
+        parser = BorgEventParser()
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        for line in execute([*argv, str(sample.path)], env=env):
+            event = parser.feed(line)
+            if isinstance(event, LogMessage):
+                logger.debug(event.message)
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    finally:
+        shutil.rmtree(repository, ignore_errors=True)
+    if parser.result is None:
+        raise RuntimeError(f'No archive statistics were reported for {compression}')
+    stats: dict[str, Any] = parser.result['archive']['stats']
+    cpu_seconds = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    return CompressionResult(compression, stats['original_size'], stats['compressed_size'], cpu_seconds)
+
+
+def transfer_rates(target: Target) -> list[float]:
+    """
+    Rates in bytes per second of each hop the compressed data of the target takes:
+    the write to a local repository and any rclone upload, or the upload to a remote repository
+    """
+    rate = target.repo.upload_ratelimit.current()
+    upload_rate = float(rate * 1024 if rate is not None else UPLOAD_RATE)
+    if isinstance(target.repo, LocalRepository):
+        return [DISK_RATE, upload_rate] if target.repo.rclone_upload_path else [DISK_RATE]
+    return [upload_rate]
+
+
+def estimated_seconds(result: CompressionResult, target: Target) -> float:
+    """
+    Time to compress the sample and move the compressed data to its destinations
+    """
+    return result.cpu_seconds + sum(result.compressed_size / rate for rate in transfer_rates(target))
+
+
+def recommend(results: list[CompressionResult], target: Target) -> CompressionResult:
+    return min(results, key=lambda result: estimated_seconds(result, target))
+
+
+def tune_archive(
+    archive: Archive,
+    candidates: list[str],
+    size: int = SAMPLE_SIZE,
+    workdir: Optional[Path] = None,
+) -> tuple[Sample, list[CompressionResult]]:
+    """
+    Benchmark each of the candidate compression settings on a sample of the archive's files
+    """
+    import tempfile
+    with tempfile.TemporaryDirectory(prefix='borg-drone-tune-', dir=workdir) as tmp:
+        started = time.monotonic()
+        sample = sample_files(archive, Path(tmp) / 'sample', size)
+        logger.info(f'Sampled {sample.size} bytes from {sample.files} files in {time.monotonic() - started:.1f}s')
+        if not sample.size:
+            raise RuntimeError(f'No files found to sample in {", ".join(archive.paths)}')
+        return sample, [benchmark(sample, compression, Path(tmp)) for compression in candidates]
+
+
+def write_compression(config_file: Path, compression: dict[str, dict[str, str]]) -> Path:
+    """
+    Save the compression of each archive and repository to the configuration file.
+    An archive's setting is taken from its first repository when that was tuned, the others get an override where
+    they differ. Repositories which were not tuned keep their current compression.
+    The previous file is kept as a backup, and its path returned. Comments in the file are not preserved.
+    """
+    import yaml
+    data = yaml.safe_load(config_file.read_text())
+    definitions = {**data['repositories'].get('local', {}), **data['repositories'].get('remote', {})}
+    for archive, repository_compression in compression.items():
+        archive_data = data['archives'][archive]
+        repositories = archive_data['repositories']
+        if isinstance(repositories, list):
+            repositories = {name: None for name in repositories}
+        previous = archive_data.get('compression', Archive.compression)
+        default = repository_compression.get(next(iter(repositories)), previous)
+        archive_data['compression'] = default
+        for name in repositories:
+            overrides = dict(repositories[name] or {})
+            inherited = (definitions.get(name) or {}).get('compression')
+            current = overrides.pop('compression', None) or inherited or previous
+            value = repository_compression.get(name, current)
+            if value != (inherited or default):
+                overrides['compression'] = value
+            repositories[name] = overrides or None
+        if all(overrides is None for overrides in repositories.values()):
+            repositories = list(repositories)
+        archive_data['repositories'] = repositories
+
+    backup = config_file.with_name(f'{config_file.name}.bak')
+    shutil.copy2(config_file, backup)
+    config_file.write_text(yaml.safe_dump(data, sort_keys=False))
+    return backup
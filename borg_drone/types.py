@@ -1,9 +1,11 @@
-from collections.abc import Generator
+from collections.abc import AsyncGenerator, Generator
 from enum import Enum
 from typing import Optional
 
 EnvironmentMap = Optional[dict[str, str]]
 StringGenerator = Generator[str, None, None]
+AsyncStringGenerator = AsyncGenerator[str, None]
+AsyncLinesGenerator = AsyncGenerator[list[str], None]
 
 TargetTuple = Optional[tuple[str, str]]
 
@@ -0,0 +1,389 @@
+import asyncio
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from logging import getLogger
+from pathlib import Path, PurePosixPath
+from typing import Any, Optional
+
+from .config import LocalRepository, PriorityOptions, Target
+from .util import atomic_write_text, execute_async, run_cmd_async
+
+logger = getLogger(__package__)
+
+# A full `rclone sync` of each repository is made at least this often, to repair anything the incremental
+# uploads missed (e.g. files changed or removed on the remote)
+FULL_SYNC_INTERVAL = 7 * 86400
+
+# Files uploaded in parallel by a single rclone process
+TRANSFERS = 8
+
+# Remote modification times within this many seconds of the local ones match, as some remotes only store seconds
+MODTIME_WINDOW = 1.0
+
+# Size of the blocks files are hashed in
+HASH_BLOCK_SIZE = 2**20
+
+# Hashes kept in the manifest, in the order of FileHashes, and the number of files hashed remotely by each verification
+HASH_TYPES = ['md5', 'sha1']
+VERIFY_SAMPLE = 16
+
+FileState = tuple[int, int]
+FileHashes = tuple[str, str]
+
+
+@dataclass
+class UploadState:
+    """
+    Manifest of a repository's files at its last successful upload: the size and modification time of every file,
+    and its MD5 and SHA-1 hashes
+    """
+    full_sync: float = 0.0
+    files: dict[str, FileState] = field(default_factory=dict)
+    hashes: dict[str, FileHashes] = field(default_factory=dict)
+
+
+@dataclass(frozen=True)
+class UploadPlan:
+    target: Target
+    previous: UploadState
+    files: dict[str, FileState]
+    changed: list[str]
+    deleted: list[str]
+    full: bool
+
+    @property
+    def unhashed(self) -> list[str]:
+        """
+        Files which are uploaded by this plan, or were never hashed
+        """
+        changed = set(self.changed)
+        return sorted(path for path in self.files if path in changed or path not in self.previous.hashes)
+
+
+def is_segment(path: str) -> bool:
+    return path.split('/')[0] == 'data'
+
+
+def state_file(target: Target) -> Path:
+    return target.config_path / 'upload.json'
+
+
+def read_state(target: Target) -> UploadState:
+    try:
+        data = json.loads(state_file(target).read_text())
+        return UploadState(
+            data['full_sync'],
+            {k: (v[0], v[1]) for k, v in data['files'].items()},
+            {k: (v[0], v[1]) for k, v in data.get('hashes', {}).items()},
+        )
+    except FileNotFoundError:
+        return UploadState()
+    except (OSError, ValueError, KeyError, TypeError, IndexError) as ex:
+        logger.warning(f'Ignoring unreadable upload state of {target.name}: {ex}')
+        return UploadState()
+
+
+def write_state(target: Target, state: UploadState) -> None:
+    data = {'full_sync': state.full_sync, 'files': state.files, 'hashes': state.hashes}
+    try:
+        atomic_write_text(state_file(target), json.dumps(data))
+    except OSError as ex:
+        logger.warning(f'Unable to save the upload state of {target.name}: {ex}')
+
+
+def scan_repository(path: Path) -> dict[str, FileState]:
+    """
+    Size and modification time of each file in a borg repository, keyed by relative path
+    """
+    files = {}
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.name.startswith('lock.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(Path(entry.path))
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    files[Path(entry.path).relative_to(path).as_posix()] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+def plan_upload(target: Target, full: bool = False, now: Optional[float] = None) -> UploadPlan:
+    """
+    Find the files of the target's repository which changed or were removed since its last successful upload.
+    A full sync is planned when forced, when there was no previous upload, or once FULL_SYNC_INTERVAL has passed.
+    """
+    now = time.time() if now is None else now
+    state = read_state(target)
+    files = scan_repository(Path(target.borg_repository_path))
+    changed = sorted(path for path, file_state in files.items() if state.files.get(path) != file_state)
+    deleted = sorted(set(state.files) - set(files))
+    full = full or not state.files or now - state.full_sync >= FULL_SYNC_INTERVAL
+    return UploadPlan(target, state, files, changed, deleted, full)
+
+
+def hash_files(root: Path, paths: list[str]) -> dict[str, FileHashes]:
+    """
+    MD5 and SHA-1 hashes of each file, which between them are supported by most rclone remotes
+    """
+    hashes = {}
+    for path in paths:
+        md5, sha1 = hashlib.md5(), hashlib.sha1()
+        try:
+            with open(root / path, 'rb') as f:
+                while block := f.read(HASH_BLOCK_SIZE):
+                    md5.update(block)
+                    sha1.update(block)
+        except OSError as ex:
+            logger.warning(f'Unable to hash {path}: {ex}')
+            continue
+        hashes[path] = (md5.hexdigest(), sha1.hexdigest())
+    return hashes
+
+
+def remote_root(repo: LocalRepository) -> str:
+    remote_name, remote_base_path = repo.rclone_upload_path.split(':', 1)
+    return f'{remote_name}:{PurePosixPath(remote_base_path)}'
+
+
+def upload_group_key(target: Target) -> tuple[str, str]:
+    """
+    Targets of the same local repository and upload path are uploaded together
+    """
+    assert isinstance(target.repo, LocalRepository)
+    return target.repo.path, target.repo.rclone_upload_path
+
+
+async def upload_group(targets: list[Target], ratelimit: Optional[int] = None, full: bool = False) -> None:
+    """
+    Upload the repositories of all targets sharing a local repository and rclone upload path.
+    Targets due a full sync are synced one by one. For all others, the new and changed files are copied
+    by a single rclone process (segments before the index and hints which reference them),
+    then files removed by borg (e.g. by compact) are deleted from the remote.
+    """
+    repo = targets[0].repo
+    priority = targets[0].priority
+    assert isinstance(repo, LocalRepository)
+    root = remote_root(repo)
+    argv = ['rclone', '-v', '--stats-one-line', '--transfers', str(TRANSFERS)]
+    if ratelimit is not None:
+        argv += ['--bwlimit', f'{ratelimit}K']
+
+    plans = [plan_upload(target, full) for target in targets]
+    started = time.time()
+
+    # Files are hashed while rclone reads them, so they are usually read from the page cache only once
+    def hash_plans() -> list[dict[str, FileHashes]]:
+        return [hash_files(Path(plan.target.borg_repository_path), plan.unhashed) for plan in plans]
+
+    hashing = asyncio.create_task(asyncio.to_thread(hash_plans))
+    try:
+        await _upload_plans(plans, root, repo.path, argv, priority)
+    finally:
+        hashes = await hashing
+
+    for plan, new_hashes in zip(plans, hashes):
+        stale = set(plan.unhashed)
+        kept = {path: digest for path, digest in plan.previous.hashes.items() if path in plan.files}
+        unchanged = {path: digest for path, digest in kept.items() if path not in stale}
+        full_sync = started if plan.full else plan.previous.full_sync
+        write_state(plan.target, UploadState(full_sync, plan.files, {**unchanged, **new_hashes}))
+
+
+async def _upload_plans(
+    plans: list[UploadPlan],
+    root: str,
+    path: str,
+    argv: list[str],
+    priority: PriorityOptions,
+) -> None:
+    for plan in plans:
+        if plan.full:
+            logger.info(f'Full sync of {plan.target.name}')
+            destination = f'{root}/{plan.target.archive.name}'
+            await run_cmd_async([*argv, 'sync', plan.target.borg_repository_path, destination], priority=priority)
+
+    incremental = [plan for plan in plans if not plan.full]
+    changed = [f'{plan.target.archive.name}/{path}' for plan in incremental for path in plan.changed]
+    deleted = [f'{plan.target.archive.name}/{path}' for plan in incremental for path in plan.deleted]
+    if incremental:
+        logger.info(f'{len(changed)} changed and {len(deleted)} deleted file(s) in {len(incremental)} repositories')
+    segments = [path for path in changed if is_segment(path.split('/', 1)[1])]
+    for batch, command in ((segments, 'copy'), (sorted(set(changed) - set(segments)), 'copy'), (deleted, 'delete')):
+        if not batch:
+            continue
+        with tempfile.NamedTemporaryFile('w', prefix='borg-drone-upload-', suffix='.txt') as files_from:
+            files_from.write('\n'.join(batch) + '\n')
+            files_from.flush()
+            if command == 'delete':
+                options = ['--files-from-raw', files_from.name, root]
+            else:
+                options = ['--files-from-raw', files_from.name, '--no-traverse', path, root]
+            await run_cmd_async([*argv, command, *options], priority=priority)
+
+
+@dataclass
+class VerifyResult:
+    """
+    Differences between the remote copy of a repository and the manifest of its last upload
+    """
+    target: Target
+    files: int = 0
+    hashed: int = 0
+    missing: list[str] = field(default_factory=list)
+    truncated: list[str] = field(default_factory=list)
+    modified: list[str] = field(default_factory=list)
+    corrupt: list[str] = field(default_factory=list)
+    unexpected: list[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        """
+        Modification times and unexpected files are reported, but only missing or differing content is a failure
+        """
+        return not (self.missing or self.truncated or self.corrupt)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            'status': 'ok' if self.ok else 'failed',
+            'files': self.files,
+            'hashed': self.hashed,
+            'missing': self.missing,
+            'truncated': self.truncated,
+            'modified': self.modified,
+            'corrupt': self.corrupt,
+            'unexpected': self.unexpected,
+        }
+
+
+def verify_state_file(target: Target) -> Path:
+    return target.config_path / 'verify.json'
+
+
+def read_verify_offset(target: Target) -> int:
+    """
+    Position in the sorted manifest of the next file to hash, so each run checks the files after the previous one
+    """
+    try:
+        return int(json.loads(verify_state_file(target).read_text())['offset'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return 0
+
+
+def write_verify_offset(target: Target, offset: int) -> None:
+    try:
+        atomic_write_text(verify_state_file(target), json.dumps({'offset': offset, 'time': time.time()}))
+    except OSError as ex:
+        logger.warning(f'Unable to save the verification state of {target.name}: {ex}')
+
+
+def rotate_sample(paths: list[str], offset: int, count: int) -> tuple[list[str], int]:
+    """
+    The `count` paths starting at `offset`, wrapping around to the start, and the offset of the following sample
+    """
+    if not paths or count <= 0:
+        return [], offset
+    offset %= len(paths)
+    count = min(count, len(paths))
+    sample = (paths[offset:] + paths[:offset])[:count]
+    return sample, (offset + count) % len(paths)
+
+
+LSJSON_PATTERN = re.compile(r'^[\[\]{]')
+HASHSUM_PATTERN = re.compile(r'^([0-9a-fA-F]+|UNSUPPORTED) {2}(.*)$')
+MODTIME_PATTERN = re.compile(r'^(.*T\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:\d\d)?$')
+
+
+def parse_modtime(value: str) -> Optional[float]:
+    """
+    Timestamp of an rclone ModTime, which has nanosecond precision that datetime.fromisoformat does not accept
+    """
+    match = MODTIME_PATTERN.match(value)
+    if match is None:
+        return None
+    base, fraction, zone = match.groups()
+    try:
+        timestamp = datetime.fromisoformat(base + (zone or 'Z').replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+    return timestamp + (float(f'0.{fraction}') if fraction else 0.0)
+
+
+async def _rclone_output(argv: list[str], target: Target, pattern: re.Pattern) -> list[str]:
+    """
+    Lines of an rclone listing matching `pattern`. The listing has a line for every file, so it is not logged,
+    but anything else rclone writes (i.e. errors) is.
+    """
+    output = []
+    async for line in execute_async([*argv, '--log-level', 'ERROR'], priority=target.priority):
+        if pattern.match(line):
+            output.append(line)
+        elif line.strip():
+            logger.warning(f'{target.name}: {line}')
+    return output
+
+
+async def verify_upload(target: Target, sample: int = VERIFY_SAMPLE, hash_type: str = 'md5') -> VerifyResult:
+    """
+    Compare the remote copy of the target's repository with the manifest of its last upload.
+    The listing of the remote is checked against the size and modification time of every file, and the stored hashes
+    of `sample` files are compared with the hashes computed during the upload. The sampled files rotate between runs,
+    so every file is hashed eventually. Neither check downloads any data.
+    """
+    assert isinstance(target.repo, LocalRepository)
+    state = read_state(target)
+    result = VerifyResult(target, len(state.files))
+    if not state.files:
+        raise RuntimeError(f'{target.name} has not been uploaded yet')
+    root = f'{remote_root(target.repo)}/{target.archive.name}'
+
+    output = await _rclone_output(['rclone', 'lsjson', '--recursive', '--files-only', root], target, LSJSON_PATTERN)
+    remote = {entry['Path']: entry for entry in json.loads('\n'.join(output) or '[]')}
+    for path, (size, mtime_ns) in sorted(state.files.items()):
+        entry = remote.get(path)
+        if entry is None:
+            result.missing.append(path)
+        elif entry['Size'] != size:
+            result.truncated.append(path)
+        else:
+            modtime = parse_modtime(entry.get('ModTime', ''))
+            if modtime is None or abs(modtime - mtime_ns / 1e9) > MODTIME_WINDOW:
+                result.modified.append(path)
+    result.unexpected = sorted(path for path in remote if path not in state.files)
+
+    # Files already known to differ are not hashed, segments are preferred as they hold the archive data
+    bad = set(result.missing + result.truncated)
+    candidates = sorted(path for path in state.hashes if path in state.files and path not in bad)
+    candidates.sort(key=lambda path: not is_segment(path))
+    offset = read_verify_offset(target)
+    paths, next_offset = rotate_sample(candidates, offset, sample)
+    if paths:
+        index = HASH_TYPES.index(hash_type)
+        with tempfile.NamedTemporaryFile('w', prefix='borg-drone-verify-', suffix='.txt') as files_from:
+            files_from.write('\n'.join(paths) + '\n')
+            files_from.flush()
+            argv = ['rclone', 'hashsum', hash_type, '--files-from-raw', files_from.name, root]
+            output = await _rclone_output(argv, target, HASHSUM_PATTERN)
+        remote_hashes = {}
+        for line in output:
+            match = HASHSUM_PATTERN.match(line)
+            assert match is not None
+            remote_hashes[match.group(2)] = match.group(1).lower()
+        for path in paths:
+            digest = remote_hashes.get(path, 'unsupported')
+            if digest == 'unsupported':
+                logger.warning(f'{target.name}: no {hash_type} hash of {path} is available from the remote')
+                continue
+            result.hashed += 1
+            if digest != state.hashes[path][index]:
+                result.corrupt.append(path)
+    write_verify_offset(target, next_offset)
+    return result
@@ -1,119 +1,224 @@
-import subprocess
+import asyncio
+import os
+import shutil
 from json import JSONEncoder
 from pathlib import Path
-from subprocess import Popen, PIPE, STDOUT, DEVNULL, CalledProcessError
+from subprocess import PIPE, STDOUT, CalledProcessError
 from typing import Any, Callable, TypeVar, Optional
 from dataclasses import asdict
 import logging
 
 from typing_extensions import ParamSpec
 
-from .config import ConfigValidationError, read_config, PruneOptions, Target
-from .types import StringGenerator, EnvironmentMap, TargetTuple
+from .log import Colour
+from .output import CHUNK_SIZE, LineSplitter, OutputLog
+from .config import ConfigValidationError, read_index, PriorityOptions, PruneOptions, RateLimit, Target
+from .ssh import record_connection
+from .types import AsyncLinesGenerator, AsyncStringGenerator, StringGenerator, EnvironmentMap, TargetTuple
 
 logger = logging.getLogger(__package__)
 
 
-class Colour:
-    RESET = '\x1b[0m'
-    GREY = '\x1b[38;20m'
-    DARK_GREY = '\x1b[90;20m'
-    YELLOW = '\x1b[33;20m'
-    RED = '\x1b[31;20m'
-    BOLD_RED = '\x1b[31;1m'
-    GREEN = '\x1b[32;20m'
-
-
-class ColourLogFormatter(logging.Formatter):
-    datefmt = '%Y-%m-%d %H:%M:%S'
-    fmt = '%(asctime)s │ %(levelname)s │ %(message)s'
-
-    def __init__(self) -> None:
-        super().__init__()
-        self.formatters = {
-            logging.DEBUG: self.mkformat(Colour.DARK_GREY),
-            logging.INFO: self.mkformat(Colour.GREY),
-            logging.WARNING: self.mkformat(Colour.YELLOW),
-            logging.ERROR: self.mkformat(Colour.RED),
-            logging.CRITICAL: self.mkformat(Colour.BOLD_RED),
-        }
-
-    @classmethod
-    def mkformat(cls, colour: str) -> logging.Formatter:
-        asctime = f'{colour}%(asctime)s{Colour.RESET}'
-        levelname = f'{colour}%(levelname)-7s{Colour.RESET}'
-        message = f'{colour}%(message)s{Colour.RESET}'
-        return logging.Formatter(cls.fmt % locals(), datefmt=cls.datefmt)
-
-    def format(self, record: logging.LogRecord) -> str:
-        return self.formatters[record.levelno].format(record)
-
-
-def setup_logging(debug: bool = False) -> None:
-    level = logging.DEBUG if debug else logging.INFO
-    logger.setLevel(level)
-    ch = logging.StreamHandler()
-    ch.setLevel(level)
-    ch.setFormatter(ColourLogFormatter())
-    logger.addHandler(ch)
-
-
-def execute(cmd: list[str], env: EnvironmentMap = None, stderr: int = STDOUT) -> StringGenerator:
+def priority_argv(cmd: list[str], priority: PriorityOptions) -> list[str]:
+    """
+    Wrap a command with ionice if an IO priority is configured
+    """
+    if priority.ionice_class is None and priority.ionice_level is None:
+        return cmd
+    if shutil.which('ionice') is None:
+        logger.warning('Unable to locate ionice executable, IO priority will not be set')
+        return cmd
+    argv = ['ionice', '-t']
+    if priority.ionice_class is not None:
+        argv += ['-c', str(PriorityOptions.IONICE_CLASSES[priority.ionice_class])]
+    if priority.ionice_level is not None:
+        argv += ['-n', str(priority.ionice_level)]
+    return argv + cmd
+
+
+def priority_preexec(priority: PriorityOptions) -> Optional[Callable[[], None]]:
+    """
+    Return a function to be called in the child process which sets its CPU priority and affinity
+    """
+    nice = priority.nice
+    cpu_affinity = priority.cpu_affinity
+    if cpu_affinity is not None and not hasattr(os, 'sched_setaffinity'):
+        logger.warning('CPU affinity is not supported on this platform')
+        cpu_affinity = None
+    if nice is None and cpu_affinity is None:
+        return None
+
+    def preexec() -> None:
+        if nice is not None:
+            os.nice(nice - os.nice(0))
+        if cpu_affinity is not None:
+            os.sched_setaffinity(0, cpu_affinity)
+
+    return preexec
+
+
+async def execute_batches_async(
+    cmd: list[str],
+    env: EnvironmentMap = None,
+    stderr: int = STDOUT,
+    priority: Optional[PriorityOptions] = None,
+    spill: bool = False,
+) -> AsyncLinesGenerator:
+    """
+    Run a command and yield the lines of its output in batches, as they are produced.
+    Output is read in large binary chunks and only a bounded tail is retained for error reporting.
+    With spill=True, the complete output of a failed command is kept in a temporary file.
+    Raises CalledProcessError if the command exits with a non-zero return code.
+    """
     logger.info('> ' + ' '.join(cmd))
     for var, value in (env or {}).items():
         logger.debug(f'>  ENV: {var} = {value}')
-    with Popen(cmd, stdout=PIPE, stderr=stderr, universal_newlines=True, env=env) as proc:
-        while True:
-            if proc.stdout is None:
-                break
-            line = proc.stdout.readline()
-            if not line:
-                break
-            yield line.strip()
+    record_connection(env)
+    argv, preexec_fn = cmd, None
+    if priority:
+        logger.debug(f'>  PRIORITY: {priority}')
+        argv, preexec_fn = priority_argv(cmd, priority), priority_preexec(priority)
+    proc = await asyncio.create_subprocess_exec(
+        *argv,
+        stdout=PIPE,
+        stderr=stderr,
+        env=env,
+        preexec_fn=preexec_fn,
+        # Bounds the data buffered from the pipe before reading from the child is paused
+        limit=CHUNK_SIZE,
+    )
+    output = OutputLog(spill=spill)
+    spill_file = None
+    try:
         if proc.stdout is not None:
-            proc.stdout.close()
-        return_code = proc.wait()
-        if return_code:
-            raise CalledProcessError(return_code, ' '.join(cmd))
+            splitter = LineSplitter()
+            while chunk := await proc.stdout.read(CHUNK_SIZE):
+                lines = splitter.feed(chunk)
+                output.write(chunk, lines)
+                if lines:
+                    yield lines
+            lines = splitter.flush()
+            output.write(b'', lines)
+            if lines:
+                yield lines
+        return_code = await proc.wait()
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        spill_file = output.close(keep=proc.returncode != 0)
+    if return_code:
+        if spill_file is not None:
+            logger.error(f'Complete output saved to {spill_file}')
+        raise CalledProcessError(return_code, ' '.join(cmd), output=str(output))
     logger.info(f'{Colour.GREEN}Command executed successfully{Colour.RESET}\n')
 
 
-def run_cmd(cmd: list[str], env: EnvironmentMap = None, stderr: int = STDOUT) -> list[str]:
+async def execute_async(
+    cmd: list[str],
+    env: EnvironmentMap = None,
+    stderr: int = STDOUT,
+    priority: Optional[PriorityOptions] = None,
+    spill: bool = False,
+) -> AsyncStringGenerator:
+    """
+    Run a command and yield each line of its output as it is produced.
+    Many commands may be supervised concurrently from a single event loop.
+    Raises CalledProcessError if the command exits with a non-zero return code.
+    """
+    async for lines in execute_batches_async(cmd, env, stderr, priority, spill):
+        for line in lines:
+            yield line
+
+
+async def run_cmd_async(
+    cmd: list[str],
+    env: EnvironmentMap = None,
+    stderr: int = STDOUT,
+    priority: Optional[PriorityOptions] = None,
+    capture: bool = False,
+    spill: bool = False,
+) -> list[str]:
+    """
+    Run a command, logging its output.
+    The output is only returned when capture=True, otherwise it is not kept in memory.
+    """
+    output = []
+    async for lines in execute_batches_async(cmd, env, stderr, priority, spill):
+        for line in lines:
+            logger.info(line)
+        if capture:
+            output += lines
+    return output
+
+
+def execute(
+    cmd: list[str],
+    env: EnvironmentMap = None,
+    stderr: int = STDOUT,
+    priority: Optional[PriorityOptions] = None,
+    spill: bool = False,
+) -> StringGenerator:
+    """
+    Blocking interface to execute_async, driven by a private event loop
+    """
+    loop = asyncio.new_event_loop()
+    batches = execute_batches_async(cmd, env, stderr, priority, spill)
+    try:
+        while True:
+            try:
+                yield from loop.run_until_complete(batches.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(batches.aclose())
+        loop.close()
+
+
+def run_cmd(
+    cmd: list[str],
+    env: EnvironmentMap = None,
+    stderr: int = STDOUT,
+    priority: Optional[PriorityOptions] = None,
+    capture: bool = False,
+    spill: bool = False,
+) -> list[str]:
+    """
+    Blocking interface to run_cmd_async
+    """
     output = []
-    for line in execute(cmd, env, stderr):
+    for line in execute(cmd, env, stderr, priority, spill):
         logger.info(line)
-        output.append(line)
+        if capture:
+            output.append(line)
     return output
 
 
 def get_targets(config_file: Path, sync_target: TargetTuple = None) -> list[Target]:
-    targets = read_config(config_file)
-    if sync_target is None:
-        return targets
-    archive, repo = sync_target
-    if archive:
-        targets = [t for t in targets if t.archive.name == archive]
-    if repo:
-        targets = [t for t in targets if t.repo.name == repo]
-    if not targets:
+    targets = read_index(config_file, sync_target).select(sync_target)
+    if sync_target is not None and not targets:
         raise ConfigValidationError([f'No targets found matching {":".join(sync_target)}'])
     return targets
 
 
-def update_ssh_known_hosts(hostname: str) -> None:
-    ssh_dir = Path.home() / '.ssh'
-    ssh_dir.mkdir(mode=700, exist_ok=True)
-    known_hosts = ssh_dir / 'known_hosts'
-    if not known_hosts.exists():
-        known_hosts.touch(mode=600, exist_ok=True)
-    with known_hosts.open() as f:
-        matched = [line for line in f if line.split(' ')[0] == hostname]
-    if not matched:
-        lines = run_cmd(['ssh-keyscan', '-H', hostname], stderr=DEVNULL)
-        if lines:
-            host_keys = '\n'.join(lines)
-            with known_hosts.open('a') as f:
-                f.write(f'\n{host_keys}')
+def atomic_write_bytes(file: Path, data: bytes) -> None:
+    """
+    Replace a file in a single step, so readers never see a partial file.
+    The data is written to a temporary file next to it, which is removed again if anything fails.
+    Raises OSError, callers decide how loudly to report it.
+    """
+    tmp = file.with_name(f'.{file.name}.{os.getpid()}.tmp')
+    try:
+        file.parent.mkdir(parents=True, exist_ok=True)
+        tmp.write_bytes(data)
+        os.replace(tmp, file)
+    except OSError:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def atomic_write_text(file: Path, text: str) -> None:
+    atomic_write_bytes(file, text.encode())
 
 
 class CustomJSONEncoder(JSONEncoder):
@@ -121,6 +226,11 @@ class CustomJSONEncoder(JSONEncoder):
     def default(self, o: Any) -> Any:
         if isinstance(o, PruneOptions):
             return [{k: v} for k, v in asdict(o).items() if v is not None]
+        if isinstance(o, PriorityOptions):
+            return {k: v for k, v in asdict(o).items() if v is not None}
+        if isinstance(o, RateLimit):
+            schedule = [{'start': f'{x.start:%H:%M}', 'end': f'{x.end:%H:%M}', 'rate': x.rate} for x in o.schedule]
+            return {'default': o.default, 'schedule': schedule}
         return super().default(o)
 
 
@@ -134,9 +244,8 @@ def require_borg(fn: Callable[P, T]) -> Callable[P, Optional[T]]:
     """
 
     def wrapped(*args: P.args, **kwargs: P.kwargs) -> Optional[T]:
-        try:
-            subprocess.run(['borg', '-V'], capture_output=True)
-        except FileNotFoundError:
+        from .tools import find_tool
+        if find_tool('borg') is None:
             logger.error('Unable to locate borg executable')
             return None
         return fn(*args, **kwargs)
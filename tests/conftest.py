@@ -1,12 +1,68 @@
-from dataclasses import asdict
+import os
+import sys
+from dataclasses import replace
 from pathlib import Path
+from typing import Callable
 
 import yaml
 import pytest
 
+from borg_drone import config
 from borg_drone.config import Archive, LocalRepository, RemoteRepository, PruneOptions, Target
 
 
+@pytest.fixture(autouse=True)
+def config_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    path = tmp_path / 'config'
+    monkeypatch.setattr(config, 'CONFIG_PATH', path)
+    return path
+
+
+@pytest.fixture(autouse=True)
+def config_cache_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    path = tmp_path / 'cache'
+    monkeypatch.setattr(config, 'CONFIG_CACHE_PATH', path)
+    return path
+
+
+@pytest.fixture(autouse=True)
+def history_file(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    from borg_drone import history
+    path = tmp_path / 'history.sqlite3'
+    monkeypatch.setattr(history, 'HISTORY_FILE', path)
+    return path
+
+
+FakeExecutable = Callable[..., Path]
+
+
+@pytest.fixture
+def fake_executable(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> FakeExecutable:
+    """
+    Factory for fake external tools: writes a script to tmp_path/bin, which is put first on PATH.
+    The script is formatted with `python` (the running interpreter) and the keyword arguments.
+    """
+    directory = tmp_path / 'bin'
+    monkeypatch.setenv('PATH', f'{directory}:{os.environ["PATH"]}')
+
+    def create(name: str, script: str, **values: str) -> Path:
+        directory.mkdir(exist_ok=True)
+        path = directory / name
+        path.write_text(script.format(python=sys.executable, **values))
+        path.chmod(0o755)
+        return path
+
+    return create
+
+
+@pytest.fixture(autouse=True)
+def tool_registry(monkeypatch: pytest.MonkeyPatch):
+    from borg_drone import tools
+    registry = tools.ToolRegistry()
+    monkeypatch.setattr(tools, 'registry', registry)
+    return registry
+
+
 @pytest.fixture
 def local_repository_usb():
     return LocalRepository(
@@ -45,9 +101,11 @@ def remote_repository_offsite():
 
 @pytest.fixture
 def remote_repository_offsite_with_overrides(remote_repository_offsite):
-    attrs = asdict(remote_repository_offsite)
-    attrs['prune'] = PruneOptions(keep_daily=1, keep_monthly=2)
-    return RemoteRepository(**dict(attrs, encryption='encryption_override'))
+    return replace(
+        remote_repository_offsite,
+        prune=PruneOptions(keep_daily=1, keep_monthly=2),
+        encryption='encryption_override',
+    )
 
 
 @pytest.fixture
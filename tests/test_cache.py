@@ -0,0 +1,87 @@
+import json
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from borg_drone import command
+from borg_drone.cache import claim_refresh, invalidate_results, read_result, release_refresh, write_result
+from borg_drone.config import Target
+
+from .conftest import FakeExecutable
+
+FAKE_BORG = '''#!{python}
+import json, sys
+with open({calls!r}, 'a') as f:
+    f.write(sys.argv[1] + '\\n')
+print(json.dumps({{'type': 'log_message', 'levelname': 'INFO', 'message': 'hello'}}), file=sys.stderr, flush=True)
+print(json.dumps({{'repository': {{'location': sys.argv[1]}}}}, indent=4))
+'''
+
+
+def test_result_cache(expected_targets: list[Target], config_path: Path):
+    target = expected_targets[0]
+    assert read_result(target, 'info') is None
+    write_result(target, 'info', {'archives': []})
+    cached = read_result(target, 'info')
+    assert cached is not None
+    assert cached.data == {'archives': []}
+    assert cached.age < 1
+    assert target.config_path.is_relative_to(config_path)
+
+    invalidate_results(target)
+    assert read_result(target, 'info') is None
+
+    assert claim_refresh(target, 'info')
+    assert not claim_refresh(target, 'info')
+    release_refresh(target, 'info')
+    assert claim_refresh(target, 'info')
+
+
+def test_cached_results(
+    expected_targets: list[Target],
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    fake_executable: FakeExecutable,
+):
+    calls = tmp_path / 'calls'
+    fake_executable('borg', FAKE_BORG, calls=str(calls))
+    targets = [expected_targets[0], expected_targets[3]]
+    for target in targets:
+        target.environment['PATH'] = os.environ['PATH']
+    refreshed = []
+    monkeypatch.setattr(command, '_background_refresh', lambda config_file, t, kind: refreshed.append(t.name))
+
+    def cached_results(cached: bool = True, max_age: int = 300) -> dict:
+        return command._cached_results(tmp_path / 'config.yml', targets, 'info', ['borg', 'info'], cached, max_age)
+
+    expected = {t.name: {'repository': {'location': 'info'}} for t in targets}
+    assert cached_results() == expected
+    assert calls.read_text().splitlines() == ['info', 'info']
+
+    # Fresh results are answered from the cache
+    start = time.monotonic()
+    assert cached_results() == expected
+    assert time.monotonic() - start < 0.1
+    assert len(calls.read_text().splitlines()) == 2
+
+    # Stale results are answered from the cache and refreshed in the background
+    assert cached_results(max_age=-1) == expected
+    assert refreshed == ['archive1:usb', 'archive2:usb']
+
+    # Only the background refresh releases the marker claimed for it
+    assert claim_refresh(targets[0], 'info')
+    assert cached_results(cached=False) == expected
+    assert not claim_refresh(targets[0], 'info')
+    command._cached_results(tmp_path / 'config.yml', targets, 'info', ['borg', 'info'], refresh=True)
+    assert claim_refresh(targets[0], 'info')
+    release_refresh(targets[0], 'info')
+
+    # Without the cache the repository is always queried, invalidated results are queried again
+    assert cached_results(cached=False) == expected
+    invalidate_results(targets[0])
+    assert cached_results() == expected
+    assert len(calls.read_text().splitlines()) == 9
+    cache_file = targets[0].config_path / 'results' / 'info.json'
+    assert json.loads(cache_file.read_text())['data'] == expected['archive1:usb']
@@ -1,9 +1,14 @@
+import os
 from pathlib import Path
 
+import pytest
+import yaml
 from pytest import CaptureFixture
 
 from borg_drone import command
-from borg_drone.config import RemoteRepository, LocalRepository
+from borg_drone.config import RemoteRepository, LocalRepository, Target
+
+from .conftest import FakeExecutable
 
 
 def test_targets_command(
@@ -38,3 +43,171 @@ def test_targets_command(
             '\n',
         ))
     return
+
+
+FAKE_BORG = '''#!{python}
+import json, sys
+if sys.argv[1] == 'create':
+    assert {{'--log-json', '--progress', '--json'}} <= set(sys.argv)
+    progress = {{'type': 'archive_progress', 'original_size': 10, 'compressed_size': 5, 'deduplicated_size': 1,
+                 'nfiles': 1, 'path': '/data/a', 'time': 0}}
+    print(json.dumps(progress), file=sys.stderr, flush=True)
+    stats = {{'original_size': 10, 'compressed_size': 5, 'deduplicated_size': 1, 'nfiles': 1}}
+    print(json.dumps({{'archive': {{'name': 'archive', 'duration': 1.5, 'stats': stats}}}}, indent=4))
+'''
+
+
+def test_create_stage_stats(expected_targets: list[Target], fake_executable: FakeExecutable):
+    import asyncio
+    from borg_drone.progress import ArchiveStats, ProgressView
+    fake_executable('borg', FAKE_BORG)
+    target = expected_targets[0]
+    target.environment['PATH'] = os.environ['PATH']
+
+    view = ProgressView()
+    stats = asyncio.run(command._create_stage(target, view=view))
+    assert stats == ArchiveStats('archive', 10, 5, 1, 1, 1.5)
+    assert view.progress == {}
+
+
+FAKE_BORG_QUERY = '''#!{python}
+import json, os, sys, time
+if sys.argv[1] == '-V':
+    sys.exit()
+time.sleep(0.3)
+repo = os.environ['BORG_REPO']
+if sys.argv[1] == 'check':
+    failed = repo.endswith('archive2')
+    message = {{'type': 'log_message', 'levelname': 'ERROR' if failed else 'INFO', 'message': 'checked ' + repo}}
+    print(json.dumps(message), file=sys.stderr, flush=True)
+    sys.exit(1 if failed else 0)
+archives = [{{'name': 'a1', 'start': '2024-01-01'}}]
+print(json.dumps({{'repository': {{'location': repo}}, 'archives': archives}}, indent=4))
+'''
+
+
+def test_read_only_commands_concurrent(
+    config_file: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    capfd: CaptureFixture,
+    fake_executable: FakeExecutable,
+):
+    import json
+    import time
+    from borg_drone.types import OutputFormat
+    from borg_drone.util import get_targets
+    fake_executable('borg', FAKE_BORG_QUERY)
+    targets = get_targets(config_file)
+    for target in targets:
+        target.environment['PATH'] = os.environ['PATH']
+    monkeypatch.setattr(command, 'get_targets', lambda config_file, sync_target: targets)
+
+    start = time.monotonic()
+    command.info_command(config_file, ('', ''), jobs=4, output=OutputFormat.json)
+    assert time.monotonic() - start < 1.0
+    out, _ = capfd.readouterr()
+    archives = [{'name': 'a1', 'start': '2024-01-01'}]
+    assert json.loads(out) == {
+        t.name: {
+            'repository': {
+                'location': t.borg_repository_path
+            },
+            'archives': archives,
+        }
+        for t in targets
+    }
+
+    command.list_command(config_file, ('', ''), output=OutputFormat.text)
+    out, _ = capfd.readouterr()
+    assert out.startswith('archive1:usb\n\tarchives  │ 1\n\t2024-01-01│ a1\n\n')
+
+    with pytest.raises(RuntimeError, match='2 target'):
+        command.check_command(config_file, ('', ''), output=OutputFormat.yaml)
+    out, _ = capfd.readouterr()
+    results = yaml.safe_load(out)
+    assert list(results) == [t.name for t in targets]
+    assert results['archive1:usb'] == {'status': 'ok', 'messages': []}
+    assert results['archive2:usb']['output'] == ['checked /path/to/usb/archive2']
+
+
+def test_create_skip_if_unchanged(
+    local_repository_usb: LocalRepository,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    fake_executable: FakeExecutable,
+):
+    from dataclasses import replace
+    from borg_drone.config import Archive
+    fake_executable('borg', FAKE_BORG)
+    source = tmp_path / 'src'
+    source.mkdir()
+    (source / 'file').write_text('data')
+    archive = Archive(name='archive', paths=[str(source)], skip_if_unchanged=True)
+    target = Target(archive, replace(local_repository_usb, prune=None))
+    target.environment['PATH'] = os.environ['PATH']
+    monkeypatch.setattr(command, 'get_targets', lambda config_file, sync_target: [target])
+
+    assert list(command.create_command(tmp_path / 'config.yml', None)) == [target.name]
+    assert command.create_command(tmp_path / 'config.yml', None) == {}
+    (source / 'new').touch()
+    assert list(command.create_command(tmp_path / 'config.yml', None)) == [target.name]
+
+
+FAKE_BORG_2 = '''#!{python}
+import json, os, sys
+if sys.argv[1] == '-V':
+    print('borg 2.0.0')
+    sys.exit()
+with open({calls!r}, 'a') as f:
+    f.write(json.dumps([os.environ['BORG_REPO'], *sys.argv[1:]]) + '\\n')
+'''
+
+
+def test_create_fanout_transfer(
+    local_repository_usb: LocalRepository,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    fake_executable: FakeExecutable,
+):
+    import json
+    from dataclasses import replace
+    from borg_drone.config import Archive
+    calls = tmp_path / 'calls'
+    fake_executable('borg', FAKE_BORG_2, calls=str(calls))
+    archive = Archive(name='archive', paths=['/data'], fanout='transfer')
+    primary = Target(archive, replace(local_repository_usb, prune=None))
+    secondary = Target(archive, replace(local_repository_usb, name='usb2', path='/path/to/usb2', prune=None))
+    secondary.replicate_from(primary)
+    targets = [secondary, primary]
+    for target in targets:
+        target.environment['PATH'] = os.environ['PATH']
+    monkeypatch.setattr(command, 'get_targets', lambda config_file, sync_target: targets)
+
+    command.create_command(tmp_path / 'config.yml', None, jobs=2)
+    commands = [json.loads(line)[:3] for line in calls.read_text().splitlines()]
+    assert commands == [
+        ['/path/to/usb/archive', 'create', '--log-json'],
+        ['/path/to/usb2/archive', 'transfer', '--other-repo'],
+    ]
+    assert json.loads(calls.read_text().splitlines()[1])[3] == '/path/to/usb/archive'
+
+
+def test_query_commands_borg_2(
+    local_repository_usb: LocalRepository,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    fake_executable: FakeExecutable,
+):
+    import json
+    from borg_drone.config import Archive
+    from borg_drone.types import OutputFormat
+    calls = tmp_path / 'calls'
+    fake_executable('borg', FAKE_BORG_2, calls=str(calls))
+    target = Target(Archive(name='archive', paths=['/data']), local_repository_usb)
+    target.environment['PATH'] = os.environ['PATH']
+    monkeypatch.setattr(command, 'get_targets', lambda config_file, sync_target: [target])
+
+    command.info_command(tmp_path / 'config.yml', ('', ''), output=OutputFormat.json)
+    command.list_command(tmp_path / 'config.yml', ('', ''), output=OutputFormat.json)
+    commands = [json.loads(line)[1] for line in calls.read_text().splitlines()]
+    assert commands == ['repo-info', 'repo-list']
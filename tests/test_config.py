@@ -1,8 +1,213 @@
+from datetime import datetime
 from pathlib import Path
 
+import pytest
+import yaml
+
 from borg_drone.config import Target
 
 
 def test_parse_config(config_file: Path, expected_targets: list[Target]):
     from borg_drone.config import parse_config
     assert parse_config(config_file) == expected_targets
+
+
+def test_parse_config_priority(config_data: dict, tmp_path: Path):
+    from borg_drone.config import parse_config, PriorityOptions
+    config_data['archives']['archive1']['priority'] = {'nice': 10, 'ionice_class': 'idle'}
+    config_data['repositories']['remote']['offsite']['priority'] = {'nice': 19}
+    file = tmp_path / 'config.yml'
+    file.write_text(yaml.dump(config_data))
+
+    priorities = {t.name: t.priority for t in parse_config(file)}
+    assert priorities == {
+        'archive1:usb': PriorityOptions(nice=10, ionice_class='idle'),
+        'archive1:offsite': PriorityOptions(nice=19, ionice_class='idle'),
+        'archive2:offsite': PriorityOptions(nice=19),
+        'archive2:usb': PriorityOptions(),
+    }
+
+
+@pytest.mark.parametrize(
+    'value, expected', [
+        (None, None),
+        (False, None),
+        (0, None),
+        ('off', None),
+        (1024, 1024),
+        ('500', 500),
+        ('500K', 500),
+        ('500B', 1),
+        ('4096B/s', 4),
+        ('2M', 2048),
+        ('2MiB', 2048),
+        ('20Mbit', 2441),
+        ('20 Mbit/s', 2441),
+        ('20Mbps', 2441),
+        ('10Mb', 1220),
+        ('10MB/s', 10240),
+        ('10MBps', 10240),
+    ])
+def test_parse_rate(value, expected):
+    from borg_drone.config import parse_rate
+    assert parse_rate(value) == expected
+
+
+def test_rate_limit_schedule():
+    from borg_drone.config import RateLimit
+    ratelimit = RateLimit.from_yaml(
+        {
+            'default': '1M',
+            'schedule': [
+                {'start': '08:00', 'end': 1080, 'rate': '20Mbit'},
+                {'start': '22:00', 'end': '02:00', 'rate': 'off'},
+            ]
+        })  # yapf: disable
+    assert ratelimit.current(datetime(2024, 1, 1, 9, 30)) == 2441
+    assert ratelimit.current(datetime(2024, 1, 1, 18, 0)) == 1024
+    assert ratelimit.current(datetime(2024, 1, 1, 23, 0)) is None
+    assert ratelimit.current(datetime(2024, 1, 1, 1, 0)) is None
+    assert ratelimit.current(datetime(2024, 1, 1, 3, 0)) == 1024
+
+
+def test_read_config_cache(
+    config_file: Path,
+    config_cache_path: Path,
+    expected_targets: list[Target],
+    monkeypatch: pytest.MonkeyPatch,
+):
+    from borg_drone import config
+    assert config.read_config(config_file) == expected_targets
+    assert len(list(config_cache_path.glob('*.pickle'))) == 1
+
+    # Unchanged file is read from the cache without parsing
+    with monkeypatch.context() as m:
+        m.setattr(config, 'parse_config_text', lambda text: pytest.fail('configuration was parsed'))
+        assert config.read_config(config_file) == expected_targets
+
+    # Changed file is parsed again
+    config_file.write_text(config_file.read_text().replace('/path/to/usb', '/path/to/other'))
+    assert config.read_config(config_file)[0].repo.url == '/path/to/other'
+
+
+def test_target_index(expected_targets: list[Target]):
+    from borg_drone.config import TargetIndex
+    index = TargetIndex(expected_targets)
+    assert index.select() == expected_targets
+    assert index.select(('', '')) == expected_targets
+    assert index.select(('archive1', '')) == expected_targets[:2]
+    assert index.select(('', 'usb')) == [expected_targets[0], expected_targets[3]]
+    assert index.select(('archive2', 'offsite')) == [expected_targets[2]]
+    assert index.select(('archive2', 'missing')) == []
+    assert index.select(('missing', '')) == []
+
+
+def test_target_index_no_filesystem_access(archive1, local_repository_usb, monkeypatch: pytest.MonkeyPatch):
+    from dataclasses import replace
+    from borg_drone.config import TargetIndex
+    targets = [Target(replace(archive1, name=f'archive{i}'), local_repository_usb) for i in range(10_000)]
+    index = TargetIndex(targets)
+
+    def no_access(*args, **kwargs):
+        pytest.fail('filesystem was accessed')
+
+    monkeypatch.setattr(Path, 'mkdir', no_access)
+    monkeypatch.setattr(Path, 'exists', no_access)
+    monkeypatch.setattr(Path, 'stat', no_access)
+    target, = index.select(('archive9999', 'usb'))
+    assert target.environment['BORG_REPO'] == '/path/to/usb/archive9999'
+    assert target.password_file.name == 'passwd'
+
+
+def test_read_index_selective(
+    config_file: Path,
+    config_data: dict,
+    config_cache_path: Path,
+    expected_targets: list[Target],
+    monkeypatch: pytest.MonkeyPatch,
+):
+    import yaml
+    from borg_drone import config
+    from borg_drone.util import get_targets
+
+    # Errors in archives which are not selected are not reported, and the partial index is cached for the selector
+    config_data['archives']['broken'] = {'paths': '/not/a/list'}
+    config_file.write_text(yaml.dump(config_data))
+    built = []
+    from_dict = config.Archive.from_dict
+    monkeypatch.setattr(config.Archive, 'from_dict', lambda obj: built.append(obj['name']) or from_dict(obj))
+    assert config.read_index(config_file, ('archive2', 'offsite')).select(('archive2', 'offsite')) == [
+        expected_targets[2]
+    ]
+    assert built == ['archive2']
+    assert config.read_index(config_file, ('missing', '')).targets == []
+    assert len(list(config_cache_path.glob('*.pickle'))) == 2
+    with monkeypatch.context() as m:
+        m.setattr(config, 'parse_config_text', lambda text, sync_target: pytest.fail('configuration was parsed'))
+        index = config.read_index(config_file, ('archive2', 'offsite'))
+        assert index.select(('archive2', 'offsite')) == [expected_targets[2]]
+
+    assert get_targets(config_file, ('', 'offsite')) == [expected_targets[1], expected_targets[2]]
+    with pytest.raises(config.ConfigValidationError) as ex:
+        get_targets(config_file, ('broken', ''))
+    assert ex.value.errors == {'Archive "broken" is missing attribute "repositories"'}
+    with pytest.raises(config.ConfigValidationError):
+        get_targets(config_file)
+
+
+def test_load_config_text_selective(config_data: dict):
+    from copy import deepcopy
+    from borg_drone.config import load_config_text
+    expected = deepcopy(config_data)
+    config_data['repositories']['local']['spare'] = {'path': '/path/to/spare', 'encryption': 'none'}
+    config_data['archives']['unselected'] = 'placeholder'
+
+    # Nodes which are not selected are never constructed, so a tag the safe loader rejects is not an error
+    text = yaml.dump(config_data).replace('unselected: placeholder', 'unselected: !unknown {repositories: [spare]}')
+    data = load_config_text(text, ('archive2', ''))
+    assert data == {**expected, 'archives': {'archive2': expected['archives']['archive2']}}
+    data = load_config_text(text, ('archive1', 'usb'))
+    assert data == {**expected, 'archives': {'archive1': expected['archives']['archive1']}}
+    with pytest.raises(yaml.constructor.ConstructorError):
+        load_config_text(text)
+    with pytest.raises(yaml.constructor.ConstructorError):
+        load_config_text(text, ('', 'usb'))
+
+
+def test_parse_config_fanout(config_data: dict, tmp_path: Path):
+    from borg_drone.config import parse_config
+    config_data['archives']['archive1']['fanout'] = 'sync'
+    config_data['archives']['archive2']['fanout'] = 'transfer'
+    file = tmp_path / 'config.yml'
+    file.write_text(yaml.dump(config_data))
+
+    targets = {t.name: t for t in parse_config(file)}
+    usb, offsite = targets['archive1:usb'], targets['archive1:offsite']
+    assert usb.primary is None
+    assert offsite.primary is usb
+    assert offsite.password_file == usb.password_file
+    assert offsite.environment['BORG_PASSCOMMAND'] == usb.environment['BORG_PASSCOMMAND']
+
+    # yaml.dump sorts the repository mapping, so offsite is listed first
+    primary, secondary = targets['archive2:offsite'], targets['archive2:usb']
+    assert secondary.primary is primary
+    assert secondary.password_file != primary.password_file
+    assert secondary.environment['BORG_OTHER_PASSCOMMAND'] == primary.environment['BORG_PASSCOMMAND']
+
+
+def test_parse_config_profile(config_data: dict, tmp_path: Path):
+    from borg_drone.config import parse_config, PERFORMANCE_PROFILES
+    config_data['archives']['archive1']['profile'] = 'vm-images'
+    config_data['archives']['archive2']['profile'] = 'many-small-files'
+    config_data['archives']['archive2']['repositories']['offsite']['profile'] = 'database-dumps'
+    file = tmp_path / 'config.yml'
+    file.write_text(yaml.dump(config_data))
+
+    targets = {t.name: t for t in parse_config(file)}
+    assert targets['archive1:usb'].profile == PERFORMANCE_PROFILES['vm-images']
+    assert targets['archive1:usb'].profile.argv == [
+        '--chunker-params', 'fixed,4194304', '--files-cache', 'ctime,size', '--checkpoint-interval', '600'
+    ]
+    assert targets['archive2:usb'].environment['BORG_FILES_CACHE_TTL'] == '60'
+    assert targets['archive2:offsite'].profile == PERFORMANCE_PROFILES['database-dumps']
+    assert 'BORG_FILES_CACHE_TTL' not in targets['archive2:offsite'].environment
@@ -225,3 +225,77 @@ def test_validate_config_rclone_upload_path(config_data: dict, upload_path: str,
         assert ex.value.errors == {
             f'Invalid rclone_upload_path "{upload_path}". Path must contain a single colon',
         }
+
+
+def test_validate_config_priority(config_data: dict):
+    test_config = config_data.copy()
+    test_config['archives']['archive1']['priority'] = {'nice': 10, 'ionice_class': 'idle', 'cpu_affinity': [0]}
+    validate_config(test_config)
+
+    test_config['archives']['archive1']['priority'] = {'nice': 30, 'ionice_class': 'lazy', 'ionice_level': 8}
+    test_config['archives']['archive2']['repositories']['offsite']['priority'] = {'bad_option': 1}
+    with pytest.raises(ConfigValidationError) as ex:
+        validate_config(test_config)
+    assert ex.value.errors == {
+        'Invalid nice level for "archive1": 30. Must be between -20 and 19',
+        "Invalid ionice_class for \"archive1\": lazy. Must be one of ['realtime', 'best-effort', 'idle']",
+        'Invalid ionice_level for "archive1": 8. Must be between 0 and 7',
+        "Invalid priority options for \"archive2:offsite\": {'bad_option': 1}",
+    }
+
+
+def test_validate_config_remote_prune_options(config_data: dict):
+    test_config = config_data.copy()
+    test_config['repositories']['remote']['offsite']['prune'] = [{'bad_option': 1}]
+    with pytest.raises(ConfigValidationError) as ex:
+        validate_config(test_config)
+    assert ex.value.errors == {"Invalid prune options: [{'bad_option': 1}]"}
+
+
+def test_validate_config_schema(config_data: dict):
+    test_config = config_data.copy()
+    test_config['archives']['archive1']['exclude'] = '*.tmp'
+    test_config['archives']['archive1']['bananas'] = 1
+    test_config['repositories']['local']['usb']['encryption'] = 'rot13'
+    with pytest.raises(ConfigValidationError) as ex:
+        validate_config(test_config)
+    assert ex.value.errors == {
+        'Invalid value for "archives.archive1.exclude": expected array, got \'*.tmp\'',
+        'Unknown key "archives.archive1.bananas"',
+        "Invalid value for \"repositories.local.usb.encryption\": 'rot13'. Must be one of "
+        "['none', 'authenticated', 'authenticated-blake2', 'repokey', 'repokey-blake2', 'keyfile', 'keyfile-blake2']",
+    }
+
+
+def test_validate_config_fanout(config_data: dict):
+    test_config = config_data.copy()
+    test_config['archives']['archive1']['fanout'] = 'sync'
+    test_config['archives']['archive2']['fanout'] = 'transfer'
+    validate_config(test_config)
+
+    test_config['archives']['archive1']['fanout'] = 'copy'
+    test_config['archives']['archive2']['fanout'] = 'sync'
+    test_config['archives']['archive2']['repositories'] = {'offsite': None, 'usb': None}
+    with pytest.raises(ConfigValidationError) as ex:
+        validate_config(test_config)
+    assert ex.value.errors == {
+        "Invalid fanout for \"archive1\": copy. Must be one of ['sync', 'transfer']",
+        'Archive "archive2" uses fanout: sync, its first repository "offsite" must be local',
+    }
+
+
+def test_validate_config_profile(config_data: dict):
+    test_config = config_data.copy()
+    test_config['archives']['archive1']['profile'] = 'vm-images'
+    test_config['archives']['archive2']['repositories']['offsite']['profile'] = 'database-dumps'
+    validate_config(test_config)
+
+    test_config['archives']['archive1']['profile'] = 'fast'
+    test_config['repositories']['local']['usb']['profile'] = 'slow'
+    with pytest.raises(ConfigValidationError) as ex:
+        validate_config(test_config)
+    profiles = "['vm-images', 'many-small-files', 'database-dumps']"
+    assert ex.value.errors == {
+        f'Invalid profile for "archive1": fast. Must be one of {profiles}',
+        f'Invalid profile for "usb": slow. Must be one of {profiles}',
+    }
@@ -0,0 +1,87 @@
+import os
+from dataclasses import replace
+from pathlib import Path
+
+import pytest
+
+from borg_drone.config import Archive, LocalRepository, Target
+from borg_drone.fingerprint import pattern_matcher, source_fingerprint, target_fingerprint
+
+
+@pytest.fixture
+def source(tmp_path: Path) -> Path:
+    root = tmp_path / 'src'
+    (root / 'a' / 'node_modules').mkdir(parents=True)
+    (root / 'a' / 'file.txt').write_text('a')
+    (root / 'a' / 'node_modules' / 'module.js').write_text('b')
+    (root / 'b.txt').write_text('c')
+    return root
+
+
+def fingerprint(archive: Archive) -> str:
+    result = source_fingerprint(archive)
+    assert result is not None
+    return result.digest
+
+
+def matches(pattern: str, path: str) -> bool:
+    matcher = pattern_matcher(pattern)
+    assert matcher is not None
+    return matcher(path)
+
+
+def test_pattern_matcher():
+    assert matches('**/node_modules', 'home/user/src/node_modules')
+    assert matches('/home/*/.cache', 'home/user/.cache/pip/file')
+    assert not matches('fm:/home/*/.cache', 'home/user/src')
+    assert matches('pp:/var/tmp', 'var/tmp/x')
+    assert not matches('pp:/var/tmp', 'var/tmpfiles')
+    assert matches('re:\\.pyc$', 'src/x.pyc')
+    assert pattern_matcher('sh:**/venv') is None
+
+
+def test_source_fingerprint(source: Path):
+    archive = Archive(name='archive', paths=[str(source)], exclude=['**/node_modules'])
+    result = source_fingerprint(archive)
+    assert result is not None and result.entries == 3
+    digest = result.digest
+    assert fingerprint(archive) == digest
+
+    # Changes to excluded files are ignored
+    (source / 'a' / 'node_modules' / 'module.js').write_text('changed')
+    assert fingerprint(archive) == digest
+
+    st = (source / 'a' / 'file.txt').stat()
+    os.utime(source / 'a' / 'file.txt', ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    assert fingerprint(archive) != digest
+
+    digest = fingerprint(archive)
+    (source / 'a' / 'new.txt').touch()
+    assert fingerprint(archive) != digest
+
+    digest = fingerprint(archive)
+    assert fingerprint(replace(archive, exclude=[])) != digest
+    assert source_fingerprint(archive, limit=2) is None
+
+
+def test_source_fingerprint_missing_path(tmp_path: Path):
+    archive = Archive(name='archive', paths=[str(tmp_path / 'missing')])
+    digest = fingerprint(archive)
+    (tmp_path / 'missing').mkdir()
+    assert fingerprint(archive) != digest
+
+
+def test_target_fingerprint(source: Path, local_repository_usb: LocalRepository):
+    archive = Archive(name='archive', paths=[str(source)])
+    result = source_fingerprint(archive)
+    assert result is not None
+    target = Target(archive, local_repository_usb)
+    digest = target_fingerprint(target, result).digest
+    assert digest != result.digest
+    assert target_fingerprint(Target(archive, local_repository_usb), result).digest == digest
+
+    # A repository override of the compression or profile changes the fingerprint of that target only
+    tuned = Target(archive, replace(local_repository_usb, compression='zstd,10'))
+    assert target_fingerprint(tuned, result).digest != digest
+    profiled = Target(archive, replace(local_repository_usb, profile='vm-images'))
+    assert target_fingerprint(profiled, result).digest != digest
@@ -0,0 +1,84 @@
+from pathlib import Path
+from subprocess import CalledProcessError
+from typing import Optional
+
+import pytest
+from pytest import CaptureFixture
+
+from borg_drone import command
+from borg_drone.config import Target
+from borg_drone.history import connect, record_results, target_stats
+from borg_drone.progress import ArchiveStats
+from borg_drone.scheduler import StageResult
+
+DAY = 86400.0
+
+
+def test_record_results(expected_targets: list[Target], history_file: Path):
+    usb = expected_targets[0]
+    results = [
+        StageResult(usb, 'create', 100.0, 160.0, result=ArchiveStats('archive', 1000, 500, 10, 3, 60.0)),
+        StageResult(usb, 'prune', 160.0, 170.0, CalledProcessError(2, 'borg prune')),
+    ]
+    record_results('create', results)
+    connection = connect(history_file)
+    assert connection.execute('SELECT command, started, finished FROM runs').fetchall() == [('create', 100.0, 170.0)]
+    assert connection.execute('SELECT target, stage, deduplicated_size, exit_code, error FROM stages').fetchall() == [
+        ('archive1:usb', 'create', 10, 0, None),
+        ('archive1:usb', 'prune', None, 2, "Command 'borg prune' returned non-zero exit status 2."),
+    ]
+    plan = connection.execute(
+        'EXPLAIN QUERY PLAN SELECT * FROM stages WHERE stage = ? AND started >= ?', ('create', 0)).fetchall()
+    assert 'USING INDEX' in str(plan)
+
+
+def test_record_results_failure_closes_connection(
+    expected_targets: list[Target],
+    history_file: Path,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    import sqlite3
+    from borg_drone import history
+    connections = []
+
+    def failing_connect(file: Optional[Path] = None) -> sqlite3.Connection:
+        connection = connect(file)
+        connection.execute("CREATE TRIGGER fail BEFORE INSERT ON stages BEGIN SELECT RAISE(ABORT, 'full'); END")
+        connections.append(connection)
+        return connection
+
+    monkeypatch.setattr(history, 'connect', failing_connect)
+    record_results('create', [StageResult(expected_targets[0], 'create', 100.0, 160.0)])
+    with pytest.raises(sqlite3.ProgrammingError):
+        connections[0].execute('SELECT 1')
+
+
+def test_target_stats(expected_targets: list[Target], capfd: CaptureFixture):
+    usb, offsite = expected_targets[0], expected_targets[1]
+    now = 30 * DAY
+    results = []
+    for day, duration, deduplicated in ((1, 10, 100), (2, 30, 100), (20, 20, 300), (21, 500, None)):
+        stats = None if deduplicated is None else ArchiveStats('a', 1000, 500, deduplicated, 1, duration)
+        error = CalledProcessError(1, 'borg create') if deduplicated is None else None
+        results.append(StageResult(usb, 'create', day * DAY, day * DAY + duration, error, stats))
+    results.append(StageResult(offsite, 'create', 25 * DAY, 25 * DAY + 5, result=None))
+    results.append(StageResult(usb, 'create', -5 * DAY, -5 * DAY + 1000))
+    record_results('create', results)
+
+    usb_stats, offsite_stats = target_stats(30, now=now)
+    assert usb_stats.target == 'archive1:usb'
+    assert (usb_stats.runs, usb_stats.failures) == (4, 1)
+    assert usb_stats.median_duration == 20
+    assert usb_stats.max_duration == 30
+    assert round(usb_stats.dedup_ratio, 4) == round(500 / 3000, 4)
+    assert round(usb_stats.dedup_drift, 4) == 0.2
+    assert usb_stats.last_success == 20 * DAY + 20
+    assert offsite_stats.dedup_ratio is None
+    assert [x.target for x in target_stats(30, ('', 'offsite'), now=now)] == ['archive1:offsite']
+    assert target_stats(30, ('archive1', 'missing'), now=now) == []
+
+    command.stats_command(('', 'offsite'), days=36500)
+    out, _ = capfd.readouterr()
+    header, row = out.splitlines()
+    assert header.startswith('target')
+    assert [x.strip() for x in row.split('│')][:5] == ['archive1:offsite', '1', '0', '0m 05s', '0m 05s']
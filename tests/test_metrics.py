@@ -0,0 +1,42 @@
+from pathlib import Path
+from subprocess import CalledProcessError
+
+from borg_drone.config import Target
+from borg_drone.metrics import read_samples, write_metrics
+from borg_drone.progress import ArchiveStats
+from borg_drone.scheduler import StageResult
+
+
+def test_write_metrics(expected_targets: list[Target], tmp_path: Path):
+    metrics_file = tmp_path / 'textfile' / 'borg-drone.prom'
+    usb, offsite = expected_targets[0], expected_targets[1]
+    stats = ArchiveStats('archive', 2000, 1000, 100, 10, 5.0)
+    results = [
+        StageResult(usb, 'create', 100.0, 105.0, result=stats),
+        StageResult(usb, 'prune', 105.0, 106.5),
+        StageResult(offsite, 'create', 100.0, 101.0),
+    ]
+    write_metrics(metrics_file, expected_targets[:2], results)
+    labels = 'target="archive1:usb",archive="archive1",repo="usb"'
+    text = metrics_file.read_text()
+    assert '# TYPE borg_drone_stage_duration_seconds gauge' in text
+    assert f'borg_drone_start_timestamp_seconds{{{labels}}} 100' in text
+    assert f'borg_drone_end_timestamp_seconds{{{labels}}} 106.5' in text
+    assert f'borg_drone_stage_duration_seconds{{{labels},stage="create"}} 5' in text
+    assert f'borg_drone_stage_duration_seconds{{{labels},stage="prune"}} 1.5' in text
+    assert f'borg_drone_deduplicated_bytes{{{labels}}} 100' in text
+    assert f'borg_drone_files{{{labels}}} 10' in text
+    assert f'borg_drone_exit_status{{{labels}}} 0' in text
+    assert f'borg_drone_last_success_timestamp_seconds{{{labels}}} 106.5' in text
+    assert len(read_samples(metrics_file)) == 15
+
+    # A failed run keeps the last success time, and targets which did not run are kept as they were
+    results = [StageResult(usb, 'create', 200.0, 201.0, CalledProcessError(2, 'borg create'))]
+    write_metrics(metrics_file, expected_targets[:1], results)
+    text = metrics_file.read_text()
+    assert f'borg_drone_exit_status{{{labels}}} 2' in text
+    assert f'borg_drone_last_success_timestamp_seconds{{{labels}}} 106.5' in text
+    assert f'borg_drone_deduplicated_bytes{{{labels}}}' not in text
+    offsite_labels = 'target="archive1:offsite",archive="archive1",repo="offsite"'
+    assert f'borg_drone_last_success_timestamp_seconds{{{offsite_labels}}} 101' in text
+    assert [p.name for p in metrics_file.parent.iterdir()] == ['borg-drone.prom']
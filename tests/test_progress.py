@@ -0,0 +1,110 @@
+import io
+import json
+import logging
+
+from borg_drone.log import StatusLine
+from borg_drone.progress import (
+    ArchiveProgress,
+    ArchiveStats,
+    BorgEventParser,
+    LogMessage,
+    ProgressView,
+    format_size,
+)
+
+CREATE_RESULT = {
+    'archive': {
+        'name': '2024-01-01T00:00:00',
+        'duration': 10.0,
+        'stats': {
+            'original_size': 2_000_000,
+            'compressed_size': 1_000_000,
+            'deduplicated_size': 100_000,
+            'nfiles': 50,
+        },
+    },
+    'repository': {
+        'location': '/path/to/usb/archive1'
+    },
+}
+
+
+def test_borg_event_parser():
+    parser = BorgEventParser()
+    parser.started = 100.0
+    lines = [
+        json.dumps({'type': 'log_message', 'levelname': 'WARNING', 'message': 'file changed while we backed it up'}),
+        json.dumps({'type': 'progress_percent', 'message': 'Initializing cache', 'finished': False}),
+        json.dumps(
+            {
+                'type': 'archive_progress',
+                'original_size': 1000,
+                'compressed_size': 500,
+                'deduplicated_size': 100,
+                'nfiles': 10,
+                'path': '/data/file',
+                'time': 102.0,
+            }),
+        json.dumps({'type': 'archive_progress', 'finished': True, 'time': 103.0}),
+        'not json',
+        *json.dumps(CREATE_RESULT, indent=4).splitlines(),
+    ]
+    events = [parser.feed(line) for line in lines]
+    assert [e for e in events if e is not None] == [
+        LogMessage(logging.WARNING, 'file changed while we backed it up'),
+        ArchiveProgress(1000, 500, 100, 10, '/data/file', 2.0),
+        LogMessage(logging.INFO, 'not json'),
+    ]
+    progress = events[2]
+    assert isinstance(progress, ArchiveProgress)
+    assert progress.files_per_second == 5
+    assert progress.bytes_per_second == 500
+    assert progress.compression_ratio == 0.5
+    assert progress.deduplication_ratio == 0.1
+    assert parser.result == CREATE_RESULT
+
+
+def test_archive_stats():
+    stats = ArchiveStats.from_json(CREATE_RESULT)
+    assert stats.bytes_per_second == 200_000
+    assert stats.files_per_second == 5
+    assert stats.deduplication_ratio == 0.05
+    assert str(stats) == (
+        '2024-01-01T00:00:00: 50 files, 2.00 MB original, 1.00 MB compressed, 100.00 kB deduplicated '
+        'in 10.0s (200.00 kB/s, 5 files/s)')
+
+
+def test_format_size():
+    assert format_size(999) == '999 B'
+    assert format_size(1500) == '1.50 kB'
+    assert format_size(2.5e15) == '2.50 PB'
+
+
+class TTY(io.StringIO):
+
+    def isatty(self) -> bool:
+        return True
+
+
+def test_progress_view(monkeypatch):
+    stream = TTY()
+    monkeypatch.setenv('COLUMNS', '200')
+    monkeypatch.setattr('borg_drone.progress.status_line', StatusLine(stream))
+    view = ProgressView(interval=0)
+    view.update('archive1:usb', ArchiveProgress(1000, 500, 100, 10, '/data/file', 2.0))
+    assert stream.getvalue().endswith(
+        '\r\x1b[K[archive1:usb] 10 files │ 1.00 kB │ 100 B deduplicated │ 500 B/s │ 5 files/s │ /data/file')
+    view.update('archive2:usb', ArchiveProgress(3000, 500, 100, 10, '/data/other', 2.0))
+    assert stream.getvalue().endswith(
+        '\r\x1b[K2 targets 20 files │ 4.00 kB │ 200 B deduplicated │ 2.00 kB/s │ 10 files/s')
+    view.finish('archive1:usb')
+    view.finish('archive2:usb')
+    assert stream.getvalue().endswith('\r\x1b[K')
+
+
+def test_status_line_not_interactive():
+    stream = io.StringIO()
+    status = StatusLine(stream)
+    status.update('progress')
+    status.clear()
+    assert stream.getvalue() == ''
@@ -0,0 +1,122 @@
+import asyncio
+from typing import Optional, Union
+
+from borg_drone.config import Archive, LocalRepository, RemoteRepository, Target
+from borg_drone.scheduler import ConcurrencyLimits, Stage, run_pipeline
+
+
+def make_targets(repo: Union[LocalRepository, RemoteRepository], count: int) -> list[Target]:
+    return [Target(archive=Archive(name=f'archive{i}', paths=['/data']), repo=repo) for i in range(count)]
+
+
+class ConcurrencyCounter:
+
+    def __init__(self, delay: float = 0.02, events: Optional[list[str]] = None, name: str = '') -> None:
+        self.delay = delay
+        self.events = events if events is not None else []
+        self.name = name
+        self.current = 0
+        self.peak = 0
+
+    async def __call__(self, target: Target) -> None:
+        self.current += 1
+        self.peak = max(self.peak, self.current)
+        self.events.append(f'{self.name} {target.archive.name}')
+        await asyncio.sleep(self.delay)
+        self.current -= 1
+
+
+def test_run_pipeline_repository_limit(local_repository_usb: LocalRepository):
+    counter = ConcurrencyCounter()
+    # Repository entries with the same path share the borg repository of each archive
+    archive = Archive(name='archive', paths=['/data'])
+    repos = [LocalRepository(**dict(local_repository_usb.to_dict(), name=f'usb{i}')) for i in range(4)]
+    targets = [Target(archive=archive, repo=repo) for repo in repos]
+    results = run_pipeline(targets, [Stage('create', counter, workers=4)], limits=ConcurrencyLimits(per_repository=2))
+    assert [r.error for r in results] == [None] * 4
+    assert counter.peak == 2
+
+    # Each archive has its own borg repository below the repository location
+    counter = ConcurrencyCounter()
+    run_pipeline(make_targets(local_repository_usb, 4), [Stage('create', counter, workers=4)])
+    assert counter.peak == 4
+
+
+def test_run_pipeline_host_limit(remote_repository_offsite: RemoteRepository):
+    counter = ConcurrencyCounter()
+    repos = [RemoteRepository(**dict(remote_repository_offsite.to_dict(), path=f'/repo{i}')) for i in range(4)]
+    targets = [t for repo in repos for t in make_targets(repo, 1)]
+    run_pipeline(targets, [Stage('create', counter, workers=4)], limits=ConcurrencyLimits(per_host=3))
+    assert counter.peak == 3
+
+
+def test_run_pipeline_stage_overlap(local_repository_usb: LocalRepository):
+    events: list[str] = []
+    create = ConcurrencyCounter(0.01, events, 'create')
+    upload = ConcurrencyCounter(0.05, events, 'upload')
+    targets = make_targets(local_repository_usb, 3)
+    results = run_pipeline(targets, [Stage('create', create), Stage('upload', upload, limited=False)])
+
+    assert len(results) == 6
+    assert create.peak == 1
+    assert upload.peak == 1
+    assert [e for e in events if e.startswith('upload')] == ['upload archive0', 'upload archive1', 'upload archive2']
+    # Later creates start while the first upload is still running
+    first_upload = next(r for r in results if r.stage == 'upload')
+    assert all(r.started < first_upload.finished for r in results if r.stage == 'create')
+
+
+def test_run_pipeline_failures(local_repository_usb: LocalRepository):
+    uploaded = []
+
+    async def create(target: Target) -> None:
+        if target.archive.name == 'archive1':
+            raise RuntimeError('failed')
+
+    async def prune(target: Target) -> None:
+        raise AssertionError('prune should not run')
+
+    async def upload(target: Target) -> None:
+        uploaded.append(target.archive.name)
+
+    stages = [
+        Stage('create', create),
+        Stage('prune', prune, applies=lambda t: False),
+        Stage('upload', upload),
+    ]
+    results = run_pipeline(make_targets(local_repository_usb, 3), stages)
+    assert [(r.target.archive.name, r.stage) for r in results if r.error] == [('archive1', 'create')]
+    assert 'prune' not in {r.stage for r in results}
+    assert uploaded == ['archive0', 'archive2']
+
+
+def test_run_pipeline_result(local_repository_usb: LocalRepository):
+
+    async def create(target: Target) -> str:
+        return f'{target.archive.name} created'
+
+    results = run_pipeline(make_targets(local_repository_usb, 2), [Stage('create', create)])
+    assert [r.result for r in results] == ['archive0 created', 'archive1 created']
+
+
+def test_run_pipeline_depends_on(local_repository_usb: LocalRepository):
+    events: list[str] = []
+
+    async def create(target: Target) -> None:
+        await asyncio.sleep(0.02)
+        if target.archive.name == 'archive2':
+            raise RuntimeError('failed')
+        events.append(f'create {target.archive.name}')
+
+    async def replicate(target: Target) -> None:
+        events.append(f'replicate {target.archive.name}')
+
+    stages = [
+        Stage('create', create, workers=4, limited=False, applies=lambda t: t.archive.name in ('archive0', 'archive2')),
+        Stage('replicate', replicate, limited=False, applies=lambda t: t.archive.name in ('archive1', 'archive3')),
+    ]
+    targets = make_targets(local_repository_usb, 4)
+    results = run_pipeline(targets, stages, depends_on={'archive1:usb': 'archive0:usb', 'archive3:usb': 'archive2:usb'})
+    assert events == ['create archive0', 'replicate archive1']
+    failures = [(r.target.archive.name, r.stage, str(r.error)) for r in results if r.error]
+    assert failures == [('archive2', 'create', 'failed'), ('archive3', 'replicate', 'archive2:usb failed')]
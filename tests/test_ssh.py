@@ -0,0 +1,105 @@
+from dataclasses import replace
+from pathlib import Path
+
+import pytest
+
+from borg_drone import ssh
+from borg_drone.config import Archive, RemoteRepository, Target
+from borg_drone.ssh import (
+    ControlMaster,
+    KnownHosts,
+    control_path,
+    hash_hostname,
+    known_hosts_name,
+    record_connection,
+    update_ssh_known_hosts,
+    _masters,
+)
+
+
+def test_control_path(remote_repository_offsite: RemoteRepository):
+    same_connection = replace(remote_repository_offsite, name='other', path='/other')
+    other_key = replace(remote_repository_offsite, ssh_key='~/.ssh/other')
+    assert control_path(remote_repository_offsite) == control_path(same_connection)
+    assert control_path(remote_repository_offsite) != control_path(other_key)
+    assert len(str(control_path(remote_repository_offsite))) < 100
+
+
+def test_environment_borg_rsh(archive1: Archive, remote_repository_offsite: RemoteRepository):
+    path = control_path(remote_repository_offsite)
+    borg_rsh = Target(archive1, remote_repository_offsite).environment['BORG_RSH']
+    assert borg_rsh.startswith('ssh -o VisualHostKey=no -i ~/.ssh/borg ')
+    assert f'-o ControlPath={path}' in borg_rsh
+
+    repo = replace(remote_repository_offsite, ssh_multiplex=False)
+    assert Target(archive1, repo).environment['BORG_RSH'] == 'ssh -o VisualHostKey=no -i ~/.ssh/borg'
+
+
+def test_record_connection(archive1: Archive, remote_repository_offsite: RemoteRepository):
+    path = control_path(remote_repository_offsite)
+    master = ControlMaster(remote_repository_offsite, path)
+    _masters[str(path)] = master
+    try:
+        env = Target(archive1, remote_repository_offsite).environment
+        record_connection(env)
+        record_connection(env)
+        record_connection({'BORG_REPO': '/local'})
+    finally:
+        _masters.pop(str(path))
+    assert master.connections == 2
+
+
+def test_known_hosts(tmp_path: Path):
+    known_hosts = tmp_path / 'known_hosts'
+    known_hosts.write_text(
+        '\n'.join(
+            (
+                '# comment',
+                'plain.example.com,192.0.2.1 ssh-ed25519 AAAA',
+                f'{hash_hostname("hashed.example.com")} ssh-ed25519 AAAA',
+                f'{hash_hostname("[ported.example.com]:2222")} ssh-ed25519 AAAA',
+                '*.wild.example.com,!bad.wild.example.com ssh-ed25519 AAAA',
+                '@revoked revoked.example.com ssh-ed25519 AAAA',
+            )))
+    index = KnownHosts(known_hosts)
+    assert 'plain.example.com' in index
+    assert '192.0.2.1' in index
+    assert 'hashed.example.com' in index
+    assert known_hosts_name('ported.example.com', 2222) in index
+    assert 'ported.example.com' not in index
+    assert 'a.wild.example.com' in index
+    assert 'bad.wild.example.com' not in index
+    assert 'revoked.example.com' not in index
+    assert 'unknown.example.com' not in index
+
+
+def test_update_ssh_known_hosts(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(Path, 'home', lambda: tmp_path)
+    (tmp_path / '.ssh').mkdir()
+    (tmp_path / '.ssh' / 'known_hosts').write_text(f'{hash_hostname("known.example.com")} ssh-ed25519 AAAA\n')
+    scans = []
+
+    async def fake_keyscan(hostnames: list[str], port: int) -> list[str]:
+        scans.append((sorted(hostnames), port))
+        return [f'{known_hosts_name(h, port)} ssh-ed25519 BBBB' for h in hostnames if h != 'down.example.com']
+
+    monkeypatch.setattr(ssh, 'keyscan', fake_keyscan)
+    hosts = [
+        ('known.example.com', 22),
+        ('new.example.com', 22),
+        ('new.example.com', 22),
+        ('down.example.com', 22),
+        ('ported.example.com', 2222),
+    ]
+    assert update_ssh_known_hosts(hosts) == {('down.example.com', 22)}
+    assert sorted(scans) == [(['down.example.com', 'new.example.com'], 22), (['ported.example.com'], 2222)]
+
+    index = KnownHosts(tmp_path / '.ssh' / 'known_hosts')
+    assert 'new.example.com' in index
+    assert '[ported.example.com]:2222' in index
+    assert 'BBBB' in (tmp_path / '.ssh' / 'known_hosts').read_text()
+
+    # Every host is now known, so nothing is scanned again
+    scans.clear()
+    assert update_ssh_known_hosts(hosts[:2]) == set()
+    assert scans == []
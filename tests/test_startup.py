@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+# Modules which must not be loaded just to start the CLI, e.g. for `borg-drone version`
+HEAVY_MODULES = {
+    'asyncio',
+    'getpass',
+    'json',
+    'pickle',
+    'subprocess',
+    'yaml',
+    'borg_drone.command',
+    'borg_drone.scheduler',
+    'borg_drone.ssh',
+    'borg_drone.tools',
+    'borg_drone.util',
+}
+
+
+def imported_modules(code: str, env: dict[str, str]) -> set[str]:
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=env,
+        cwd=Path(__file__).parent.parent,
+    )
+    return {line.rsplit('|', 1)[-1].strip() for line in result.stderr.splitlines() if line.startswith('import time:')}
+
+
+def test_startup_imports(tmp_path: Path):
+    env = dict(os.environ, XDG_CONFIG_HOME=str(tmp_path / 'xdg'))
+    modules = imported_modules('import borg_drone.__main__', env)
+    assert 'borg_drone.config' in modules
+    assert modules & HEAVY_MODULES == set()
+
+    # Importing must not touch the filesystem
+    assert not (tmp_path / 'xdg').exists()
@@ -0,0 +1,74 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from borg_drone import tools
+from borg_drone.tools import BorgCapabilities, Tool, ToolRegistry, parse_version
+
+from .conftest import FakeExecutable
+
+FAKE_BORG = '''#!{python}
+import sys
+with open({calls!r}, 'a') as f:
+    f.write(' '.join(sys.argv[1:]) + '\\n')
+print('borg 1.2.4')
+'''
+
+
+@pytest.fixture
+def fake_borg(tmp_path: Path, fake_executable: FakeExecutable) -> tuple[Path, Path]:
+    calls = tmp_path / 'calls'
+    return fake_executable('borg', FAKE_BORG, calls=str(calls)), calls
+
+
+def test_parse_version():
+    assert parse_version('borg 1.2.4') == (1, 2, 4)
+    assert parse_version('rclone v1.65.0\n- os/version: debian') == (1, 65, 0)
+    assert parse_version('OpenSSH_9.2p1 Debian-2, OpenSSL 3.0.11') == (9, 2)
+    assert parse_version('unknown') == ()
+
+
+def test_version_cached(fake_borg: tuple[Path, Path]):
+    borg, calls = fake_borg
+    tool = tools.find_tool('borg')
+    assert tool == Tool('borg', str(borg), (1, 2, 4))
+    assert tools.find_tool('borg') is tool
+
+    # A new process reads the version from the cache file
+    assert ToolRegistry().find('borg') == tool
+    assert calls.read_text() == '-V\n'
+
+    # Replacing the binary invalidates the cached version
+    stat = borg.stat()
+    os.utime(borg, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert ToolRegistry().find('borg') == tool
+    assert calls.read_text() == '-V\n-V\n'
+
+
+def test_missing_tool(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+    monkeypatch.setenv('PATH', str(tmp_path))
+    assert tools.find_tool('borg') is None
+    assert tools.borg_capabilities().tool.version == (1, 4)
+
+
+def test_borg_capabilities():
+    borg_1_1 = BorgCapabilities(Tool('borg', 'borg', (1, 1, 18)))
+    assert borg_1_1.log_json and not borg_1_1.compact
+    assert borg_1_1.ratelimit_option == '--remote-ratelimit'
+    assert borg_1_1.archive('now') == '::now'
+
+    borg_1_2 = BorgCapabilities(Tool('borg', 'borg', (1, 2, 4)))
+    assert borg_1_2.compact and not borg_1_2.borg2
+    assert borg_1_2.ratelimit_option == '--upload-ratelimit'
+    assert borg_1_2.init_command == ['borg', 'init']
+    assert borg_1_2.repo_list_command == ['borg', 'list']
+    assert borg_1_2.repository() == ['::']
+
+    borg_2 = BorgCapabilities(Tool('borg', 'borg', (2, 0, 0)))
+    assert borg_2.borg2 and borg_2.compact
+    assert borg_2.init_command == ['borg', 'repo-create']
+    assert borg_2.repo_info_command == ['borg', 'repo-info']
+    assert borg_2.repo_list_command == ['borg', 'repo-list']
+    assert borg_2.archive('now') == 'now'
+    assert borg_2.repository() == []
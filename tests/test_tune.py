@@ -0,0 +1,115 @@
+from dataclasses import replace
+from pathlib import Path
+
+import pytest
+import yaml
+
+from borg_drone.config import Archive, LocalRepository, RateLimit, RemoteRepository, Target
+from borg_drone.tune import CompressionResult, candidate_files, recommend, sample_files, write_compression
+
+from .conftest import FakeExecutable
+
+
+@pytest.fixture
+def source(tmp_path: Path) -> Path:
+    root = tmp_path / 'src'
+    (root / 'venv').mkdir(parents=True)
+    (root / 'venv' / 'lib.py').write_bytes(b'x' * 100)
+    for i in range(10):
+        (root / f'file{i}.txt').write_bytes(bytes([i]) * 1000)
+    (root / 'empty').touch()
+    return root
+
+
+def test_sample_files(source: Path, tmp_path: Path):
+    archive = Archive(name='archive', paths=[str(source)], exclude=['**/venv'])
+    assert sorted(Path(path).name for path, _ in candidate_files(archive)) == [f'file{i}.txt' for i in range(10)]
+
+    sample = sample_files(archive, tmp_path / 'sample', size=2500)
+    assert (sample.files, sample.size) == (3, 2500)
+    assert sorted(x.stat().st_size for x in sample.path.iterdir()) == [500, 1000, 1000]
+
+
+def test_recommend(local_repository_usb: LocalRepository, remote_repository_offsite: RemoteRepository):
+    archive = Archive(name='archive', paths=['/data'])
+    results = [
+        CompressionResult('lz4', 10**9, 6 * 10**8, 2.0),
+        CompressionResult('zstd,10', 10**9, 4 * 10**8, 20.0),
+    ]
+    assert recommend(results, Target(archive, local_repository_usb)).compression == 'lz4'
+    assert recommend(results, Target(archive, remote_repository_offsite)).compression == 'zstd,10'
+
+    # A fast link makes the extra CPU time not worth it
+    fast = replace(remote_repository_offsite, upload_ratelimit=RateLimit(default=1024**2))
+    assert recommend(results, Target(archive, fast)).compression == 'lz4'
+
+
+def test_write_compression(config_data: dict, tmp_path: Path):
+    config_file = tmp_path / 'config.yml'
+    config_file.write_text(yaml.safe_dump(config_data, sort_keys=False))
+    backup = write_compression(config_file, {
+        'archive1': {'usb': 'lz4', 'offsite': 'zstd,10'},
+        'archive2': {'usb': 'zstd,3', 'offsite': 'zstd,3'},
+    })
+    assert yaml.safe_load(backup.read_text()) == config_data
+
+    data = yaml.safe_load(config_file.read_text())
+    assert data['archives']['archive1']['compression'] == 'lz4'
+    assert data['archives']['archive1']['repositories'] == {'usb': None, 'offsite': {'compression': 'zstd,10'}}
+    assert data['archives']['archive2']['compression'] == 'zstd,3'
+    assert 'compression' not in data['archives']['archive2']['repositories']['offsite']
+
+
+def test_write_compression_partial(config_data: dict, tmp_path: Path):
+    config_file = tmp_path / 'config.yml'
+    config_data['archives']['archive1']['compression'] = 'lz4'
+    config_file.write_text(yaml.safe_dump(config_data, sort_keys=False))
+
+    # Only the second repository was tuned, the archive default used by the first is unchanged
+    write_compression(config_file, {'archive1': {'offsite': 'zstd,10'}})
+    data = yaml.safe_load(config_file.read_text())
+    assert data['archives']['archive1']['compression'] == 'lz4'
+    assert data['archives']['archive1']['repositories'] == {'usb': None, 'offsite': {'compression': 'zstd,10'}}
+
+    # Tuning the first repository changes the default, the second keeps its override
+    write_compression(config_file, {'archive1': {'usb': 'zstd,3'}})
+    data = yaml.safe_load(config_file.read_text())
+    assert data['archives']['archive1']['compression'] == 'zstd,3'
+    assert data['archives']['archive1']['repositories'] == {'usb': None, 'offsite': {'compression': 'zstd,10'}}
+
+    # A repository which inherited the previous default keeps it
+    write_compression(config_file, {'archive1': {'usb': 'lz4', 'offsite': 'lz4'}})
+    assert yaml.safe_load(config_file.read_text())['archives']['archive1']['repositories'] == ['usb', 'offsite']
+    write_compression(config_file, {'archive1': {'usb': 'zstd,6'}})
+    data = yaml.safe_load(config_file.read_text())
+    assert data['archives']['archive1']['compression'] == 'zstd,6'
+    assert data['archives']['archive1']['repositories'] == {'usb': None, 'offsite': {'compression': 'lz4'}}
+
+
+FAKE_BORG = '''#!{python}
+import json, sys
+if sys.argv[1] == 'create':
+    level = {{'lz4': 6, 'zstd,3': 4}}[sys.argv[sys.argv.index('--compression') + 1]]
+    stats = {{'original_size': 10000, 'compressed_size': level * 1000, 'deduplicated_size': 0, 'nfiles': 10}}
+    print(json.dumps({{'archive': {{'name': 'tune', 'duration': 0.1, 'stats': stats}}}}))
+'''
+
+
+def test_tune_command(
+    source: Path,
+    local_repository_usb: LocalRepository,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    capfd: pytest.CaptureFixture,
+    fake_executable: FakeExecutable,
+):
+    from borg_drone import command
+    fake_executable('borg', FAKE_BORG)
+    target = Target(Archive(name='archive', paths=[str(source)]), local_repository_usb)
+    monkeypatch.setattr(command, 'get_targets', lambda config_file, sync_target: [target])
+
+    recommendations = command.tune_command(tmp_path / 'config.yml', ('archive', ''), candidates=['lz4', 'zstd,3'])
+    assert list(recommendations) == ['archive:usb']
+    out, _ = capfd.readouterr()
+    assert out.startswith('archive (sample of 10.10 kB from 11 files)\n')
+    assert f'\trecommended for usb: {recommendations["archive:usb"]}' in out
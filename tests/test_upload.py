@@ -0,0 +1,154 @@
+import asyncio
+import json
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from borg_drone.config import Archive, LocalRepository, Target
+from borg_drone.upload import FULL_SYNC_INTERVAL, plan_upload, upload_group
+
+from .conftest import FakeExecutable
+
+FAKE_RCLONE = '''#!{python}
+import json, sys
+files = []
+if '--files-from-raw' in sys.argv:
+    with open(sys.argv[sys.argv.index('--files-from-raw') + 1]) as f:
+        files = f.read().split()
+command = next(x for x in sys.argv[1:] if x in ('copy', 'sync', 'delete'))
+with open({calls!r}, 'a') as f:
+    f.write(json.dumps([command, sys.argv[-1], files]) + '\\n')
+'''
+
+
+@pytest.fixture
+def rclone_calls(tmp_path: Path, fake_executable: FakeExecutable) -> Path:
+    calls = tmp_path / 'calls'
+    fake_executable('rclone', FAKE_RCLONE, calls=str(calls))
+    return calls
+
+
+def read_calls(calls: Path) -> list[list]:
+    result = [json.loads(line) for line in calls.read_text().splitlines()]
+    calls.unlink()
+    return result
+
+
+def test_upload_group(rclone_calls: Path, tmp_path: Path):
+    repo = LocalRepository(name='usb', encryption='none', path=str(tmp_path / 'usb'), rclone_upload_path='b2:backups')
+    targets = [Target(Archive(name=name, paths=['/data']), repo) for name in ('archive1', 'archive2')]
+    for target in targets:
+        path = Path(target.borg_repository_path)
+        (path / 'data' / '0').mkdir(parents=True)
+        for name in ('config', 'index.2', 'hints.2', 'data/0/1', 'data/0/2'):
+            (path / name).write_text(name)
+
+    asyncio.run(upload_group(targets))
+    assert read_calls(rclone_calls) == [
+        ['sync', 'b2:backups/archive1', []],
+        ['sync', 'b2:backups/archive2', []],
+    ]
+    assert plan_upload(targets[0]).changed == []
+
+    # borg appends a segment, writes a new index and hints, and compact removes an old segment
+    path = Path(targets[0].borg_repository_path)
+    (path / 'data' / '0' / '3').write_text('3')
+    (path / 'index.2').rename(path / 'index.3')
+    (path / 'hints.2').rename(path / 'hints.3')
+    (path / 'data' / '0' / '1').unlink()
+    asyncio.run(upload_group(targets))
+    assert read_calls(rclone_calls) == [
+        ['copy', 'b2:backups', ['archive1/data/0/3']],
+        ['copy', 'b2:backups', ['archive1/hints.3', 'archive1/index.3']],
+        ['delete', 'b2:backups', ['archive1/data/0/1', 'archive1/hints.2', 'archive1/index.2']],
+    ]
+
+    asyncio.run(upload_group(targets))
+    assert not rclone_calls.exists()
+    assert plan_upload(targets[0], now=time.time() + FULL_SYNC_INTERVAL).full
+    assert plan_upload(targets[0], full=True).full
+
+
+FAKE_RCLONE_REMOTE = '''#!{python}
+import hashlib, json, os, sys, time
+root = next(x for x in sys.argv if x.startswith('b2:')).replace('b2:backups', {remote!r})
+if sys.argv[1] == 'lsjson':
+    entries = []
+    for directory, _, names in os.walk(root):
+        for name in names:
+            st = os.stat(os.path.join(directory, name))
+            modtime = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(st.st_mtime)) + f'.{{st.st_mtime_ns % 10**9:09d}}Z'
+            path = os.path.relpath(os.path.join(directory, name), root)
+            entries.append({{'Path': path, 'Name': name, 'Size': st.st_size, 'ModTime': modtime}})
+    print('[\\n' + ',\\n'.join(map(json.dumps, entries)) + '\\n]')
+elif sys.argv[1] == 'hashsum':
+    with open(sys.argv[sys.argv.index('--files-from-raw') + 1]) as f:
+        files = f.read().split()
+    with open({calls!r}, 'a') as f:
+        f.write(json.dumps(['hashsum', sys.argv[2], files]) + '\\n')
+    for path in files:
+        if os.path.exists(os.path.join(root, path)):
+            with open(os.path.join(root, path), 'rb') as f:
+                print(hashlib.new(sys.argv[2], f.read()).hexdigest() + '  ' + path)
+'''
+
+
+def test_verify_upload(tmp_path: Path, fake_executable: FakeExecutable):
+    import hashlib
+    import shutil
+    from borg_drone.upload import read_state, verify_upload
+    remote = tmp_path / 'remote'
+    calls = tmp_path / 'calls'
+    fake_executable('rclone', FAKE_RCLONE_REMOTE, remote=str(remote), calls=str(calls))
+    repo = LocalRepository(name='usb', encryption='none', path=str(tmp_path / 'usb'), rclone_upload_path='b2:backups')
+    target = Target(Archive(name='archive', paths=['/data']), repo)
+    path = Path(target.borg_repository_path)
+    (path / 'data' / '0').mkdir(parents=True)
+    for name in ('config', 'index.2', 'hints.2', 'data/0/1', 'data/0/2'):
+        (path / name).write_text(name)
+
+    asyncio.run(upload_group([target]))
+    hashes = read_state(target).hashes
+    assert hashes['config'] == (hashlib.md5(b'config').hexdigest(), hashlib.sha1(b'config').hexdigest())
+    shutil.copytree(path, remote / 'archive')
+
+    # A sample of 0 only compares the listing
+    result = asyncio.run(verify_upload(target, sample=0))
+    assert result.ok and (result.files, result.hashed) == (5, 0)
+    assert not calls.exists()
+
+    # Segments are hashed first, and each verification continues with the files after the previous sample
+    result = asyncio.run(verify_upload(target, sample=2))
+    assert result.ok and (result.files, result.hashed) == (5, 2)
+    result = asyncio.run(verify_upload(target, sample=2, hash_type='sha1'))
+    assert result.ok and not result.modified
+    assert read_calls(calls) == [
+        ['hashsum', 'md5', ['data/0/1', 'data/0/2']],
+        ['hashsum', 'sha1', ['config', 'hints.2']],
+    ]
+
+    # A truncated and a missing segment are found from the listing, a corrupt file of the same size by its hash
+    (remote / 'archive' / 'data' / '0' / '1').write_text('da')
+    (remote / 'archive' / 'data' / '0' / '2').unlink()
+    corrupt = remote / 'archive' / 'index.2'
+    corrupt.write_text('INDEX.2')
+    os.utime(corrupt, ns=(0, (path / 'index.2').stat().st_mtime_ns))
+    (remote / 'archive' / 'hints.3').write_text('hints.3')
+    result = asyncio.run(verify_upload(target, sample=5))
+    assert not result.ok
+    assert result.missing == ['data/0/2']
+    assert result.truncated == ['data/0/1']
+    assert result.corrupt == ['index.2']
+    assert result.modified == []
+    assert result.unexpected == ['hints.3']
+    assert read_calls(calls) == [['hashsum', 'md5', ['hints.2', 'index.2', 'config']]]
+
+
+def test_parse_modtime():
+    from borg_drone.upload import parse_modtime
+    assert parse_modtime('1970-01-01T00:00:01.5Z') == 1.5
+    assert parse_modtime('1970-01-01T01:00:02.123456789+01:00') == pytest.approx(2.123456789)
+    assert parse_modtime('1970-01-01T00:00:03Z') == 3.0
+    assert parse_modtime('not a time') is None
@@ -0,0 +1,103 @@
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from subprocess import CalledProcessError
+
+import pytest
+
+from borg_drone.config import PriorityOptions
+from borg_drone.output import LineSplitter
+from borg_drone.util import atomic_write_text, priority_argv, run_cmd, run_cmd_async
+
+
+def test_run_cmd():
+    assert run_cmd([sys.executable, '-c', 'print("a"); print("b")'], capture=True) == ['a', 'b']
+    assert run_cmd([sys.executable, '-c', 'print("a"); print("b")']) == []
+
+
+def test_run_cmd_environment():
+    argv = [sys.executable, '-c', 'import os; print(os.environ["BORG_REPO"])']
+    assert run_cmd(argv, env={'BORG_REPO': '/path/to/repo'}, capture=True) == ['/path/to/repo']
+
+
+def test_run_cmd_error():
+    with pytest.raises(CalledProcessError) as ex:
+        run_cmd([sys.executable, '-c', 'exit(3)'])
+    assert ex.value.returncode == 3
+
+
+def test_run_cmd_error_tail(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp_path))
+    argv = [sys.executable, '-c', 'for i in range(1000): print(i)\nexit(1)']
+    with pytest.raises(CalledProcessError) as ex:
+        run_cmd(argv, spill=True)
+    assert ex.value.output == '\n'.join(map(str, range(950, 1000)))
+    spill_file, = tmp_path.glob('borg-drone-*.log')
+    assert spill_file.read_text().splitlines() == list(map(str, range(1000)))
+
+    # Output of successful commands is not kept
+    spill_file.unlink()
+    run_cmd([sys.executable, '-c', 'print(1)'], spill=True)
+    assert not list(tmp_path.glob('borg-drone-*.log'))
+
+
+def test_line_splitter():
+    splitter = LineSplitter(limit=4)
+    assert splitter.feed(b'a\nb') == ['a']
+    assert splitter.feed(b'c  \r\n\xff\n') == ['bc', '\ufffd']
+    assert splitter.feed(b'0123456789') == ['0123', '4567']
+    assert splitter.flush() == ['89']
+    assert splitter.flush() == []
+
+
+def test_run_cmd_async_concurrent():
+
+    async def run_all() -> list[list[str]]:
+        argv = [sys.executable, '-c', 'import time; time.sleep(0.2); print("done")']
+        return await asyncio.gather(*(run_cmd_async(argv, capture=True) for _ in range(10)))
+
+    start = time.monotonic()
+    results = asyncio.run(run_all())
+    assert time.monotonic() - start < 2
+    assert results == [['done']] * 10
+
+
+def test_run_cmd_priority():
+    current = os.nice(0)
+    priority = PriorityOptions(nice=min(current + 5, 19))
+    assert run_cmd([sys.executable, '-c', 'import os; print(os.nice(0))'], priority=priority, capture=True) == [
+        str(priority.nice)
+    ]
+
+
+@pytest.mark.skipif(not hasattr(os, 'sched_setaffinity'), reason='CPU affinity not supported')
+def test_run_cmd_cpu_affinity():
+    cpu = min(os.sched_getaffinity(0))
+    argv = [sys.executable, '-c', 'import os; print(sorted(os.sched_getaffinity(0)))']
+    assert run_cmd(argv, priority=PriorityOptions(cpu_affinity=[cpu]), capture=True) == [str([cpu])]
+
+
+def test_priority_argv():
+    assert priority_argv(['borg'], PriorityOptions(nice=10)) == ['borg']
+    if shutil.which('ionice'):
+        priority = PriorityOptions(ionice_class='idle', ionice_level=7)
+        assert priority_argv(['borg'], priority) == ['ionice', '-t', '-c', '3', '-n', '7', 'borg']
+
+
+def test_atomic_write_text(tmp_path: Path):
+    file = tmp_path / 'state' / 'file.json'
+    atomic_write_text(file, 'first')
+    atomic_write_text(file, 'second')
+    assert file.read_text() == 'second'
+    assert [p.name for p in file.parent.iterdir()] == ['file.json']
+
+    # The temporary file is removed when the file can not be replaced
+    file.unlink()
+    file.mkdir()
+    with pytest.raises(OSError):
+        atomic_write_text(file, 'third')
+    assert [p.name for p in file.parent.iterdir()] == ['file.json']